@@ -8,36 +8,46 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 import astro # Импортируем ваш основной файл с логикой бота
 
+astro.setup_logging()
 logger = logging.getLogger(__name__)
 
-# Этот флаг будет показывать, была ли MongoDB уже инициализирована
-_mongodb_initialized_cron = False
+# Цикл событий живет, пока жив контейнер: клиент MongoDB привязан к циклу,
+# поэтому при теплом вызове переиспользуются и клиент, и его пул соединений.
+_loop = None
+
+def get_event_loop():
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
 
 async def initialize_mongodb_for_cron():
-    """Инициализирует MongoDB, если еще не инициализировано."""
-    global _mongodb_initialized_cron
-    if not _mongodb_initialized_cron:
-        logger.info("Инициализация MongoDB для Cron Job...")
-        await astro.init_mongodb()
-        logger.info("Инициализация MongoDB завершена для Cron Job.")
-        _mongodb_initialized_cron = True
-    else:
-        logger.info("MongoDB уже инициализирована для Cron Job.")
+    """Инициализирует MongoDB (при теплом вызове клиент переиспользуется)."""
+    await astro.init_mongodb()
 
 def handler(request, context):
     """
     Обработчик для Cron Job.
-    Vercel Cron Job вызывает этот endpoint по HTTP.
+    Vercel Cron Job вызывает этот endpoint по HTTP. Каждый вызов работает не дольше
+    CRON_TIME_BUDGET (меньше maxDuration функции в vercel.json) и берет в аренду свободные шарды рассылки, поэтому расписание
+    вызывает его несколько раз за утро, а при BROADCAST_RUNNERS > 1 вызовы могут идти параллельно.
     """
     try:
         logger.info("Получен запрос на запуск ежедневной рассылки гороскопов (Cron Job).")
         
         # Запускаем асинхронную задачу
-        asyncio.run(run_scheduled_tasks())
+        progress = get_event_loop().run_until_complete(run_scheduled_tasks())
 
+        status = "finished" if progress.get("finished") else "in progress, will resume on next run"
         return {
             "statusCode": 200,
-            "body": "Daily horoscopes dispatch initiated successfully."
+            "body": (
+                f"Daily horoscopes dispatch {status}: sent={progress.get('sent', 0)}, "
+                f"blocked={progress.get('blocked', 0)}, failed={progress.get('failed', 0)}, "
+                f"shards finished={progress.get('shards_finished', 0)}/{progress.get('shards', 0)}, "
+                f"running={progress.get('shards_running', 0)}."
+            )
         }
     except Exception as e:
         logger.error(f"Ошибка при запуске Cron Job: {e}", exc_info=True)
@@ -51,5 +61,6 @@ async def run_scheduled_tasks():
     Асинхронная функция для выполнения запланированных задач.
     """
     await initialize_mongodb_for_cron()
-    await astro.scheduled_tasks()
+    progress = await astro.scheduled_tasks(astro.CRON_TIME_BUDGET)
     logger.info("Запланированные задачи (рассылка гороскопов) завершены.")
+    return progress
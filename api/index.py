@@ -1,21 +1,196 @@
 # api/index.py
-from aiohttp import web
+import os
+import sys
+import asyncio
+import logging
+
+from aiohttp import ClientSession, ClientTimeout, web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from starlette.applications import Starlette
-from starlette.routing import Mount
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+# Добавляем корневую директорию проекта в sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import astro # Импортируем основной файл с логикой бота
+
+astro.setup_logging()
+logger = logging.getLogger(__name__)
+
+
+FORWARDED_HEADER = "X-Astro-Forwarded"
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука, который сразу отвечает Telegram 200 и кладет обновление в UpdateLanes
+    (или WorkerPool). Если очередь переполнена, отвечает 503, и Telegram повторит доставку позже.
+    Обновление чата другой реплики (REPLICA_URLS) пересылается ей, Telegram получает ее ответ.
+    """
+
+    def __init__(self, lanes, **kwargs):
+        super().__init__(**kwargs)
+        self.lanes = lanes
+        self.forward_session = None
+
+    async def forward(self, replica: int, update: dict) -> web.Response:
+        if self.forward_session is None:
+            self.forward_session = ClientSession(timeout=ClientTimeout(total=astro.WEBHOOK_ENQUEUE_TIMEOUT + 3))
+        headers = {FORWARDED_HEADER: "1"}
+        if astro.WEBHOOK_SECRET:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = astro.WEBHOOK_SECRET
+        try:
+            async with self.forward_session.post(
+                f"{astro.REPLICA_URLS[replica]}{astro.WEBHOOK_PATH}", json=update, headers=headers
+            ) as response:
+                return web.Response(status=response.status)
+        except Exception as e:
+            logger.warning(f"Реплика {replica} недоступна, обновление {update.get('update_id')} не передано: {e}")
+            return web.Response(status=503, text="Replica unavailable")
+
+    async def deliver(self, update: dict) -> bool:
+        """Служебное обновление (подтверждение оплаты от лидера) - в процесс, которому принадлежит чат."""
+        replica = astro.update_replica(update)
+        if replica != astro.REPLICA_ID:
+            return (await self.forward(replica, update)).status == 200
+        return await self.lanes.put(update)
+
+    async def close(self):
+        if self.forward_session is not None:
+            await self.forward_session.close()
+        await super().close()
+
+    async def _handle_request_background(self, bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        # Пересланное обновление обрабатываем на месте, даже если списки реплик разошлись
+        replica = astro.update_replica(update)
+        if replica != astro.REPLICA_ID and FORWARDED_HEADER not in request.headers:
+            return await self.forward(replica, update)
+        if not await self.lanes.put(update):
+            logger.warning(f"Очередь обновлений переполнена, обновление {update.get('update_id')} отклонено.")
+            return web.Response(status=503, text="Too many pending updates")
+        return web.json_response({}, dumps=bot.session.json_dumps)
 
-# Создаем экземпляр aiohttp приложения
-_aiohttp_app_instance = web.Application()
 
 async def aiohttp_handle(request):
-    # Этот обработчик принадлежит приложению aiohttp
     return web.Response(text="Hello from Astro Bot!")
 
-_aiohttp_app_instance.router.add_get('/', aiohttp_handle)
 
-# Создаем приложение Starlette и монтируем в него aiohttp приложение
-# Приложение Starlette будет основной точкой входа ASGI для Uvicorn
+def metrics_authorized(headers) -> bool:
+    return not astro.METRICS_TOKEN or headers.get("Authorization") == f"Bearer {astro.METRICS_TOKEN}"
+
+
+async def aiohttp_metrics(request):
+    if not metrics_authorized(request.headers):
+        return web.Response(status=401, text="Unauthorized")
+    return web.Response(text=astro.metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def aiohttp_profile(request):
+    """
+    Отчет профайлера в формате folded stacks.
+    ?seconds=N - профилировать N секунд (не больше 60) прямо сейчас, если профайлер не включен постоянно;
+    ?reset=1 - очистить накопленные стеки после выдачи.
+    Профайлер раскрывает код и нагружает процесс, поэтому без METRICS_TOKEN эндпоинт выключен.
+    """
+    if not astro.METRICS_TOKEN:
+        return web.Response(status=404, text="Profiler endpoint is disabled: METRICS_TOKEN is not set")
+    if not metrics_authorized(request.headers):
+        return web.Response(status=401, text="Unauthorized")
+    profiler = astro.profiler
+    if not profiler.running:
+        seconds = min(float(request.query.get("seconds", "10")), 60)
+        profiler.reset()
+        profiler.start()
+        if not profiler.running:
+            return web.Response(status=501, text="Profiler is not available on this platform")
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+    report = profiler.report()
+    if request.query.get("reset") == "1":
+        profiler.reset()
+    return web.Response(text=report, content_type="text/plain", charset="utf-8")
+
+
+def create_app(argv=None) -> web.Application:
+    """
+    aiohttp-приложение вебхука (Render):
+    python -m aiohttp.web -H 0.0.0.0 -P $PORT api.index:create_app
+
+    Несколько процессов: WORKERS=N. Несколько реплик: REPLICA_URLS и REPLICA_ID на каждой.
+    """
+    if astro.WORKERS > 1:
+        # Этот процесс только принимает вебхуки, обработка - в процессах-воркерах
+        lanes = astro.WorkerPool(astro.worker_process, astro.WORKERS, astro.WORKER_QUEUE_SIZE)
+    else:
+        lanes = astro.UpdateLanes(astro.WEBHOOK_LANES, astro.WEBHOOK_LANE_SIZE, astro.WEBHOOK_ENQUEUE_TIMEOUT)
+
+    bot = astro.get_bot()
+    dispatcher = astro.get_dispatcher()
+
+    async def on_startup(app):
+        await astro.on_startup(bot)
+        lanes.start(bot, dispatcher)
+
+    async def on_shutdown(app):
+        await lanes.stop()
+        await astro.on_shutdown(bot)
+
+    app = web.Application()
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app.router.add_get('/', aiohttp_handle)
+    app.router.add_get('/metrics', aiohttp_metrics)
+    app.router.add_get('/debug/profile', aiohttp_profile)
+
+    request_handler = QueuedRequestHandler(
+        lanes=lanes,
+        dispatcher=dispatcher,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=astro.WEBHOOK_SECRET
+    )
+    request_handler.register(app, path=astro.WEBHOOK_PATH)
+    astro.payment_verifier.deliver = request_handler.deliver
+    return app
+
+
+# --- ASGI-приложение для Vercel ---
+# Serverless-функция замораживается после ответа, поэтому здесь обновление
+# обрабатывается до ответа, а буферы записей пользователей и событий дописываются сразу.
+
+async def index(request: Request):
+    return PlainTextResponse("Hello from Astro Bot!")
+
+async def metrics(request: Request):
+    # Метрики только текущего экземпляра функции: подходят для отладки, не для агрегирования
+    if not metrics_authorized(request.headers):
+        return PlainTextResponse("Unauthorized", status_code=401)
+    return PlainTextResponse(astro.metrics.render())
+
+async def webhook(request: Request):
+    if astro.WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != astro.WEBHOOK_SECRET:
+        return PlainTextResponse("Unauthorized", status_code=401)
+    await astro.init_mongodb() # При теплом вызове клиент уже готов
+
+    update = await request.json()
+    try:
+        await astro.get_dispatcher().feed_raw_update(bot=astro.get_bot(), update=update)
+    except Exception as e:
+        logger.error(f"Ошибка при обработке обновления {update.get('update_id')}: {e}", exc_info=True)
+    finally:
+        await astro.user_writes.flush()
+        await astro.analytics.flush()
+    return JSONResponse({})
+
 app = Starlette(
     routes=[
-        Mount("/", app=_aiohttp_app_instance), # Монтируем aiohttp приложение в корневой путь
+        Route("/", index),
+        Route("/metrics", metrics),
+        Route("/api/webhook", webhook, methods=["POST"]),
     ]
 )
@@ -1,25 +1,48 @@
 import os
 import logging
-import hashlib
-import random
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F
+from datetime import date, datetime, timedelta, timezone
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.enums.parse_mode import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
-from aiogram.types import ReplyKeyboardMarkup, InlineKeyboardMarkup, ReplyKeyboardRemove
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
 import asyncio
+import hashlib
+from abc import ABC, abstractmethod
 import re
-from motor.motor_asyncio import AsyncIOMotorClient
-from dotenv import load_dotenv
+import sys
+import time
+import uuid
+from array import array
+from collections import OrderedDict, deque
+from queue import Empty
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+from runtime.fsm_storage import MongoStorage
+from runtime.keyboards import KeyboardRegistry, StaticKeyboardMiddleware
+from runtime.leases import INSTANCE_ID, LeaderLease, acquire_lease, lease_is_free, release_lease
+from runtime.metrics import HandlerMetricsMiddleware, TelegramMetricsMiddleware, UpdateMetricsMiddleware, metrics, timed_db
+from runtime.outbound import OutboundDispatcher
+from runtime.periodic import PeriodicFlusher
+from runtime.profiler import SamplingProfiler
+from runtime.ratelimit import SendRateLimiter
+from runtime.throttling import ThrottlingMiddleware, UpdateThrottlingMiddleware, parse_throttle_limits
+from runtime.updates import REPLICA_SEED, UpdateLanes, WorkerPool, chat_shard, poll_updates, report_metrics, update_chat_id
+
+# Модуль импортируется на каждом холодном старте (api/cron.py, api/index.py), поэтому при импорте
+# ничего не создается: бот, диспетчер, роутер и клиент MongoDB собираются при первом обращении
+# (get_bot, get_dispatcher, init_mongodb), а motor, NumPy и билдеры клавиатур импортируются там,
+# где они действительно нужны.
 
 # --- Загрузка переменных окружения для локальной разработки ---
-# На Render эти переменные будут установлены автоматически.
-load_dotenv()
+# На Render и Vercel эти переменные задаются платформой, .env нужен только локально.
+if not (os.getenv("RENDER") or os.getenv("VERCEL")):
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # --- Настройки (читаются из переменных окружения) ---
 TOKEN = os.getenv("BOT_TOKEN")
@@ -28,6 +51,83 @@ ADSGRAM_API_KEY = os.getenv("ADSGRAM_API_KEY")
 MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "AstroBotDB")
 MONGO_COLLECTION_NAME = os.getenv("MONGO_COLLECTION_NAME", "users")
+MONGO_BROADCASTS_COLLECTION_NAME = os.getenv("MONGO_BROADCASTS_COLLECTION_NAME", "broadcasts")
+MONGO_HOROSCOPES_COLLECTION_NAME = os.getenv("MONGO_HOROSCOPES_COLLECTION_NAME", "horoscopes")
+MONGO_PAYMENTS_COLLECTION_NAME = os.getenv("MONGO_PAYMENTS_COLLECTION_NAME", "payments")
+MONGO_PAYMENT_CHECKS_COLLECTION_NAME = os.getenv("MONGO_PAYMENT_CHECKS_COLLECTION_NAME", "payment_checks")
+MONGO_META_COLLECTION_NAME = os.getenv("MONGO_META_COLLECTION_NAME", "meta")
+MONGO_FSM_COLLECTION_NAME = os.getenv("MONGO_FSM_COLLECTION_NAME", "fsm_states")
+MONGO_EVENTS_COLLECTION_NAME = os.getenv("MONGO_EVENTS_COLLECTION_NAME", "events")
+MONGO_EVENTS_DAILY_COLLECTION_NAME = os.getenv("MONGO_EVENTS_DAILY_COLLECTION_NAME", "events_daily")
+# Пул соединений MongoDB
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+# Версия набора индексов: увеличьте при изменении индексов в ensure_indexes
+MONGO_INDEX_VERSION = 6
+# Идентификатор деплоя: индексы проверяются один раз на деплой, а не на каждый процесс
+DEPLOYMENT_ID = os.getenv("VERCEL_DEPLOYMENT_ID") or os.getenv("RENDER_GIT_COMMIT") or "local"
+# Хранилище состояний FSM: "mongo" (по умолчанию) или "memory"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "mongo")
+# Через сколько секунд без активности сессия FSM удаляется
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+# Сколько секунд состояние из локального кэша считается свежим. 0 - без кэша: нужно, если обновления
+# одного чата попадают на разные инстансы (Vercel), на Render их держит один процесс (UpdateLanes, WorkerPool)
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "30"))
+# Сколько дней хранить сгенерированные гороскопы в MongoDB
+HOROSCOPES_RETENTION_DAYS = int(os.getenv("HOROSCOPES_RETENTION_DAYS", "7"))
+# На сколько дней вперед (включая текущий) рассылка заранее сохраняет тексты гороскопов
+HOROSCOPE_PREWARM_DAYS = int(os.getenv("HOROSCOPE_PREWARM_DAYS", "2"))
+
+# Обслуживание пользователей (раз в день вместе с рассылкой или командой maintain-users):
+# через сколько дней удалять заблокировавших бота и пользователей без знака, давно не бравших гороскоп.
+# 0 - не удалять.
+USERS_BLOCKED_RETENTION_DAYS = int(os.getenv("USERS_BLOCKED_RETENTION_DAYS", "30"))
+USERS_INACTIVE_DAYS = int(os.getenv("USERS_INACTIVE_DAYS", "180"))
+
+# Кэш пользователей и буферизация записей в MongoDB
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+USER_WRITE_FLUSH_INTERVAL = float(os.getenv("USER_WRITE_FLUSH_INTERVAL", "1"))
+USER_WRITE_FLUSH_THRESHOLD = int(os.getenv("USER_WRITE_FLUSH_THRESHOLD", "500"))
+
+# Ограничение на бесплатные гороскопы в день
+DAILY_FREE_HOROSCOPES = 2
+
+# Фоновая проверка оплат: период опроса провайдеров и сколько ждать подтверждения
+PAYMENT_POLL_INTERVAL = float(os.getenv("PAYMENT_POLL_INTERVAL", "2"))
+PAYMENT_CHECK_TIMEOUT = float(os.getenv("PAYMENT_CHECK_TIMEOUT", "30"))
+# Проверять оплату один раз прямо в хендлере, без фонового опроса. По умолчанию - на Vercel:
+# функция замораживается после ответа, и фоновые задачи там не выполняются
+PAYMENT_CHECK_INLINE = os.getenv("PAYMENT_CHECK_INLINE", "1" if os.getenv("VERCEL") else "0") == "1"
+# Через сколько секунд заглушка провайдера подтверждает оплату
+PAYMENT_MOCK_CONFIRM_AFTER = float(os.getenv("PAYMENT_MOCK_CONFIRM_AFTER", "5"))
+
+# Настройки ежедневной рассылки.
+# Telegram допускает ~30 сообщений в секунду на бота и ~1 сообщение в секунду в один чат.
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "20"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CHAT_RATE = float(os.getenv("BROADCAST_CHAT_RATE", "1"))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))
+# Курсор шарда сохраняется после каждых BROADCAST_CHECKPOINT_SIZE отправок. Если запуск упадет между
+# чекпоинтами, повторный начнет с сохраненного курсора - до этого числа пользователей получат гороскоп дважды.
+BROADCAST_CHECKPOINT_SIZE = int(os.getenv("BROADCAST_CHECKPOINT_SIZE", "50"))
+# Сколько секунд может работать один запуск рассылки (0 - без ограничения).
+# На serverless задайте чуть меньше таймаута функции, остаток доработает следующий запуск.
+BROADCAST_TIME_BUDGET = float(os.getenv("BROADCAST_TIME_BUDGET", "0"))
+# Бюджет запуска из cron (api/cron.py). Меньше maxDuration функции в vercel.json (60 с) с запасом
+# на последний чекпоинт: бюджет проверяется между чекпоинтами, а не посреди пачки.
+CRON_TIME_BUDGET = float(os.getenv("CRON_TIME_BUDGET", "45"))
+# Пользователи делятся на BROADCAST_SHARDS диапазонов user_id, каждый запуск берет свободный
+# диапазон в аренду на BROADCAST_LEASE_SECONDS (продлевается на каждом чекпоинте).
+# Одновременно рассылают не больше BROADCAST_RUNNERS запусков, лимит BROADCAST_RATE делится между ними:
+# Telegram ограничивает скорость на бота, а не на процесс.
+BROADCAST_SHARDS = int(os.getenv("BROADCAST_SHARDS", "16"))
+BROADCAST_RUNNERS = int(os.getenv("BROADCAST_RUNNERS", "1"))
+BROADCAST_LEASE_SECONDS = float(os.getenv("BROADCAST_LEASE_SECONDS", "120"))
 
 # Настройки вебхука для Render/Vercel
 # WEBHOOK_HOST = os.getenv("WEBHOOK_HOST") # Это может быть адрес вашего Render сервиса
@@ -44,46 +144,337 @@ if not WEBHOOK_HOST:
     WEBHOOK_HOST = os.getenv("WEBHOOK_HOST") # Fallback для случаев, если вы задаете его вручную
 WEBHOOK_PATH = f"/webhook/{TOKEN}"
 WEBHOOK_URL = f"https://{WEBHOOK_HOST}{WEBHOOK_PATH}" if WEBHOOK_HOST and TOKEN else None
+# Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token каждого запроса
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Обработка обновлений вебхука: число параллельных полос и размер очереди каждой полосы.
+# Если очередь полосы заполнена дольше WEBHOOK_ENQUEUE_TIMEOUT секунд, вебхук отвечает 503
+# и Telegram повторит доставку позже.
+WEBHOOK_LANES = int(os.getenv("WEBHOOK_LANES", "32"))
+WEBHOOK_LANE_SIZE = int(os.getenv("WEBHOOK_LANE_SIZE", "100"))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "2"))
+
+# Горизонтальное масштабирование.
+# WORKERS > 1: обновления обрабатываются в WORKERS процессах, процесс выбирается по хешу чата.
+# REPLICA_URLS (через запятую, внутренние адреса всех реплик в одном порядке) и REPLICA_ID (номер
+# этой реплики): вебхук, пришедший не на ту реплику, пересылается реплике, которой принадлежит чат.
+# Polling и рассылку по расписанию выполняет только лидер - процесс с арендой в коллекции meta.
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+REPLICA_ID = int(os.getenv("REPLICA_ID", "0"))
+REPLICA_URLS = [url.strip().rstrip("/") for url in os.getenv("REPLICA_URLS", "").split(",") if url.strip()]
+LEADER_LEASE_SECONDS = float(os.getenv("LEADER_LEASE_SECONDS", "30"))
+# Час (UTC), с которого лидер долгоживущего процесса (Render, polling) запускает ежедневную рассылку.
+# Не задан - рассылку запускает внешний cron (api/cron.py на Vercel).
+BROADCAST_HOUR = int(os.getenv("BROADCAST_HOUR")) if os.getenv("BROADCAST_HOUR") else None
+
+# Исходящие запросы к Bot API: размер пула keep-alive соединений, общий лимит сообщений в секунду
+# (0 - без лимита: ответы пользователям не ограничиваются, у рассылки свой лимит BROADCAST_RATE)
+# и число повторов после RetryAfter и сетевых ошибок - для всех запросов, включая рассылку.
+BOT_CONNECTION_LIMIT = int(os.getenv("BOT_CONNECTION_LIMIT", "100"))
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "0"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+# Метрики отдаются на /metrics. Если задан METRICS_TOKEN, он требуется в заголовке
+# Authorization: Bearer <METRICS_TOKEN>. Эндпоинт профайлера /debug/profile без METRICS_TOKEN выключен.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# При WORKERS > 1 воркеры раз в METRICS_REPORT_INTERVAL секунд отправляют снимок своих метрик
+# основному процессу, и /metrics отдает сумму по всем процессам.
+METRICS_REPORT_INTERVAL = float(os.getenv("METRICS_REPORT_INTERVAL", "5"))
+# Семплирующий профайлер (SIGPROF, только Unix): PROFILER_ENABLED=1 включает его при старте,
+# иначе его можно запустить на время через /debug/profile?seconds=N.
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.01"))
+# События аналитики: размер кольцевого буфера, период и порог записи пачкой, срок хранения
+# (для time-series коллекции) и размер capped-коллекции, если сервер старше MongoDB 5.0
+EVENTS_BUFFER_SIZE = int(os.getenv("EVENTS_BUFFER_SIZE", "10000"))
+EVENTS_FLUSH_INTERVAL = float(os.getenv("EVENTS_FLUSH_INTERVAL", "5"))
+EVENTS_FLUSH_THRESHOLD = int(os.getenv("EVENTS_FLUSH_THRESHOLD", "1000"))
+EVENTS_RETENTION_DAYS = int(os.getenv("EVENTS_RETENTION_DAYS", "90"))
+EVENTS_CAPPED_BYTES = int(os.getenv("EVENTS_CAPPED_BYTES", str(256 * 1024 * 1024)))
+# Защита от флуда: сколько обновлений в секунду (и сколько подряд) пропускается от одного пользователя.
+# Отдельные лимиты хендлеров (вдобавок к общему) - флаг throttle при регистрации или THROTTLE_LIMITS
+# вида "cmd_start=0.2/3,check_payment=0.5/2". THROTTLE_RATE=0 выключает защиту целиком.
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "2"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "5"))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "100000"))
+THROTTLE_LIMITS = parse_throttle_limits(os.getenv("THROTTLE_LIMITS", ""))
 
 
 # --- Логирование ---
-# Настройка логирования для вывода в консоль (Render будет перехватывать это)
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# --- Проверка наличия обязательных переменных окружения ---
-if not TOKEN:
-    logger.error("Environment variable BOT_TOKEN is not set.")
-    raise ValueError("Environment variable BOT_TOKEN is not set.")
-if not TON_WALLET:
-    logger.error("Environment variable TON_WALLET_ADDRESS is not set.")
-    # raise ValueError("Environment variable TON_WALLET_ADDRESS is not set.") # Закомментировано, если это не критично для запуска
-if not MONGO_URI:
-    logger.error("Environment variable MONGO_URI is not set.")
-    raise ValueError("Environment variable MONGO_URI is not set.")
+def setup_logging():
+    # Настройка логирования для вывода в консоль (Render будет перехватывать это).
+    # Вызывается точками входа, а не при импорте модуля.
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# --- Метрики ---
+# Реестр metrics и middleware метрик - в runtime.metrics, профайлер - в runtime.profiler.
+profiler = SamplingProfiler(PROFILER_INTERVAL)
 
 # --- Инициализация бота и диспетчера ---
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage()) # Используем MemoryStorage
+async def gather_awaitables(*awaitables):
+    """asyncio.gather, который принимает и методы Bot API (они awaitable, но не хешируются)."""
+    return await asyncio.gather(*(asyncio.ensure_future(awaitable) for awaitable in awaitables))
+
+
+def answer_callback_early(callback: types.CallbackQuery) -> asyncio.Future:
+    """
+    Отвечает на callback параллельно с работой хендлера: "часики" на кнопке пропадают сразу,
+    а answerCallbackQuery идет вне очереди чата. Результат нужно дождаться в конце хендлера.
+    """
+    return asyncio.ensure_future(callback.answer())
+
+
+_bot = None
+_dp = None
+
+def get_bot() -> Bot:
+    global _bot
+    if _bot is None:
+        # --- Проверка наличия обязательных переменных окружения ---
+        if not TOKEN:
+            logger.error("Environment variable BOT_TOKEN is not set.")
+            raise ValueError("Environment variable BOT_TOKEN is not set.")
+        if not TON_WALLET:
+            logger.error("Environment variable TON_WALLET_ADDRESS is not set.")
+            # raise ValueError("Environment variable TON_WALLET_ADDRESS is not set.") # Закомментировано, если это не критично для запуска
+        # Один ClientSession на процесс с пулом keep-alive соединений к api.telegram.org
+        session = AiohttpSession(limit=BOT_CONNECTION_LIMIT)
+        # Первый middleware - внешний: метрики считают каждую попытку, без ожидания в очереди чата,
+        # а клавиатура подставляется последней, когда OutboundDispatcher уже склеил правки
+        session.middleware(OutboundDispatcher(OUTBOUND_RATE, OUTBOUND_MAX_RETRIES))
+        session.middleware(TelegramMetricsMiddleware())
+        session.middleware(StaticKeyboardMiddleware(keyboards))
+        _bot = Bot(token=TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    return _bot
+
+def get_dispatcher() -> Dispatcher:
+    global _dp
+    if _dp is None:
+        if FSM_STORAGE == "memory":
+            # Состояния в памяти процесса (удобно для локальной разработки)
+            from aiogram.fsm.storage.memory import MemoryStorage
+            storage = MemoryStorage()
+        else:
+            storage = MongoStorage(lambda: db[MONGO_FSM_COLLECTION_NAME], FSM_CACHE_SIZE, FSM_CACHE_TTL)
+        # FSM-middleware диспетчер регистрирует сам сразу после своих; здесь она ставится вручную,
+        # после защиты от флуда: отброшенное обновление не должно читать состояние из хранилища
+        _dp = Dispatcher(storage=storage, disable_fsm=True)
+        _dp.update.outer_middleware(UpdateMetricsMiddleware())
+        _dp.update.outer_middleware(PaymentConfirmedMiddleware())
+        throttling = None
+        if THROTTLE_RATE > 0:
+            throttling = ThrottlingMiddleware(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAX_USERS, THROTTLE_LIMITS)
+            _dp.update.outer_middleware(UpdateThrottlingMiddleware(throttling))
+            metrics.gauge("astro_throttle_buckets", lambda: len(throttling.buckets))
+        _dp.update.outer_middleware(_dp.fsm)
+        # Inner-middleware диспетчера действуют и на хендлеры вложенных роутеров.
+        # Лимиты хендлеров - первыми, чтобы отброшенные обновления не попадали в метрики хендлеров
+        if throttling is not None:
+            _dp.message.middleware(throttling)
+            _dp.callback_query.middleware(throttling)
+        handler_metrics = HandlerMetricsMiddleware()
+        _dp.message.middleware(handler_metrics)
+        _dp.callback_query.middleware(handler_metrics)
+        fsm_transitions = FSMTransitionMiddleware()
+        _dp.message.middleware(fsm_transitions)
+        _dp.callback_query.middleware(fsm_transitions)
+        _dp.include_router(create_router())
+    return _dp
+
+def __getattr__(name):
+    # astro.bot и astro.dp создаются при первом обращении
+    if name == "bot":
+        return get_bot()
+    if name == "dp":
+        return get_dispatcher()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # --- Соединение с MongoDB ---
-mongo_client: AsyncIOMotorClient = None
+# Клиент motor привязан к циклу событий, в котором создан. На serverless контейнер переживает
+# несколько вызовов, поэтому клиент (и его пул соединений) переиспользуется, пока жив его цикл,
+# и пересоздается, только если init_mongodb вызвали из другого цикла.
+mongo_client = None
 db = None
 users_collection = None
+broadcasts_collection = None
+horoscopes_collection = None
+payments_collection = None
+_mongo_loop = None
+_indexes_ready = False
 
 async def init_mongodb():
-    global mongo_client, db, users_collection
+    global mongo_client, db, users_collection, broadcasts_collection, horoscopes_collection, payments_collection, _mongo_loop
+    loop = asyncio.get_running_loop()
+    if mongo_client is not None and _mongo_loop is loop:
+        return # Теплый старт: клиент и пул соединений уже готовы
+
+    if not MONGO_URI:
+        logger.error("Environment variable MONGO_URI is not set.")
+        raise ValueError("Environment variable MONGO_URI is not set.")
+    from motor.motor_asyncio import AsyncIOMotorClient
+    if mongo_client is not None:
+        logger.info("Цикл событий сменился, пересоздаем клиент MongoDB.")
+        close_mongodb()
     try:
-        mongo_client = AsyncIOMotorClient(MONGO_URI)
+        mongo_client = AsyncIOMotorClient(
+            MONGO_URI,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            appname="astro"
+        )
+        _mongo_loop = loop
         db = mongo_client[MONGO_DB_NAME]
         users_collection = db[MONGO_COLLECTION_NAME]
-        await users_collection.create_index("user_id", unique=True)
+        broadcasts_collection = db[MONGO_BROADCASTS_COLLECTION_NAME]
+        horoscopes_collection = db[MONGO_HOROSCOPES_COLLECTION_NAME]
+        payments_collection = db[MONGO_PAYMENTS_COLLECTION_NAME]
+        await ensure_indexes()
         logger.info("Успешно подключено к MongoDB.")
     except Exception as e:
         logger.error(f"Ошибка при подключении к MongoDB: {e}", exc_info=True)
+        close_mongodb()
         # В случае ошибки, возможно, стоит поднять исключение или предпринять другие действия
         raise ConnectionError(f"Не удалось подключиться к MongoDB: {e}")
 
+async def ensure_indexes():
+    """
+    Создает индексы один раз на деплой: отметка о версии индексов и деплое хранится
+    в коллекции meta, и остальные процессы того же деплоя обходятся одним find_one.
+    """
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    meta_collection = db[MONGO_META_COLLECTION_NAME]
+    marker = f"{MONGO_INDEX_VERSION}:{DEPLOYMENT_ID}"
+    if await meta_collection.find_one({"_id": "indexes", "marker": marker}, projection={"_id": 1}):
+        _indexes_ready = True
+        return
+
+    # В компактной схеме user_id - это _id. Уникальный индекс user_id прежней схемы счел бы все компактные
+    # документы (без user_id) дубликатами null, поэтому он заменяется частичным до первой записи новой версии.
+    # Сами документы переписывает migrate_users - командой migrate-users или из cron, но не на старте:
+    # на большой коллекции она не уложится в таймаут webhook
+    if await users_migration_pending():
+        await replace_legacy_user_index()
+        logger.warning("В базе есть пользователи прежней схемы: запустите python astro.py migrate-users "
+                       "(пока она не закончена, ее продолжает каждый запуск cron).")
+    # Рассылка идет по знакам, внутри знака - по возрастанию user_id
+    await users_collection.create_index([(USER_SIGN, 1), ("_id", 1)])
+    # Обслуживание пользователей (maintain_users): сброс счетчиков и удаление неактивных и заблокировавших бота
+    await users_collection.create_index(USER_QUOTA_DAY)
+    await users_collection.create_index(USER_BLOCKED_DAY, sparse=True)
+    # Шарды рассылки дня (claim_broadcast_shard)
+    await broadcasts_collection.create_index([("day", 1), ("shard", 1)])
+    await horoscopes_collection.create_index("created_at", expireAfterSeconds=HOROSCOPES_RETENTION_DAYS * 86400)
+    await payments_collection.create_index("order_id", unique=True)
+    await payments_collection.create_index("group")
+    await payments_collection.create_index([("user_id", 1), ("status", 1), ("created_at", -1)])
+    # Проверки, которые никто не завершил (например, без фонового опроса), удаляются через час после срока
+    await db[MONGO_PAYMENT_CHECKS_COLLECTION_NAME].create_index("deadline", expireAfterSeconds=3600)
+    if FSM_STORAGE != "memory":
+        await db[MONGO_FSM_COLLECTION_NAME].create_index("updated_at", expireAfterSeconds=FSM_STATE_TTL)
+    await ensure_events_collection()
+
+    await meta_collection.update_one(
+        {"_id": "indexes"},
+        {"$set": {"marker": marker, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    _indexes_ready = True
+    logger.info(f"Индексы MongoDB созданы (версия {marker}).")
+
+def close_mongodb():
+    global mongo_client, _mongo_loop
+    if mongo_client is not None:
+        mongo_client.close()
+        mongo_client = None
+        _mongo_loop = None
+        logger.info("MongoDB соединение закрыто.")
+
+def today_key() -> str:
+    """Текущий день (UTC) в виде строки YYYY-MM-DD."""
+    return datetime.now(timezone.utc).date().isoformat()
+
+def day_number(day: str) -> int:
+    """Ключ дня YYYY-MM-DD числом YYYYMMDD: int32 в BSON, сравнивается как дата."""
+    return int(day[:4]) * 10000 + int(day[5:7]) * 100 + int(day[8:10])
+
+async def claim_daily_run(job: str, day: str) -> bool:
+    """
+    Отметка "задача job за день day уже запущена" в коллекции meta. True получает только первый
+    вызов за день: повторные и параллельные вызовы cron пропускают задачу.
+    """
+    try:
+        await db[MONGO_META_COLLECTION_NAME].update_one(
+            {"_id": job, "day": {"$ne": day}}, {"$set": {"day": day}}, upsert=True
+        )
+    except DuplicateKeyError:
+        return False # Отметка уже стоит на этом дне
+    return True
+
+# --- Знаки зодиака ---
+ZODIAC_SIGNS = [
+    "♈ Овен", "♉ Телец", "♊ Близнецы", "♋ Рак", "♌ Лев", "♍ Дева",
+    "♎ Весы", "♏ Скорпион", "♐ Стрелец", "♑ Козерог", "♒ Водолей", "♓ Рыбы"
+]
+SIGN_INDEX = {sign: index for index, sign in enumerate(ZODIAC_SIGNS)}
+
+# Первый день каждого знака: (месяц, день, индекс в ZODIAC_SIGNS)
+ZODIAC_STARTS = [
+    (1, 20, 10), (2, 19, 11), (3, 21, 0), (4, 20, 1), (5, 21, 2), (6, 21, 3),
+    (7, 23, 4), (8, 23, 5), (9, 23, 6), (10, 23, 7), (11, 22, 8), (12, 22, 9)
+]
+
+# Номер дня в високосном году, с которого начинается месяц (индекс - номер месяца)
+MONTH_OFFSETS = [0, 0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335]
+
+def _build_zodiac_day_table() -> bytes:
+    table = bytearray(367)
+    sign_index = ZODIAC_STARTS[-1][2] # 1-19 января - еще Козерог
+    starts = {MONTH_OFFSETS[month] + day: index for month, day, index in ZODIAC_STARTS}
+    for day_of_year in range(1, 367):
+        sign_index = starts.get(day_of_year, sign_index)
+        table[day_of_year] = sign_index
+    return bytes(table)
+
+# Индекс знака для каждого дня года (1-366, 29 февраля включено)
+ZODIAC_DAY_TABLE = _build_zodiac_day_table()
+
+_numpy = None
+
+def get_numpy():
+    """NumPy импортируется при первой массовой операции. None, если он не установлен."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError: # NumPy нужен только для массовых операций, без него работает медленнее
+            _numpy = False
+    return _numpy or None
+
+def get_zodiac_sign(day: int, month: int) -> str:
+    return ZODIAC_SIGNS[ZODIAC_DAY_TABLE[MONTH_OFFSETS[month] + day]]
+
+def get_zodiac_sign_indices(months, days):
+    """
+    Индексы знаков (в ZODIAC_SIGNS) для массивов месяцев и дней рождения.
+
+    С NumPy - один векторный lookup по таблице, без него - array('B').
+    """
+    np = get_numpy()
+    if np is not None:
+        offsets = np.asarray(MONTH_OFFSETS, dtype=np.int16)
+        table = np.frombuffer(ZODIAC_DAY_TABLE, dtype=np.uint8)
+        return table[offsets[np.asarray(months, dtype=np.intp)] + np.asarray(days, dtype=np.int16)]
+    return array("B", (ZODIAC_DAY_TABLE[MONTH_OFFSETS[month] + day] for month, day in zip(months, days)))
+
 # --- Состояния FSM ---
 class UserState(StatesGroup):
     choosing_sign = State()
@@ -95,14 +486,417 @@ class UserState(StatesGroup):
     waiting_for_birth_date = State()
 
 # --- Вспомогательные функции для работы с БД ---
-async def get_user_data(user_id: int):
-    return await users_collection.find_one({"user_id": user_id})
+
+# Схема документа пользователя. _id - Telegram user_id, имена полей короткие: они повторяются
+# в каждом документе и в каждом ответе MongoDB. Дни хранятся числом YYYYMMDD (day_number).
+# Отсутствующее поле означает значение по умолчанию, поэтому новый пользователь - это почти пустой документ.
+USER_SIGN = "s"  # индекс знака в ZODIAC_SIGNS
+USER_BIRTH_DATE = "b"  # дата рождения, YYYYMMDD
+USER_QUOTA_DAY = "d"  # день последнего бесплатного гороскопа
+USER_QUOTA_USED = "q"  # бесплатных гороскопов выдано в день USER_QUOTA_DAY
+USER_BLOCKED_DAY = "x"  # день, когда пользователь заблокировал бота (нет поля - не блокировал)
+USER_FIELDS = (USER_SIGN, USER_BIRTH_DATE, USER_QUOTA_DAY, USER_QUOTA_USED, USER_BLOCKED_DAY)
+
+def user_projection(fields) -> dict:
+    # Пустая проекция в MongoDB означает весь документ, поэтому без полей запрашивается только _id
+    return {field: 1 for field in fields} or {"_id": 1}
+
+
+class UserCache:
+    """
+    LRU-кэш документов пользователей с ограничением времени жизни записи.
+
+    Документ может быть прочитан с проекцией, поэтому рядом хранится множество полей, значения которых
+    известны (отсутствие такого поля в документе означает значение по умолчанию). Запрос полей,
+    которых в записи нет, - промах: get_user_data дочитает их из базы и добавит в запись.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()  # user_id -> (expires_at, document, известные поля)
+
+    def _entry(self, user_id: int):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[user_id]
+            return None
+        self.entries.move_to_end(user_id)
+        return entry
+
+    def get(self, user_id: int, fields: tuple = USER_FIELDS):
+        entry = self._entry(user_id)
+        if entry is None or not entry[2].issuperset(fields):
+            return None
+        return entry[1]
+
+    def put(self, user_id: int, document: dict, fields: tuple = USER_FIELDS):
+        entry = self._entry(user_id)
+        if entry is not None:
+            # Дочитанные поля дополняют запись, срок жизни остается прежним
+            for field in fields:
+                entry[1].pop(field, None)
+            entry[1].update(document)
+            self.entries[user_id] = (entry[0], entry[1], entry[2] | frozenset(fields))
+            return
+        self.entries[user_id] = (time.monotonic() + self.ttl, document, frozenset(fields))
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def apply(self, user_id: int, set_fields: dict = None, inc_fields: dict = None, unset_fields: tuple = ()):
+        # Write-through: меняем закэшированный документ так же, как его изменит MongoDB
+        entry = self._entry(user_id)
+        if entry is None:
+            return
+        document = entry[1]
+        document.update(set_fields or {})
+        for field, value in (inc_fields or {}).items():
+            document[field] = document.get(field, 0) + value
+        for field in unset_fields:
+            document.pop(field, None)
+
+
+class UserWriteBuffer(PeriodicFlusher):
+    """
+    Буфер изменений пользователей.
+
+    Изменения одного пользователя склеиваются в одну операцию ($set и $unset перезаписывают, $inc суммируется)
+    и отправляются в MongoDB одним bulk_write раз в flush_interval секунд
+    или сразу, как только накопилось flush_threshold пользователей.
+    """
+
+    def __init__(self, flush_interval: float, flush_threshold: int):
+        super().__init__(flush_interval)
+        self.flush_threshold = flush_threshold
+        self.pending = {}  # user_id -> {"$set": {...}, "$inc": {...}, "$setOnInsert": {...}, "$unset": {...}}
+
+    def add(self, user_id: int, set_fields: dict = None, inc_fields: dict = None, set_on_insert: dict = None,
+            unset_fields: tuple = ()):
+        self._merge(user_id, set_fields, inc_fields, set_on_insert, unset_fields)
+        if len(self.pending) >= self.flush_threshold:
+            self.flush_soon()
+
+    def _merge(self, user_id: int, set_fields: dict = None, inc_fields: dict = None, set_on_insert: dict = None,
+               unset_fields=()):
+        ops = self.pending.setdefault(user_id, {"$set": {}, "$inc": {}, "$setOnInsert": {}, "$unset": {}})
+        for field in unset_fields:
+            ops["$set"].pop(field, None)
+            ops["$inc"].pop(field, None)
+            ops["$setOnInsert"].pop(field, None)
+            ops["$unset"][field] = ""
+        for field, value in (set_fields or {}).items():
+            ops["$inc"].pop(field, None)
+            ops["$setOnInsert"].pop(field, None)
+            ops["$unset"].pop(field, None)
+            ops["$set"][field] = value
+        for field, value in (inc_fields or {}).items():
+            if field in ops["$set"]:
+                ops["$set"][field] += value
+            elif field in ops["$unset"]:
+                # Поле удалено - $inc начнет с нуля
+                del ops["$unset"][field]
+                ops["$set"][field] = value
+            else:
+                ops["$setOnInsert"].pop(field, None)
+                ops["$inc"][field] = ops["$inc"].get(field, 0) + value
+        for field, value in (set_on_insert or {}).items():
+            if field not in ops["$set"] and field not in ops["$inc"] and field not in ops["$unset"]:
+                ops["$setOnInsert"][field] = value
+
+    async def flush(self, user_ids=None):
+        if user_ids is None:
+            batch, self.pending = self.pending, {}
+        else:
+            batch = {user_id: self.pending.pop(user_id) for user_id in user_ids if user_id in self.pending}
+        if not batch:
+            return
+
+        requests = [
+            UpdateOne({"_id": user_id}, {op: fields for op, fields in ops.items() if fields}, upsert=True)
+            for user_id, ops in batch.items()
+        ]
+        try:
+            result = await timed_db("user_writes_flush", users_collection.bulk_write(requests, ordered=False))
+        except Exception as e:
+            logger.error(f"Ошибка при записи {len(requests)} изменений пользователей в MongoDB: {e}", exc_info=True)
+            # Возвращаем изменения в буфер, поверх них применяем то, что пришло во время записи
+            newer, self.pending = self.pending, {}
+            for pending in (batch, newer):
+                for user_id, ops in pending.items():
+                    self._merge(user_id, ops["$set"], ops["$inc"], ops["$setOnInsert"], ops["$unset"])
+            return
+        if result.upserted_count:
+            logger.info(f"Новых пользователей добавлено в БД: {result.upserted_count}")
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+user_writes = UserWriteBuffer(USER_WRITE_FLUSH_INTERVAL, USER_WRITE_FLUSH_THRESHOLD)
+metrics.gauge("astro_user_cache_size", lambda: len(user_cache.entries))
+metrics.gauge("astro_user_writes_pending", lambda: len(user_writes.pending))
+
+async def get_user_data(user_id: int, fields: tuple = USER_FIELDS):
+    """
+    Документ пользователя с полями fields (проекция: по сети идут только они).
+    Прочитанные поля попадают в кэш, повторный запрос тех же полей обходится без MongoDB.
+    None - пользователя нет в базе.
+    """
+    user_data = user_cache.get(user_id, fields)
+    if user_data is not None:
+        return user_data
+    if user_id in user_writes.pending:
+        # Иначе из базы придет документ без еще не записанных изменений
+        await user_writes.flush([user_id])
+    user_data = await timed_db("get_user_data", users_collection.find_one({"_id": user_id}, projection=user_projection(fields)))
+    if user_data is not None:
+        user_cache.put(user_id, user_data, fields)
+    return user_data
 
 async def update_user_data(user_id: int, data: dict):
-    await users_collection.update_one({"user_id": user_id}, {"$set": data}, upsert=True)
+    # Пользователь пишет боту - значит, снова его не блокирует: рассылка и maintain_users должны это видеть
+    user_cache.apply(user_id, set_fields=data, unset_fields=(USER_BLOCKED_DAY,))
+    user_writes.add(user_id, set_fields=data, unset_fields=(USER_BLOCKED_DAY,))
+
+async def register_user(user_id: int):
+    """
+    Создает пользователя, если его еще нет, и снимает отметку о блокировке бота, если она есть.
+    Проверка - чтение одного поля (или попадание в кэш), поэтому повторные /start ничего не пишут в базу.
+    """
+    user_data = await get_user_data(user_id, (USER_BLOCKED_DAY,))
+    if user_data is not None:
+        if USER_BLOCKED_DAY in user_data:
+            # Вернулся после блокировки бота
+            user_cache.apply(user_id, unset_fields=(USER_BLOCKED_DAY,))
+            user_writes.add(user_id, unset_fields=(USER_BLOCKED_DAY,))
+        return
+    user_writes.add(user_id, set_on_insert={USER_QUOTA_USED: 0})
+    # Документ нового пользователя известен целиком: все поля схемы по умолчанию
+    user_cache.put(user_id, {"_id": user_id, USER_QUOTA_USED: 0})
+
+async def consume_free_horoscope(user_id: int) -> bool:
+    """
+    Атомарно списывает один бесплатный гороскоп.
+
+    Сброс счетчика при смене дня и проверка лимита выполняются одним find_one_and_update,
+    поэтому параллельные запросы одного пользователя не могут превысить лимит.
+    Возвращает False, если бесплатные гороскопы на сегодня закончились.
+    """
+    today = day_number(today_key())
+    if user_id in user_writes.pending:
+        # Например, сброс счетчика после оплаты должен попасть в базу до проверки лимита
+        await user_writes.flush([user_id])
+
+    for attempt in range(2):
+        quota = await timed_db("consume_free_horoscope", users_collection.find_one_and_update(
+            {
+                "_id": user_id,
+                "$or": [
+                    {USER_QUOTA_DAY: {"$ne": today}},
+                    {USER_QUOTA_USED: {"$lt": DAILY_FREE_HOROSCOPES}}
+                ]
+            },
+            [{"$set": {
+                USER_QUOTA_USED: {"$cond": [
+                    {"$eq": [f"${USER_QUOTA_DAY}", today]},
+                    {"$add": [{"$ifNull": [f"${USER_QUOTA_USED}", 0]}, 1]},
+                    1
+                ]},
+                USER_QUOTA_DAY: today
+            }}],
+            # Для проверки лимита нужен только счетчик: остальной документ не передается
+            projection=user_projection((USER_QUOTA_DAY, USER_QUOTA_USED)),
+            return_document=ReturnDocument.AFTER
+        ))
+        if quota is not None:
+            user_cache.put(user_id, quota, (USER_QUOTA_DAY, USER_QUOTA_USED))
+            return True
+        if attempt:
+            break
+
+        # Документ не найден: либо лимит исчерпан, либо пользователя еще нет в базе
+        result = await timed_db("consume_free_horoscope_insert", users_collection.update_one(
+            {"_id": user_id},
+            {"$setOnInsert": {USER_QUOTA_USED: 1, USER_QUOTA_DAY: today}},
+            upsert=True
+        ))
+        if result.upserted_id is not None:
+            return True
+        # Документ уже есть: его мог вставить параллельный запрос этого же нового пользователя,
+        # поэтому списание повторяется по нему, а не считается исчерпанным лимитом
+    return False
+
+# --- Аналитика ---
+# События (просмотры гороскопов, показы рекламы, оплаты, переходы FSM) копятся в кольцевом буфере
+# в памяти и пишутся в MongoDB пачками из фоновой задачи, хендлер только добавляет элемент в deque.
+# Если база недоступна дольше, чем помещается в буфер, теряются самые старые события.
+
+class EventBuffer(PeriodicFlusher):
+    """
+    Кольцевой буфер событий аналитики.
+
+    record не ждет базу: событие добавляется в deque(maxlen=capacity), а insert_many
+    выполняется раз в flush_interval секунд или сразу, как только накопилось flush_threshold событий.
+    """
+
+    def __init__(self, capacity: int, flush_interval: float, flush_threshold: int):
+        super().__init__(flush_interval)
+        self.flush_threshold = flush_threshold
+        self.events = deque(maxlen=capacity)
+
+    def record(self, event: str, user_id: int = None, **fields):
+        if len(self.events) == self.events.maxlen:
+            metrics.inc("astro_events_dropped_total")
+        # meta - поле метаданных time-series коллекции: по нему MongoDB группирует события в бакеты
+        self.events.append({"ts": datetime.now(timezone.utc), "meta": {"event": event, **fields}, "user_id": user_id})
+        if len(self.events) >= self.flush_threshold:
+            self.flush_soon()
+
+    async def flush(self):
+        if not self.events or db is None:
+            return
+        batch = list(self.events)
+        self.events.clear()
+        try:
+            await timed_db("events_flush", db[MONGO_EVENTS_COLLECTION_NAME].insert_many(batch, ordered=False))
+        except Exception as e:
+            logger.error(f"Ошибка при записи {len(batch)} событий аналитики в MongoDB: {e}", exc_info=True)
+            # Возвращаем пачку в начало буфера, при переполнении вытесняются самые старые события
+            newer = list(self.events)
+            self.events.clear()
+            self.events.extend(batch)
+            self.events.extend(newer)
+
+
+analytics = EventBuffer(EVENTS_BUFFER_SIZE, EVENTS_FLUSH_INTERVAL, EVENTS_FLUSH_THRESHOLD)
+metrics.gauge("astro_events_pending", lambda: len(analytics.events))
+
+
+class TrackedFSMContext(FSMContext):
+    """FSMContext, который запоминает последнее установленное через него состояние (clear - тоже set_state)."""
+
+    def __init__(self, storage, key):
+        super().__init__(storage, key)
+        self.changed = False
+        self.new_state = None
+
+    async def set_state(self, state=None) -> None:
+        await super().set_state(state)
+        self.changed = True
+        self.new_state = state.state if isinstance(state, State) else state
+
+
+class FSMTransitionMiddleware(BaseMiddleware):
+    """
+    Inner-middleware: записывает событие fsm_transition, если хендлер сменил состояние FSM.
+    Новое состояние берется из set_state хендлера, старое - raw_state, прочитанный до хендлера,
+    поэтому без кэша FSM (FSM_CACHE_TTL=0) лишнего чтения из хранилища нет.
+    """
+
+    async def __call__(self, handler, event, data: dict):
+        state = data.get("state")
+        if state is None:
+            return await handler(event, data)
+        tracked = data["state"] = TrackedFSMContext(state.storage, state.key)
+        result = await handler(event, data)
+        before = data.get("raw_state")
+        if tracked.changed and tracked.new_state != before:
+            analytics.record("fsm_transition", tracked.key.user_id, handler=data["handler"].callback.__name__,
+                             before=before, after=tracked.new_state)
+        return result
+
+
+async def ensure_events_collection():
+    """
+    Создает time-series коллекцию событий (MongoDB 5.0+) с удалением через EVENTS_RETENTION_DAYS.
+    На старых серверах вместо нее создается capped-коллекция размером EVENTS_CAPPED_BYTES.
+    """
+    if MONGO_EVENTS_COLLECTION_NAME in await db.list_collection_names(filter={"name": MONGO_EVENTS_COLLECTION_NAME}):
+        return
+    try:
+        await db.create_collection(
+            MONGO_EVENTS_COLLECTION_NAME,
+            timeseries={"timeField": "ts", "metaField": "meta", "granularity": "minutes"},
+            expireAfterSeconds=EVENTS_RETENTION_DAYS * 86400
+        )
+    except CollectionInvalid:
+        return # Коллекцию успел создать другой процесс
+    except OperationFailure as e:
+        logger.warning(f"Time-series коллекции не поддерживаются ({e}), события пишутся в capped-коллекцию.")
+        await db.create_collection(MONGO_EVENTS_COLLECTION_NAME, capped=True, size=EVENTS_CAPPED_BYTES)
+    await db[MONGO_EVENTS_COLLECTION_NAME].create_index([("meta.event", 1), ("ts", 1)])
+
+
+def _day_bounds(day: str) -> tuple:
+    start = datetime.combine(date.fromisoformat(day), datetime.min.time(), tzinfo=timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+async def rollup_events(day: str):
+    """
+    Дневные итоги событий в коллекцию events_daily (повторный запуск перезаписывает итоги дня):
+    - {day, event, sign, type}: число событий и разных пользователей (просмотры по знаку и типу и т.д.);
+    - {day, event: "funnel"}: воронка просмотр -> запрос оплаты -> оплата и конверсия в оплату.
+    """
+    start, end = _day_bounds(day)
+    events_collection = db[MONGO_EVENTS_COLLECTION_NAME]
+    match = {"$match": {"ts": {"$gte": start, "$lt": end}}}
+    merge = {"$merge": {"into": MONGO_EVENTS_DAILY_COLLECTION_NAME, "on": "_id", "whenMatched": "replace"}}
+
+    await timed_db("events_rollup", events_collection.aggregate([
+        match,
+        {"$group": {
+            "_id": {"day": day, "event": "$meta.event", "sign": "$meta.sign", "type": "$meta.type"},
+            "count": {"$sum": 1},
+            "users": {"$addToSet": "$user_id"},
+        }},
+        {"$project": {"count": 1, "users": {"$size": "$users"}}},
+        merge,
+    ]).to_list(None))
+
+    await timed_db("events_rollup", events_collection.aggregate([
+        match,
+        {"$match": {"meta.event": {"$in": ["horoscope_view", "payment_request", "payment_confirmed"]}}},
+        {"$group": {
+            "_id": "$user_id",
+            "viewed": {"$max": {"$cond": [{"$eq": ["$meta.event", "horoscope_view"]}, 1, 0]}},
+            "requested": {"$max": {"$cond": [{"$eq": ["$meta.event", "payment_request"]}, 1, 0]}},
+            "paid": {"$max": {"$cond": [{"$eq": ["$meta.event", "payment_confirmed"]}, 1, 0]}},
+        }},
+        {"$group": {
+            "_id": {"day": day, "event": "funnel"},
+            "viewers": {"$sum": "$viewed"},
+            "payment_requests": {"$sum": "$requested"},
+            "payers": {"$sum": "$paid"},
+        }},
+        {"$set": {"conversion": {"$cond": [
+            {"$gt": ["$payment_requests", 0]}, {"$divide": ["$payers", "$payment_requests"]}, 0
+        ]}}},
+        merge,
+    ]).to_list(None))
+    logger.info(f"Итоги событий за {day} сохранены в {MONGO_EVENTS_DAILY_COLLECTION_NAME}.")
+
+
+async def rollup_previous_day():
+    """Считает итоги вчерашнего дня один раз за день."""
+    yesterday = (date.fromisoformat(today_key()) - timedelta(days=1)).isoformat()
+    if await claim_daily_run("events_rollup", yesterday):
+        await rollup_events(yesterday)
+
+
+async def rollup_recent_events():
+    """Служебная команда: пересчитывает итоги вчерашнего и (частично) сегодняшнего дня."""
+    today = date.fromisoformat(today_key())
+    for day in (today - timedelta(days=1), today):
+        await rollup_events(day.isoformat())
 
 # --- Клавиатуры ---
-def get_main_keyboard():
+# Статические клавиатуры строятся один раз и отправляются готовым JSON (runtime.keyboards).
+
+keyboards = KeyboardRegistry()
+
+def _build_main_keyboard():
+    from aiogram.utils.keyboard import ReplyKeyboardBuilder
     builder = ReplyKeyboardBuilder()
     builder.button(text="♈ Овен")
     builder.button(text="♉ Телец")
@@ -120,14 +914,16 @@ def get_main_keyboard():
     builder.adjust(3)
     return builder.as_markup(resize_keyboard=True)
 
-def get_date_keyboard():
+def _build_date_keyboard():
+    from aiogram.utils.keyboard import InlineKeyboardBuilder
     builder = InlineKeyboardBuilder()
     builder.button(text="Сегодня", callback_data="date_today")
     builder.button(text="Завтра", callback_data="date_tomorrow")
     builder.button(text="Неделя", callback_data="date_week")
     return builder.as_markup()
 
-def get_horoscope_type_keyboard():
+def _build_horoscope_type_keyboard():
+    from aiogram.utils.keyboard import InlineKeyboardBuilder
     builder = InlineKeyboardBuilder()
     builder.button(text="Общий", callback_data="type_general")
     builder.button(text="Любовный", callback_data="type_love")
@@ -135,64 +931,535 @@ def get_horoscope_type_keyboard():
     builder.button(text="Здоровье", callback_data="type_health")
     return builder.as_markup()
 
-def get_payment_keyboard(user_id: int):
+def _build_main_menu_keyboard():
+    from aiogram.utils.keyboard import InlineKeyboardBuilder
     builder = InlineKeyboardBuilder()
-    # Кнопка оплаты AdsGram
-    # Параметры: amount, currency, order_id, description, redirect_url (опционально)
-    # Используйте уникальный order_id для каждой транзакции
-    order_id_adsgram = f"adsgram_{user_id}_{int(datetime.now().timestamp())}"
-    builder.button(text="Через AdsGram (1 просмотр)", url=f"https://adsgram.ai/pay?api_key={ADSGRAM_API_KEY}&amount=1&order_id={order_id_adsgram}")
-    
-    # Кнопка оплаты TON (примерная логика, требует реальной интеграции)
-    amount_ton = 0.05 # Примерная сумма в TON
-    ton_invoice_url = f"https://ton.org/invoice/{TON_WALLET}?amount={int(amount_ton * 1e9)}" # Конвертация в нано-TON
-    builder.button(text=f"Через TON ({amount_ton} TON)", url=ton_invoice_url)
-
-    builder.button(text="Проверить оплату", callback_data="check_payment")
+    builder.button(text="Главное меню", callback_data="start_over")
     return builder.as_markup()
 
+def get_main_keyboard():
+    return keyboards.get("main", _build_main_keyboard)
+
+def get_date_keyboard():
+    return keyboards.get("date", _build_date_keyboard)
+
+def get_horoscope_type_keyboard():
+    return keyboards.get("horoscope_type", _build_horoscope_type_keyboard)
+
 def get_main_menu_keyboard():
-    builder = InlineKeyboardBuilder()
-    builder.button(text="Главное меню", callback_data="start_over")
-    return builder.as_markup()
+    return keyboards.get("main_menu", _build_main_menu_keyboard)
+
+# Шаблон клавиатуры оплаты: тексты и адреса известны заранее, подставляется только группа заказов.
+# Кнопка оплаты AdsGram
+# Параметры: amount, currency, order_id, description, redirect_url (опционально)
+# Кнопка оплаты TON (примерная логика, требует реальной интеграции):
+# order_id передается комментарием к переводу, по нему платеж находится в блокчейне
+AMOUNT_TON = 0.05 # Примерная сумма в TON
+PAYMENT_KEYBOARD_TEMPLATE = [
+    ("Через AdsGram (1 просмотр)", "url", f"https://adsgram.ai/pay?api_key={ADSGRAM_API_KEY}&amount=1&order_id=adsgram_{{order_group}}"),
+    (f"Через TON ({AMOUNT_TON} TON)", "url", f"https://ton.org/invoice/{TON_WALLET}?amount={int(AMOUNT_TON * 1e9)}&text=ton_{{order_group}}"), # Конвертация в нано-TON
+    ("Проверить оплату", "callback_data", "check_payment:{order_group}"),
+]
+
+def get_payment_keyboard(order_group: str):
+    # Кнопки собираются без валидации pydantic: все значения берутся из шаблона выше
+    return InlineKeyboardMarkup.model_construct(inline_keyboard=[[
+        InlineKeyboardButton.model_construct(text=text, **{field: value.format(order_group=order_group)})
+        for text, field, value in PAYMENT_KEYBOARD_TEMPLATE
+    ]])
+
+# --- Генерация гороскопа ---
+DATE_TYPES = ["today", "tomorrow", "week"]
+HOROSCOPE_TYPES = ["general", "love", "business", "health"]
+
+HOROSCOPE_TYPE_LABELS = {"general": "общий", "love": "любовь", "business": "бизнес", "health": "здоровье"}
+MONTHS_GENITIVE = [
+    "января", "февраля", "марта", "апреля", "мая", "июня",
+    "июля", "августа", "сентября", "октября", "ноября", "декабря"
+]
+
+# Обращение к знаку (дательный падеж) и его сильная черта, в порядке ZODIAC_SIGNS
+SIGN_TRAITS = [
+    ("Овнам", "решительность"), ("Тельцам", "упорство"), ("Близнецам", "любознательность"),
+    ("Ракам", "чуткость"), ("Львам", "щедрость"), ("Девам", "внимательность"),
+    ("Весам", "чувство меры"), ("Скорпионам", "проницательность"), ("Стрельцам", "оптимизм"),
+    ("Козерогам", "выдержка"), ("Водолеям", "изобретательность"), ("Рыбам", "интуиция"),
+]
+
+# Шаблоны текста: {who} - обращение к знаку, {trait} - его сильная черта.
+# Текст собирается из вступления, (для недели) прогноза на вторую половину, детали, совета
+# и счастливых числа и цвета; каждую часть выбирает свой байт хеша.
+HOROSCOPE_OPENINGS = {
+    "general": [
+        "{who} звезды обещают день, полный неожиданных открытий и приятных встреч.",
+        "{who} выпадает спокойное время, чтобы завершить начатые дела.",
+        "{who} стоит довериться своей сильной стороне: {trait} - ваш главный козырь.",
+        "Расположение планет благоволит {who}: многое получится с первой попытки.",
+        "{who} предстоит сделать выбор, и {trait} подскажет верное направление.",
+        "{who} не стоит торопить события: все сложится в свое время.",
+    ],
+    "love": [
+        "{who} в личных отношениях стоит ждать новых романтических переживаний.",
+        "{who} звезды советуют укреплять связи и искать взаимопонимание.",
+        "{trait} поможет {who} найти общий язык с любимым человеком.",
+        "{who}, у которых нет пары, звезды сулят интересное знакомство.",
+        "{who} подходит время откровенных разговоров и примирений.",
+        "{who} важно услышать близкого человека, а не только быть услышанными.",
+    ],
+    "business": [
+        "{who} на работе стоит быть внимательными к деталям, чтобы избежать недоразумений.",
+        "{who} поступят новые предложения, которые могут оказаться очень выгодными.",
+        "{trait} поможет {who} договориться там, где другие отступят.",
+        "{who} удастся сдвинуть с места проект, который давно стоял.",
+        "{who} звезды советуют планировать, а не совершать крупные траты.",
+        "{who} стоит открыться сотрудничеству: новые партнерства принесут успех.",
+    ],
+    "health": [
+        "{who} стоит уделить внимание самочувствию, возможно, потребуется отдых.",
+        "{who} хватит энергии на все планы.",
+        "{who} пойдут на пользу прогулка на свежем воздухе и ранний отход ко сну.",
+        "{who} важен баланс: не берите на себя больше, чем готовы унести.",
+        "{trait} поможет {who} вовремя прислушаться к сигналам организма.",
+        "{who} хватает выносливости, но не забывайте о сбалансированном питании.",
+    ],
+}
+HOROSCOPE_WEEK_TURNS = [
+    "Ко второй половине недели станет больше свободного времени.",
+    "Ближе к выходным ждите хороших новостей.",
+    "Середина недели потребует собранности, зато выходные пройдут легко.",
+    "К концу недели прояснится то, что сейчас кажется запутанным.",
+    "Начало недели лучше посвятить планам, а конец - их исполнению.",
+]
+HOROSCOPE_DETAILS = [
+    "Первая половина дня удачнее для активных действий, вторая - для размышлений.",
+    "Обратите внимание на мелочи: в них скрывается подсказка.",
+    "Возможны перемены в планах, но они окажутся к лучшему.",
+    "Старый знакомый может напомнить о себе с хорошими новостями.",
+    "Не спешите с выводами - ситуация прояснится сама.",
+    "Удачным окажется все, что связано с обучением и новыми навыками.",
+    "Легко дадутся разговоры, которые вы давно откладывали.",
+    "Избегайте споров из-за пустяков: они отнимут больше сил, чем кажется.",
+]
+HOROSCOPE_ADVICE = [
+    "доверяйте интуиции.",
+    "доведите до конца одно дело, прежде чем браться за новое.",
+    "улыбка откроет больше дверей, чем настойчивость.",
+    "найдите время для себя.",
+    "скажите спасибо тем, кто рядом.",
+    "не бойтесь просить о помощи.",
+]
+HOROSCOPE_COLORS = ["синий", "зеленый", "золотой", "белый", "красный", "фиолетовый", "оранжевый", "бирюзовый"]
+
+
+def horoscope_seed(sign: str, target: str, horoscope_type: str) -> bytes:
+    """
+    Детерминированное зерно текста: хеш знака, даты прогноза и типа.
+    target - дата (YYYY-MM-DD) для дневного прогноза или week:<понедельник> для недельного,
+    поэтому "завтра" сегодня совпадает с "сегодня" завтра, а неделя одинакова все семь дней.
+    """
+    return hashlib.blake2b(f"{sign}|{target}|{horoscope_type}".encode(), digest_size=16).digest()
+
+
+def _pick(options: list, value: int):
+    return options[value % len(options)]
+
+
+def _horoscope_body(sign: str, target: str, horoscope_type: str) -> str:
+    seed = horoscope_seed(sign, target, horoscope_type)
+    who, trait = SIGN_TRAITS[SIGN_INDEX[sign]]
+    opening = _pick(HOROSCOPE_OPENINGS[horoscope_type], seed[0]).format(who=who, trait=trait)
+    parts = [opening[0].upper() + opening[1:]]
+    if target.startswith("week:"):
+        parts.append(_pick(HOROSCOPE_WEEK_TURNS, seed[1]))
+        parts.append(f"Совет недели: {_pick(HOROSCOPE_ADVICE, seed[3])}")
+    else:
+        parts.append(_pick(HOROSCOPE_DETAILS, seed[2]))
+        parts.append(f"Совет дня: {_pick(HOROSCOPE_ADVICE, seed[3])}")
+    parts.append(f"Счастливое число: {seed[4] % 99 + 1}, цвет: {_pick(HOROSCOPE_COLORS, seed[5])}.")
+    return " ".join(parts)
+
+
+def _format_day(day) -> str:
+    return f"{day.day} {MONTHS_GENITIVE[day.month - 1]}"
+
+
+def _horoscope_periods(day: str) -> dict:
+    """{date_type: (target, подпись периода)} для прогнозов, запрошенных в день day."""
+    today = date.fromisoformat(day)
+    tomorrow = today + timedelta(days=1)
+    monday = today - timedelta(days=today.weekday())
+    sunday = monday + timedelta(days=6)
+    if monday.month == sunday.month:
+        week_label = f"неделю {monday.day}-{_format_day(sunday)}"
+    else:
+        week_label = f"неделю {_format_day(monday)} - {_format_day(sunday)}"
+    return {
+        "today": (day, f"сегодня, {_format_day(today)}"),
+        "tomorrow": (tomorrow.isoformat(), f"завтра, {_format_day(tomorrow)}"),
+        "week": (f"week:{monday.isoformat()}", week_label),
+    }
+
+
+def render_horoscopes(start_day: str, days: int = 1) -> dict:
+    """
+    Все тексты (знак × период × тип) на days дней начиная с start_day одним проходом:
+    {день: {(знак, период, тип): текст}}. Тексты с одинаковой датой прогноза
+    (завтрашний и следующий сегодняшний, недельные) генерируются один раз.
+    """
+    start = date.fromisoformat(start_day)
+    bodies = {}
+    rendered = {}
+    for offset in range(days):
+        day = (start + timedelta(days=offset)).isoformat()
+        texts = {}
+        for date_type, (target, period) in _horoscope_periods(day).items():
+            for horoscope_type in HOROSCOPE_TYPES:
+                suffix = f" ({HOROSCOPE_TYPE_LABELS[horoscope_type]}):\n\n"
+                for sign in ZODIAC_SIGNS:
+                    key = (sign, target, horoscope_type)
+                    body = bodies.get(key)
+                    if body is None:
+                        body = bodies[key] = _horoscope_body(sign, target, horoscope_type)
+                    texts[(sign, date_type, horoscope_type)] = f"Ваш гороскоп для знака {sign} на {period}{suffix}{body}"
+        rendered[day] = texts
+    return rendered
+
+
+def render_all_horoscopes(day: str) -> dict:
+    """Все 144 текста (знак × период × тип) на указанный день."""
+    return render_horoscopes(day)[day]
+
+
+def render_horoscope(sign: str, date_type: str, horoscope_type: str, day: str) -> str:
+    target, period = _horoscope_periods(day)[date_type]
+    body = _horoscope_body(sign, target, horoscope_type)
+    return f"Ваш гороскоп для знака {sign} на {period} ({HOROSCOPE_TYPE_LABELS[horoscope_type]}):\n\n{body}"
+
+class HoroscopeStore:
+    """
+    Кэш готовых гороскопов на текущий день.
+
+    Тексты рендерятся один раз в день и сохраняются одним документом в коллекцию horoscopes,
+    чтобы холодный инстанс загрузил весь день одним запросом и все инстансы отдавали одинаковые тексты.
+    """
+
+    def __init__(self):
+        self.day = None
+        self.texts = {}
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _items(texts: dict) -> list:
+        return [
+            {"sign": sign, "date": date_type, "type": horoscope_type, "text": text}
+            for (sign, date_type, horoscope_type), text in texts.items()
+        ]
+
+    async def _load_day(self, day: str) -> dict:
+        if horoscopes_collection is None:
+            return render_all_horoscopes(day)
+
+        doc = await timed_db("load_horoscopes", horoscopes_collection.find_one({"_id": day}))
+        if doc is None:
+            texts = render_all_horoscopes(day)
+            # $setOnInsert: если другой инстанс успел сохранить день раньше, его версия остается
+            result = await horoscopes_collection.update_one(
+                {"_id": day},
+                {"$setOnInsert": {"items": self._items(texts), "created_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+            if result.upserted_id is not None:
+                logger.info(f"Гороскопы на {day} сгенерированы и сохранены в MongoDB.")
+                return texts
+            doc = await horoscopes_collection.find_one({"_id": day})
+
+        return {(item["sign"], item["date"], item["type"]): item["text"] for item in doc["items"]}
+
+    async def prewarm(self, start_day: str, days: int) -> int:
+        """
+        Заранее сохраняет тексты на days дней начиная с start_day, чтобы первый запрос
+        (или рассылка) нового дня не генерировал их. Возвращает число добавленных дней.
+        """
+        if horoscopes_collection is None:
+            return 0
+        day_keys = [(date.fromisoformat(start_day) + timedelta(days=offset)).isoformat() for offset in range(days)]
+        existing = {
+            doc["_id"] async for doc in horoscopes_collection.find({"_id": {"$in": day_keys}}, projection={"_id": 1})
+        }
+        missing = [day for day in day_keys if day not in existing]
+        if not missing:
+            return 0
+        rendered = render_horoscopes(missing[0], (date.fromisoformat(missing[-1]) - date.fromisoformat(missing[0])).days + 1)
+        now = datetime.now(timezone.utc)
+        try:
+            result = await horoscopes_collection.bulk_write([
+                UpdateOne(
+                    {"_id": day},
+                    {"$setOnInsert": {"items": self._items(rendered[day]), "created_at": now}},
+                    upsert=True
+                )
+                for day in missing
+            ], ordered=False)
+        except BulkWriteError as e:
+            # Гонка с другим инстансом: его версия дня уже сохранена
+            logger.debug(f"Прогрев гороскопов: часть дней уже сохранена другим инстансом: {e.details.get('writeErrors')}")
+            return e.details.get("nUpserted", 0)
+        logger.info(f"Гороскопы прогреты на {result.upserted_count} дн. начиная с {missing[0]}.")
+        return result.upserted_count
+
+    async def get(self, sign: str, date_type: str, horoscope_type: str):
+        today = today_key()
+        if self.day != today:
+            async with self._lock:
+                if self.day != today:
+                    self.texts = await self._load_day(today)
+                    self.day = today
+        return self.texts.get((sign, date_type, horoscope_type))
+
+
+horoscope_store = HoroscopeStore()
 
-# --- Генерация гороскопа (заглушка) ---
 async def generate_horoscope(sign: str, date_type: str, horoscope_type: str):
-    # Здесь может быть логика обращения к API или генерации гороскопа
-    # Для примера:
-    base_horoscope = f"Ваш гороскоп для знака {sign} на {date_type} ({horoscope_type} аспект):\n\n"
-    horoscopes = {
-        "today": {
-            "general": "Сегодня вас ждет день, полный неожиданных открытий и приятных встреч.",
-            "love": "В личных отношениях возможны новые романтические переживания.",
-            "business": "На работе будьте внимательны к деталям, чтобы избежать недоразумений.",
-            "health": "Уделите внимание своему самочувствию, возможно, потребуется отдых."
-        },
-        "tomorrow": {
-            "general": "Завтрашний день принесет спокойствие и возможность завершить начатые дела.",
-            "love": "День благоприятен для укрепления связей и взаимопонимания.",
-            "business": "Ожидайте новых предложений, которые могут быть очень выгодными.",
-            "health": "Энергии будет достаточно для всех ваших планов."
-        },
-        "week": {
-            "general": "На этой неделе сосредоточьтесь на своих долгосрочных целях. Возможно, придется потрудиться больше обычного, но результат того стоит.",
-            "love": "Ваши отношения укрепятся, если вы проявите больше внимания и заботы к близким.",
-            "business": "Будьте открыты к сотрудничеству, новые партнерства принесут успех.",
-            "health": "Ваша выносливость на высоте, но не забывайте о сбалансированном питании."
+    horoscope = await horoscope_store.get(sign, date_type, horoscope_type)
+    return horoscope or "Гороскоп пока недоступен."
+
+# --- Проверка оплаты ---
+
+class PaymentProvider(ABC):
+    """Провайдер оплаты: проверяет пачку заказов одним запросом."""
+
+    @abstractmethod
+    async def check(self, order_ids: list) -> dict:
+        """Возвращает {order_id: True}, если оплата заказа подтверждена."""
+
+
+class MockPaymentProvider(PaymentProvider):
+    """
+    Локальная заглушка AdsGram/TON для разработки и тестов:
+    подтверждает заказ через confirm_after секунд после первой проверки.
+    """
+
+    def __init__(self, confirm_after: float):
+        self.confirm_after = confirm_after
+        self.first_seen = {}
+
+    async def check(self, order_ids: list) -> dict:
+        now = time.monotonic()
+        result = {}
+        for order_id in order_ids:
+            first_seen = self.first_seen.setdefault(order_id, now)
+            if now - first_seen >= self.confirm_after:
+                result[order_id] = True
+                del self.first_seen[order_id]
+        return result
+
+
+# Здесь должна быть реальная логика проверки оплаты:
+# - Для AdsGram: обращение к API AdsGram с order_id
+# - Для TON: проверка транзакций на блокчейне TON по комментарию с order_id
+# Пока оба способа обслуживает заглушка, которая подтверждает любую оплату.
+payment_providers = {
+    "adsgram": MockPaymentProvider(PAYMENT_MOCK_CONFIRM_AFTER),
+    "ton": MockPaymentProvider(PAYMENT_MOCK_CONFIRM_AFTER),
+}
+
+async def create_payment_orders(user_id: int) -> str:
+    """Создает по заказу на каждый способ оплаты. Возвращает идентификатор группы заказов."""
+    order_group = f"{user_id}_{int(datetime.now().timestamp() * 1000)}"
+    now = datetime.now(timezone.utc)
+    await timed_db("create_payment_orders", payments_collection.insert_many([
+        {
+            "order_id": f"{provider}_{order_group}", "group": order_group, "user_id": user_id,
+            "provider": provider, "status": "pending", "created_at": now
         }
+        for provider in payment_providers
+    ]))
+    return order_group
+
+async def find_pending_payment_group(user_id: int):
+    order = await timed_db("find_pending_payment_group", payments_collection.find_one(
+        {"user_id": user_id, "status": "pending"},
+        projection={"group": 1},
+        sort=[("created_at", -1)]
+    ))
+    return order["group"] if order else None
+
+
+class PaymentVerifier(PeriodicFlusher):
+    """
+    Проверка оплат.
+
+    Группы заказов на проверке лежат в коллекции payment_checks (_id - группа), а не в памяти процесса:
+    их видят все инстансы и воркеры, и они переживают перезапуск. На долгоживущих процессах их раз
+    в poll_interval секунд проверяет у провайдеров пачками один процесс - держатель аренды
+    leader:payments (run под LeaderLease), результат приходит пользователю отдельным сообщением.
+    На serverless функцию замораживают сразу после ответа, поэтому там (inline) группа проверяется
+    один раз прямо в хендлере. Исход проверки достается тому, кто удалил ее документ,
+    поэтому пользователь получает одно сообщение, даже если группу проверили два процесса.
+
+    Лидер пишет в MongoDB только оплату и сброс счетчика, а состояние FSM и сообщение - дело процесса,
+    которому принадлежит чат (у него свои кэши FSM и пользователей). Туда уходит служебное обновление
+    payment_confirmed_update через deliver: точка входа подставляет путь обновлений Telegram
+    (реплика -> воркер -> полоса), по умолчанию обновление обрабатывает этот же процесс.
+    """
+
+    def __init__(self, poll_interval: float, timeout: float, inline: bool, batch_size: int = 500):
+        super().__init__(poll_interval)
+        self.timeout = timeout
+        self.inline = inline
+        self.batch_size = batch_size
+        self.pending = 0  # групп на проверке при последнем опросе
+        self.deliver = self.deliver_here
+
+    async def deliver_here(self, update: dict) -> bool:
+        # Все чаты обрабатывает этот процесс (polling без воркеров, одна реплика без воркеров)
+        await get_dispatcher().feed_raw_update(bot=get_bot(), update=update)
+        return True
+
+    @property
+    def checks(self):
+        return db[MONGO_PAYMENT_CHECKS_COLLECTION_NAME]
+
+    async def submit(self, order_group: str, user_id: int, chat_id: int) -> bool:
+        """Ставит группу заказов на проверку. False, если она уже проверяется."""
+        deadline = datetime.now(timezone.utc) + timedelta(seconds=self.timeout)
+        try:
+            await timed_db("payment_submit", self.checks.insert_one(
+                {"_id": order_group, "user_id": user_id, "chat_id": chat_id, "deadline": deadline}
+            ))
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def _paid_orders(self, groups: list) -> dict:
+        """Оплаченные заказы групп: {группа: order_id}. Каждый провайдер проверяет все группы одним запросом."""
+        confirmed = set()
+        for provider, payment_provider in payment_providers.items():
+            try:
+                results = await payment_provider.check([f"{provider}_{order_group}" for order_group in groups])
+            except Exception as e:
+                logger.error(f"Ошибка проверки оплаты у провайдера {provider}: {e}", exc_info=True)
+                continue
+            confirmed.update(order_id for order_id, paid in results.items() if paid)
+        paid = {}
+        for order_group in groups:
+            for provider in payment_providers:
+                if f"{provider}_{order_group}" in confirmed:
+                    paid[order_group] = f"{provider}_{order_group}"
+                    break
+        return paid
+
+    async def _claim(self, order_group: str) -> bool:
+        result = await timed_db("payment_claim", self.checks.delete_one({"_id": order_group}))
+        return bool(result.deleted_count)
+
+    async def poll(self) -> int:
+        """Проверяет все группы на проверке (до batch_size). Возвращает их число."""
+        checks = await timed_db("payment_poll", self.checks.find().limit(self.batch_size).to_list(self.batch_size))
+        self.pending = len(checks)
+        if not checks:
+            return 0
+        paid = await self._paid_orders([check["_id"] for check in checks])
+
+        now = datetime.now(timezone.utc)
+        for check in checks:
+            order_group = check["_id"]
+            # motor отдает даты без часового пояса, в базе они в UTC
+            expired = check["deadline"].replace(tzinfo=timezone.utc) <= now
+            try:
+                if order_group in paid:
+                    order_id = paid[order_group]
+                    if await self._claim(order_group) and await self._confirm(order_group, order_id, check["user_id"]):
+                        update = payment_confirmed_update(order_id, check["user_id"], check["chat_id"])
+                        if not await self.deliver(update):
+                            logger.warning(f"Подтверждение оплаты {order_group} не передано процессу чата.")
+                elif expired and await self._claim(order_group):
+                    await get_bot().send_message(
+                        check["chat_id"],
+                        "Оплата не найдена. Попробуйте еще раз или выберите другой способ оплаты.",
+                        reply_markup=get_payment_keyboard(order_group)
+                    )
+            except Exception as e:
+                logger.error(f"Ошибка при обработке оплаты {order_group}: {e}", exc_info=True)
+        return len(checks)
+
+    async def check_now(self, order_group: str, user_id: int, chat_id: int) -> bool:
+        """Одна проверка группы, поставленной submit, прямо в хендлере. True - оплата подтверждена."""
+        paid = await self._paid_orders([order_group])
+        if not await self._claim(order_group):
+            return False # Проверку уже завершил другой вызов
+        if order_group in paid:
+            if await self._confirm(order_group, paid[order_group], user_id):
+                # Хендлер и так выполняется в процессе чата
+                await finish_payment(get_bot(), paid[order_group], user_id, chat_id)
+            return True
+        return False
+
+    async def _confirm(self, order_group: str, order_id: str, user_id: int) -> bool:
+        """Отмечает оплату в MongoDB и сбрасывает счетчик. False, если ее уже засчитал другой вызов."""
+        # Условие на status не даст засчитать одну оплату дважды (например, на двух инстансах)
+        result = await payments_collection.update_one(
+            {"order_id": order_id, "status": "pending"},
+            {"$set": {"status": "paid", "paid_at": datetime.now(timezone.utc)}}
+        )
+        if not result.modified_count:
+            return False
+        await payments_collection.update_many(
+            {"group": order_group, "status": "pending"}, {"$set": {"status": "cancelled"}}
+        )
+        logger.info(f"Оплата {order_id} пользователя {user_id} подтверждена.")
+        analytics.record("payment_confirmed", user_id, provider=order_id.partition("_")[0])
+
+        # Если оплата подтверждена, разрешаем еще один гороскоп. Сразу в базу, а не в буфер user_writes:
+        # буфер - этого процесса, а лимит списывает процесс чата
+        await timed_db("payment_quota_reset", users_collection.update_one(
+            {"_id": user_id}, {"$set": {USER_QUOTA_USED: 0}, "$unset": {USER_BLOCKED_DAY: ""}}
+        ))
+        return True
+
+    async def flush(self):
+        # Для PeriodicFlusher: run - опрос раз в poll_interval, его запускает leader_lease("payments")
+        await self.poll()
+
+
+payment_verifier = PaymentVerifier(PAYMENT_POLL_INTERVAL, PAYMENT_CHECK_TIMEOUT, PAYMENT_CHECK_INLINE)
+metrics.gauge("astro_payments_pending", lambda: payment_verifier.pending)
+
+# Поле служебного обновления: update_chat_id находит в нем chat, поэтому обновление доходит
+# до процесса чата тем же путем, что и обновления Telegram
+PAYMENT_CONFIRMED_UPDATE = "astro_payment_confirmed"
+
+def payment_confirmed_update(order_id: str, user_id: int, chat_id: int) -> dict:
+    return {
+        "update_id": 0,
+        PAYMENT_CONFIRMED_UPDATE: {"order_id": order_id, "chat": {"id": chat_id}, "from": {"id": user_id}}
     }
-    return base_horoscope + horoscopes.get(date_type, {}).get(horoscope_type, "Гороскоп пока недоступен.")
-
-# --- Проверка оплаты (заглушка) ---
-async def check_payment_status(user_id: int):
-    # Здесь должна быть реальная логика проверки оплаты:
-    # - Для AdsGram: обращение к API AdsGram с order_id
-    # - Для TON: проверка транзакций на блокчейне TON (сложнее)
-    # Для примера, всегда возвращаем True для демонстрации
-    logger.info(f"Проверка оплаты для пользователя {user_id}...")
-    # Здесь можно добавить задержку, чтобы имитировать проверку
-    await asyncio.sleep(5)
-    return True # В реальном приложении здесь будет логика проверки
+
+async def finish_payment(bot: Bot, order_id: str, user_id: int, chat_id: int):
+    """Завершение оплаты в процессе чата: кэш пользователя, состояние FSM и сообщение."""
+    # Служебное обновление может прислать любой, кто знает адрес вебхука, поэтому оплата сверяется с базой
+    if not await timed_db("payment_finish", payments_collection.find_one(
+            {"order_id": order_id, "user_id": user_id, "status": "paid"}, projection={"_id": 1})):
+        logger.warning(f"Подтверждение неоплаченного заказа {order_id} пользователя {user_id} отклонено.")
+        return
+    user_cache.apply(user_id, set_fields={USER_QUOTA_USED: 0}, unset_fields=(USER_BLOCKED_DAY,))
+    state = get_dispatcher().fsm.get_context(bot=bot, chat_id=chat_id, user_id=user_id)
+    await state.set_state(UserState.choosing_sign)
+    await bot.send_message(
+        chat_id,
+        "Оплата подтверждена! Теперь вы можете получить еще один гороскоп. Выберите знак зодиака:",
+        reply_markup=get_main_keyboard()
+    )
+
+
+class PaymentConfirmedMiddleware(BaseMiddleware):
+    """Outer-middleware на update: служебное обновление PAYMENT_CONFIRMED_UPDATE вместо хендлеров."""
+
+    async def __call__(self, handler, event: types.Update, data: dict):
+        confirmed = (event.model_extra or {}).get(PAYMENT_CONFIRMED_UPDATE)
+        if confirmed is None:
+            return await handler(event, data)
+        await finish_payment(data["bot"], confirmed["order_id"], confirmed["from"]["id"], confirmed["chat"]["id"])
 
 # --- ADSGRAM Просмотры ---
 async def show_ads(user_id: int):
@@ -206,30 +1473,22 @@ async def show_ads(user_id: int):
     
     # Для примера, просто логируем
     logger.info(f"Реклама показана пользователю {user_id} через AdsGram (API Key: {ADSGRAM_API_KEY[:5]}...)")
+    analytics.record("ad_impression", user_id, network="adsgram")
     # В реальном приложении здесь будет вызов AdsGram API
 
 # --- Обработчики команд и сообщений ---
 
-@dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    user_data = await get_user_data(user_id)
-    if not user_data:
-        await update_user_data(user_id, {"user_id": user_id, "daily_horoscopes_given": 0})
-        logger.info(f"Новый пользователь добавлен в БД: {user_id}")
-    
-    await message.answer(
-        "Привет! Я бот-гороскоп. Выбери свой знак зодиака:",
-        reply_markup=get_main_keyboard()
+    await register_user(user_id)
+
+    # Отправка и запись состояния не зависят друг от друга - выполняем параллельно
+    await gather_awaitables(
+        message.answer("Привет! Я бот-гороскоп. Выбери свой знак зодиака:", reply_markup=get_main_keyboard()),
+        state.set_state(UserState.choosing_sign)
     )
-    await state.set_state(UserState.choosing_sign)
 
-@dp.message(F.text, UserState.choosing_sign)
 async def process_chosen_sign(message: types.Message, state: FSMContext):
-    signs = [
-        "♈ Овен", "♉ Телец", "♊ Близнецы", "♋ Рак", "♌ Лев", "♍ Дева",
-        "♎ Весы", "♏ Скорпион", "♐ Стрелец", "♑ Козерог", "♒ Водолей", "♓ Рыбы"
-    ]
     chosen_sign = message.text
 
     if chosen_sign == "⭐️ Выбрать свой знак":
@@ -238,19 +1497,22 @@ async def process_chosen_sign(message: types.Message, state: FSMContext):
         await state.set_state(UserState.waiting_for_birth_date) # Пример нового состояния
         return
         
-    if chosen_sign not in signs:
+    if chosen_sign not in ZODIAC_SIGNS:
         await message.answer("Пожалуйста, выберите знак из предложенных на клавиатуре.")
         return
 
     await state.update_data(chosen_sign=chosen_sign)
-    await message.answer(
-        f"Отлично! Вы выбрали {chosen_sign}. Теперь выберите, на какой период вам нужен гороскоп:",
-        reply_markup=get_date_keyboard()
+    # Запоминаем знак, чтобы включить пользователя в ежедневную рассылку
+    await update_user_data(message.from_user.id, {USER_SIGN: SIGN_INDEX[chosen_sign]})
+    await gather_awaitables(
+        message.answer(
+            f"Отлично! Вы выбрали {chosen_sign}. Теперь выберите, на какой период вам нужен гороскоп:",
+            reply_markup=get_date_keyboard()
+        ),
+        state.set_state(UserState.choosing_date)
     )
-    await state.set_state(UserState.choosing_date)
 
 # Обработчик для выбора даты рождения
-@dp.message(F.text, UserState.waiting_for_birth_date)
 async def process_birth_date(message: types.Message, state: FSMContext):
     # Очень простая валидация даты рождения (ДД.ММ.ГГГГ)
     date_match = re.match(r"^(\d{1,2})\.(\d{1,2})\.(\d{4})$", message.text)
@@ -267,129 +1529,696 @@ async def process_birth_date(message: types.Message, state: FSMContext):
         return
 
     # Логика определения знака зодиака по дате рождения
-    def get_zodiac_sign(day, month):
-        if (month == 3 and day >= 21) or (month == 4 and day <= 19): return "♈ Овен"
-        if (month == 4 and day >= 20) or (month == 5 and day <= 20): return "♉ Телец"
-        if (month == 5 and day >= 21) or (month == 6 and day <= 20): return "♊ Близнецы"
-        if (month == 6 and day >= 21) or (month == 7 and day <= 22): return "♋ Рак"
-        if (month == 7 and day >= 23) or (month == 8 and day <= 22): return "♌ Лев"
-        if (month == 8 and day >= 23) or (month == 9 and day <= 22): return "♍ Дева"
-        if (month == 9 and day >= 23) or (month == 10 and day <= 22): return "♎ Весы"
-        if (month == 10 and day >= 23) or (month == 11 and day <= 21): return "♏ Скорпион"
-        if (month == 11 and day >= 22) or (month == 12 and day <= 21): return "♐ Стрелец"
-        if (month == 12 and day >= 22) or (month == 1 and day <= 19): return "♑ Козерог"
-        if (month == 1 and day >= 20) or (month == 2 and day <= 18): return "♒ Водолей"
-        if (month == 2 and day >= 19) or (month == 3 and day <= 20): return "♓ Рыбы"
-        return "Неизвестный знак" # Не должен сработать при корректных датах
-
     zodiac_sign = get_zodiac_sign(day, month)
 
     await state.update_data(chosen_sign=zodiac_sign)
+    await update_user_data(message.from_user.id, {USER_SIGN: SIGN_INDEX[zodiac_sign], USER_BIRTH_DATE: year * 10000 + month * 100 + day})
     await message.answer(
         f"Ваш знак зодиака: {zodiac_sign}. Теперь выберите, на какой период вам нужен гороскоп:",
         reply_markup=get_date_keyboard()
     )
     await state.set_state(UserState.choosing_date)
 
-@dp.callback_query(F.data.startswith("date_"), UserState.choosing_date)
 async def process_chosen_date(callback: types.CallbackQuery, state: FSMContext):
     date_type = callback.data.split("_")[1] # 'today', 'tomorrow', 'week'
+    answered = answer_callback_early(callback)
     await state.update_data(chosen_date=date_type)
-    await callback.message.edit_text(
-        f"Вы выбрали гороскоп на {date_type}. Теперь выберите тип гороскопа:",
-        reply_markup=get_horoscope_type_keyboard()
+    await gather_awaitables(
+        callback.message.edit_text(
+            f"Вы выбрали гороскоп на {date_type}. Теперь выберите тип гороскопа:",
+            reply_markup=get_horoscope_type_keyboard()
+        ),
+        state.set_state(UserState.choosing_type),
+        answered
     )
-    await callback.answer()
-    await state.set_state(UserState.choosing_type)
 
-@dp.callback_query(F.data.startswith("type_"), UserState.choosing_type)
 async def process_chosen_type(callback: types.CallbackQuery, state: FSMContext):
     horoscope_type = callback.data.split("_")[1] # 'general', 'love', 'business', 'health'
     data = await state.get_data()
     chosen_sign = data.get("chosen_sign")
     chosen_date = data.get("chosen_date")
     user_id = callback.from_user.id
+    answered = answer_callback_early(callback) # Пока идет проверка лимита в MongoDB
 
-    user_db_data = await get_user_data(user_id)
-    horoscopes_given_today = user_db_data.get("daily_horoscopes_given", 0)
-    last_horoscope_date = user_db_data.get("last_horoscope_date")
-
-    today = datetime.now().date()
-
-    if last_horoscope_date and last_horoscope_date < today:
-        # Сброс счетчика, если день изменился
-        horoscopes_given_today = 0
-        await update_user_data(user_id, {"daily_horoscopes_given": 0, "last_horoscope_date": today})
-        
-    if horoscopes_given_today >= 2: # Ограничение на 2 бесплатных гороскопа в день
-        await callback.message.edit_text(
-            "Вы использовали все бесплатные гороскопы на сегодня. Для получения дополнительного гороскопа, пожалуйста, оплатите.",
-            reply_markup=get_payment_keyboard(user_id)
+    # Проверка лимита, сброс счетчика при смене дня и списание - одна атомарная операция
+    if not await consume_free_horoscope(user_id):
+        analytics.record("payment_request", user_id, sign=chosen_sign, type=horoscope_type)
+        await gather_awaitables(
+            callback.message.edit_text(
+                "Вы использовали все бесплатные гороскопы на сегодня. Для получения дополнительного гороскопа, пожалуйста, оплатите.",
+                reply_markup=get_payment_keyboard(await create_payment_orders(user_id))
+            ),
+            state.set_state(UserState.waiting_for_payment),
+            answered
         )
-        await state.set_state(UserState.waiting_for_payment)
-        await callback.answer()
         return
 
     horoscope_text = await generate_horoscope(chosen_sign, chosen_date, horoscope_type)
-    
-    # Обновляем счетчик бесплатных гороскопов
-    await update_user_data(user_id, {
-        "daily_horoscopes_given": horoscopes_given_today + 1,
-        "last_horoscope_date": today
-    })
-
-    await callback.message.edit_text(
-        f"**Ваш гороскоп:**\n\n{horoscope_text}",
-        reply_markup=get_main_menu_keyboard() # Кнопка для возврата в главное меню
+    analytics.record("horoscope_view", user_id, sign=chosen_sign, period=chosen_date, type=horoscope_type)
+
+    await gather_awaitables(
+        callback.message.edit_text(
+            f"**Ваш гороскоп:**\n\n{horoscope_text}",
+            reply_markup=get_main_menu_keyboard() # Кнопка для возврата в главное меню
+        ),
+        state.clear(), # Сброс состояния после получения гороскопа
+        answered
     )
-    await callback.answer()
-    await state.clear() # Сброс состояния после получения гороскопа
     
     # Дополнительная функция для показа рекламы после получения гороскопа
     await show_ads(user_id)
 
 
-@dp.callback_query(F.data == "check_payment", UserState.waiting_for_payment)
 async def check_payment(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    await callback.message.edit_text("Проверяю оплату... Это может занять до 30 секунд.")
-    await callback.answer()
-
-    if await check_payment_status(user_id):
-        # Если оплата подтверждена, разрешаем еще один гороскоп
-        await update_user_data(user_id, {"daily_horoscopes_given": 0}) # Сброс счетчика после оплаты
-        await callback.message.answer(
-            "Оплата подтверждена! Теперь вы можете получить еще один гороскоп. Выберите знак зодиака:",
-            reply_markup=get_main_keyboard()
-        )
-        await state.set_state(UserState.choosing_sign)
-    else:
-        await callback.message.answer(
-            "Оплата не найдена. Попробуйте еще раз или выберите другой способ оплаты.",
-            reply_markup=get_payment_keyboard(user_id)
+    # У старых кнопок нет группы заказов в callback_data - берем последнюю ожидающую
+    order_group = callback.data.partition(":")[2] or await find_pending_payment_group(user_id)
+    if not order_group:
+        await callback.answer("Заказ не найден. Запросите гороскоп еще раз.", show_alert=True)
+        return
+
+    if not await payment_verifier.submit(order_group, user_id, callback.message.chat.id):
+        await callback.answer("Оплата уже проверяется, подождите немного.")
+        return
+    analytics.record("payment_check", user_id)
+    if payment_verifier.inline:
+        answered = answer_callback_early(callback)
+        if await payment_verifier.check_now(order_group, user_id, callback.message.chat.id):
+            await answered
+            return # Подтверждение уже отправлено
+        await gather_awaitables(
+            callback.message.edit_text(
+                "Оплата пока не найдена. Если вы уже оплатили, нажмите «Проверить оплату» еще раз через минуту.",
+                reply_markup=get_payment_keyboard(order_group)
+            ),
+            answered
         )
+        return
+    # Проверка идет в фоне, результат придет отдельным сообщением
+    await gather_awaitables(
+        callback.answer(),
+        callback.message.edit_text("Проверяю оплату... Это может занять до 30 секунд.")
+    )
 
-@dp.callback_query(F.data == "start_over")
 async def start_over(callback: types.CallbackQuery, state: FSMContext):
-    await state.clear() # Сбрасываем все состояния
-    await callback.message.answer(
-        "Вы вернулись в главное меню. Выберите свой знак зодиака:",
-        reply_markup=get_main_keyboard()
+    await gather_awaitables(
+        callback.answer(),
+        callback.message.answer("Вы вернулись в главное меню. Выберите свой знак зодиака:", reply_markup=get_main_keyboard()),
+        state.clear() # Сбрасываем все состояния
+    )
+
+
+def create_router() -> Router:
+    """Роутер со всеми хендлерами бота (собирается в get_dispatcher)."""
+    router = Router(name=__name__)
+    # /start и проверка оплаты пишут в MongoDB и ходят к провайдерам - для них лимиты строже
+    router.message.register(cmd_start, Command("start"), flags={"throttle": (0.2, 3)})
+    router.message.register(process_chosen_sign, F.text, UserState.choosing_sign)
+    router.message.register(process_birth_date, F.text, UserState.waiting_for_birth_date)
+    router.callback_query.register(process_chosen_date, F.data.startswith("date_"), UserState.choosing_date)
+    router.callback_query.register(process_chosen_type, F.data.startswith("type_"), UserState.choosing_type)
+    router.callback_query.register(
+        check_payment, F.data.startswith("check_payment"), UserState.waiting_for_payment, flags={"throttle": (0.5, 2)}
+    )
+    router.callback_query.register(start_over, F.data == "start_over")
+    return router
+
+
+# --- Ежедневная рассылка ---
+# Лимиты отправки (глобальный и на чат) - token bucket из runtime.ratelimit.
+
+async def send_limited(limiter: SendRateLimiter, chat_id: int, text: str) -> str:
+    """
+    Отправляет сообщение с учетом лимитов рассылки. Возвращает 'sent', 'blocked' или 'failed'.
+    RetryAfter и сетевые ошибки повторяет OutboundDispatcher, сюда они доходят, когда повторы исчерпаны.
+    """
+    await limiter.acquire(chat_id)
+    try:
+        await get_bot().send_message(chat_id, text)
+        return "sent"
+    except TelegramRetryAfter as e:
+        logger.warning(f"Flood control при отправке в {chat_id} не прошел после повторов: ждем {e.retry_after} с.")
+        limiter.pause(chat_id, e.retry_after)
+    except TelegramForbiddenError:
+        # Пользователь заблокировал бота - больше ему не пишем
+        return "blocked"
+    except (TelegramBadRequest, TelegramNetworkError) as e:
+        logger.warning(f"Не удалось отправить гороскоп пользователю {chat_id}: {e}")
+    return "failed"
+
+
+async def _broadcast_worker(queue: asyncio.Queue, limiter: SendRateLimiter, results: dict):
+    while True:
+        chat_id, text = await queue.get()
+        try:
+            results[chat_id] = await send_limited(limiter, chat_id, text)
+        except Exception as e:
+            logger.error(f"Ошибка рассылки для {chat_id}: {e}", exc_info=True)
+            results[chat_id] = "failed"
+        finally:
+            queue.task_done()
+
+
+async def _renew_broadcast_leases(shard_id: str, runner_id: str, owner: str) -> bool:
+    """Продлевает аренду шарда и слота запуска. False, если одну из них перехватил другой запуск."""
+    now = datetime.now(timezone.utc)
+    result = await broadcasts_collection.update_one(
+        {"_id": shard_id, "lease_owner": owner},
+        {"$set": {"lease_until": now + timedelta(seconds=BROADCAST_LEASE_SECONDS)}}
+    )
+    return bool(result.matched_count) and await acquire_lease(broadcasts_collection, runner_id, owner, BROADCAST_LEASE_SECONDS)
+
+
+async def _broadcast_batch(queue: asyncio.Queue, results: dict, shard_id: str, runner_id: str, owner: str,
+                           cursor: list, user_ids: list, text: str) -> bool:
+    """
+    Отправляет пачку пользователей (до BROADCAST_CHECKPOINT_SIZE) через пул воркеров и сохраняет
+    чекпоинт шарда, продлевая аренду. Возвращает False, если аренду шарда за это время перехватил другой запуск.
+    """
+    results.clear()
+    for user_id in user_ids:
+        await queue.put((user_id, f"🌅 Доброе утро! Ваш гороскоп на сегодня:\n\n{text}"))
+    # Пачка может идти дольше аренды (Telegram попросил подождать, медленная сеть),
+    # поэтому пока она отправляется, аренды продлеваются каждую треть срока
+    sending = asyncio.ensure_future(queue.join())
+    leased = True
+    try:
+        while not (await asyncio.wait({sending}, timeout=BROADCAST_LEASE_SECONDS / 3))[0]:
+            leased = leased and await _renew_broadcast_leases(shard_id, runner_id, owner)
+    finally:
+        sending.cancel()
+    if not leased:
+        return False
+
+    counts = {"sent": 0, "blocked": 0, "failed": 0}
+    for result in results.values():
+        counts[result] += 1
+    blocked = [user_id for user_id, result in results.items() if result == "blocked"]
+    if blocked:
+        await users_collection.update_many(
+            {"_id": {"$in": blocked}}, {"$set": {USER_BLOCKED_DAY: day_number(today_key())}}
+        )
+    # Чекпоинт пишется после того, как вся пачка обработана. Если запуск упадет раньше, повторный
+    # начнет пачку с предыдущего курсора и уже получившие сообщение из нее получат его еще раз -
+    # поэтому пачка небольшая (BROADCAST_CHECKPOINT_SIZE), а не размером с выборку из MongoDB
+    now = datetime.now(timezone.utc)
+    result = await broadcasts_collection.update_one(
+        {"_id": shard_id, "lease_owner": owner},
+        {"$set": {"cursor": cursor, "updated_at": now, "lease_until": now + timedelta(seconds=BROADCAST_LEASE_SECONDS)},
+         "$inc": counts}
+    )
+    return bool(result.matched_count)
+
+
+async def plan_broadcast(today: str) -> dict:
+    """
+    План рассылки на день: границы диапазонов user_id (квантили по индексу _id) и документы шардов.
+    Создается один раз, параллельные запуски получают уже сохраненный план.
+    """
+    plan = await broadcasts_collection.find_one({"_id": today})
+    if plan is None or "bounds" not in plan:
+        # Границы - квантили тех же пользователей, что получат рассылку, иначе шарды вышли бы неравными
+        recipients = {USER_SIGN: {"$exists": True}, USER_BLOCKED_DAY: {"$exists": False}}
+        total = await users_collection.count_documents(recipients)
+        shards = max(1, min(BROADCAST_SHARDS, total // BROADCAST_BATCH_SIZE))
+        bounds = []
+        for shard in range(1, shards):
+            # Пропуск в порядке _id: раз в день и не больше BROADCAST_SHARDS раз
+            docs = await users_collection.find(recipients, projection={"_id": 1}).sort("_id", 1) \
+                .skip(shard * total // shards).limit(1).to_list(1)
+            if docs and (not bounds or docs[0]["_id"] > bounds[-1]):
+                bounds.append(docs[0]["_id"])
+        try:
+            plan = await broadcasts_collection.find_one_and_update(
+                {"_id": today, "bounds": {"$exists": False}},
+                {"$set": {"bounds": bounds, "shards": len(bounds) + 1},
+                 "$setOnInsert": {"finished": False, "started_at": datetime.now(timezone.utc)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            logger.info(f"Рассылка за {today}: {total} пользователей, шардов {plan['shards']}.")
+        except DuplicateKeyError:
+            plan = await broadcasts_collection.find_one({"_id": today}) # План уже сохранил другой запуск
+
+    # Документы шардов досоздаются при каждом запуске: запуск, сохранивший план, мог не успеть их создать.
+    # Прогресс, сохраненный до появления шардов ([знак, user_id] на всю базу), годится как начальный
+    # курсор каждого шарда: внутри шарда пользователи идут в том же порядке.
+    start_cursor = plan.get("cursor", [0, 0])
+    edges = [None, *plan["bounds"], None]
+    await broadcasts_collection.bulk_write([
+        UpdateOne(
+            {"_id": f"{today}:{shard:03d}"},
+            {"$setOnInsert": {
+                "day": today, "shard": shard, "range": [edges[shard], edges[shard + 1]], "cursor": start_cursor,
+                "sent": 0, "blocked": 0, "failed": 0, "finished": False, "lease_until": None
+            }},
+            upsert=True
+        )
+        for shard in range(plan["shards"])
+    ], ordered=False)
+    return plan
+
+
+async def claim_broadcast_shard(today: str, owner: str):
+    """Берет в аренду первый незавершенный свободный шард дня или возвращает None."""
+    now = datetime.now(timezone.utc)
+    return await broadcasts_collection.find_one_and_update(
+        {"day": today, "finished": False, **lease_is_free(now, owner)},
+        {"$set": {"lease_owner": owner, "lease_until": now + timedelta(seconds=BROADCAST_LEASE_SECONDS)}},
+        sort=[("shard", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def _broadcast_shard(shard: dict, owner: str, runner_id: str, queue: asyncio.Queue, results: dict, deadline) -> bool:
+    """Рассылает шард с его курсора. True - шард завершен, False - прерван по времени или потерял аренду."""
+    low, high = shard["range"]
+    sign_index, last_user_id = shard["cursor"]
+    while sign_index < len(ZODIAC_SIGNS):
+        sign = ZODIAC_SIGNS[sign_index]
+        # Текст одинаков для всех пользователей знака - генерируем его один раз
+        text = await generate_horoscope(sign, "today", "general")
+        user_id_filter = {"$gt": last_user_id}
+        if low is not None:
+            user_id_filter["$gte"] = low
+        if high is not None:
+            user_id_filter["$lt"] = high
+        cursor = users_collection.find(
+            {USER_SIGN: sign_index, "_id": user_id_filter, USER_BLOCKED_DAY: {"$exists": False}},
+            projection={"_id": 1}
+        ).sort("_id", 1).batch_size(BROADCAST_BATCH_SIZE)
+
+        batch = []
+        async for user_doc in cursor:
+            batch.append(user_doc["_id"])
+            if len(batch) < BROADCAST_CHECKPOINT_SIZE:
+                continue
+            if not await _broadcast_batch(queue, results, shard["_id"], runner_id, owner, [sign_index, batch[-1]], batch, text) \
+                    or not await acquire_lease(broadcasts_collection, runner_id, owner, BROADCAST_LEASE_SECONDS):
+                await cursor.close()
+                logger.warning(f"Аренду шарда {shard['_id']} или слота {runner_id} перехватил другой запуск.")
+                return False
+            batch = []
+            if deadline and time.monotonic() >= deadline:
+                await cursor.close()
+                return False
+        if batch and not await _broadcast_batch(queue, results, shard["_id"], runner_id, owner, [sign_index, batch[-1]], batch, text):
+            return False
+
+        sign_index, last_user_id = sign_index + 1, 0
+        await broadcasts_collection.update_one(
+            {"_id": shard["_id"], "lease_owner": owner}, {"$set": {"cursor": [sign_index, 0]}}
+        )
+
+    await broadcasts_collection.update_one(
+        {"_id": shard["_id"], "lease_owner": owner},
+        {"$set": {"finished": True, "finished_at": datetime.now(timezone.utc), "lease_until": None}}
     )
-    await callback.answer()
+    return True
+
+
+async def broadcast_progress(today: str) -> dict:
+    """Сводный прогресс рассылки за день по документу плана и всем шардам."""
+    progress = await broadcasts_collection.find_one({"_id": today}) or {"_id": today}
+    # Счетчики из плана - отправленное до появления шардов
+    totals = {field: progress.get(field, 0) for field in ("sent", "blocked", "failed")}
+    now = datetime.now(timezone.utc)
+    shards_finished = shards_running = 0
+    async for shard in broadcasts_collection.find({"day": today}):
+        for field in totals:
+            totals[field] += shard.get(field, 0)
+        if shard["finished"]:
+            shards_finished += 1
+        elif shard.get("lease_until") and shard["lease_until"].replace(tzinfo=timezone.utc) > now:
+            shards_running += 1
+    progress.update(totals, shards_finished=shards_finished, shards_running=shards_running)
+    return progress
+
+
+async def scheduled_tasks(time_budget: float = None) -> dict:
+    """
+    Ежедневная рассылка гороскопов всем пользователям с сохраненным знаком.
+
+    База делится на шарды по диапазонам user_id (plan_broadcast). Запуск занимает слот
+    из BROADCAST_RUNNERS, берет в аренду свободный шард и рассылает его по знакам,
+    внутри знака - по возрастанию user_id, сохраняя курсор шарда после каждой пачки.
+    Когда шард закончен и время еще есть, берется следующий. Прерванный по таймауту запуск
+    продолжит следующий вызов, параллельные вызовы разбирают разные шарды.
+    """
+    if time_budget is None:
+        time_budget = BROADCAST_TIME_BUDGET
+    deadline = time.monotonic() + time_budget if time_budget else None
+    today = today_key()
+
+    await horoscope_store.prewarm(today, HOROSCOPE_PREWARM_DAYS)
+    # Служебные задачи не должны мешать рассылке, их можно запустить командами rollup-events,
+    # maintain-users и migrate-users
+    try:
+        # Пользователи прежней схемы не получили бы рассылку: их знак еще не в компактном поле
+        if await users_migration_pending():
+            await migrate_users(time_budget=deadline - time.monotonic() if deadline else None)
+    except Exception as e:
+        logger.error(f"Ошибка миграции пользователей: {e}", exc_info=True)
+    try:
+        await rollup_previous_day()
+    except Exception as e:
+        logger.error(f"Ошибка при подсчете итогов событий: {e}", exc_info=True)
+    try:
+        if await claim_daily_run("users_maintenance", today):
+            await maintain_users()
+    except Exception as e:
+        logger.error(f"Ошибка при обслуживании пользователей: {e}", exc_info=True)
+    plan = await plan_broadcast(today)
+    if plan.get("finished"):
+        logger.info(f"Рассылка за {today} уже завершена.")
+        return await broadcast_progress(today)
+
+    # Свой владелец аренд у каждого запуска: два запуска в одном процессе не должны делить шард
+    owner = f"{INSTANCE_ID}:{uuid.uuid4().hex[:8]}"
+    runner_id = None
+    for slot in range(BROADCAST_RUNNERS):
+        if await acquire_lease(broadcasts_collection, f"{today}:runner:{slot}", owner, BROADCAST_LEASE_SECONDS):
+            runner_id = f"{today}:runner:{slot}"
+            break
+    if runner_id is None:
+        logger.info(f"Рассылка за {today}: все {BROADCAST_RUNNERS} слотов заняты другими запусками.")
+        return await broadcast_progress(today)
+
+    limiter = SendRateLimiter(BROADCAST_RATE / BROADCAST_RUNNERS, BROADCAST_CHAT_RATE)
+    queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 2)
+    results = {}
+    workers = [asyncio.create_task(_broadcast_worker(queue, limiter, results)) for _ in range(BROADCAST_WORKERS)]
+    shard = None
+    try:
+        while not deadline or time.monotonic() < deadline:
+            shard = await claim_broadcast_shard(today, owner)
+            if shard is None:
+                break
+            logger.info(f"Рассылка за {today}: шард {shard['_id']} с курсора {shard['cursor']}.")
+            if not await _broadcast_shard(shard, owner, runner_id, queue, results, deadline):
+                break
+            shard = None
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        # Незаконченный шард сразу отдаем следующему запуску, не дожидаясь истечения аренды
+        if shard is not None:
+            await release_lease(broadcasts_collection, shard["_id"], owner)
+        await release_lease(broadcasts_collection, runner_id, owner)
+
+    if not await broadcasts_collection.count_documents({"day": today, "finished": False}):
+        await broadcasts_collection.update_one(
+            {"_id": today, "finished": False},
+            {"$set": {"finished": True, "finished_at": datetime.now(timezone.utc)}}
+        )
+    progress = await broadcast_progress(today)
+    logger.info(
+        f"Рассылка за {today}: отправлено {progress['sent']}, заблокировали бота {progress['blocked']}, "
+        f"ошибок {progress['failed']}, шардов завершено {progress['shards_finished']} из {progress['shards']}"
+        f"{', рассылка завершена' if progress.get('finished') else ', остаток доработают следующие запуски'}."
+    )
+    return progress
+
+
+# --- Служебные задачи ---
+
+async def maintain_users() -> dict:
+    """
+    Ежедневное обслуживание коллекции пользователей, каждое действие - одна операция над всей коллекцией:
+    - счетчик бесплатных гороскопов обнуляется у всех, кто не брал гороскоп сегодня;
+    - заблокировавшие бота удаляются через USERS_BLOCKED_RETENTION_DAYS дней без активности после блокировки,
+      пользователи без знака (не получают рассылку) - через USERS_INACTIVE_DAYS дней без гороскопов.
+    consume_free_horoscope сам учитывает смену дня, поэтому сброс нужен не для лимита,
+    а чтобы счетчики в базе совпадали с фактическими и старые документы не копились.
+    """
+    today = date.fromisoformat(today_key())
+    reset = await users_collection.update_many(
+        {USER_QUOTA_DAY: {"$lt": day_number(today.isoformat())}, USER_QUOTA_USED: {"$gt": 0}},
+        {"$set": {USER_QUOTA_USED: 0}}
+    )
+
+    prune = []
+    if USERS_BLOCKED_RETENTION_DAYS:
+        cutoff = day_number((today - timedelta(days=USERS_BLOCKED_RETENTION_DAYS)).isoformat())
+        # Только если после блокировки пользователь ничего не получал: день последнего гороскопа
+        # не позже дня блокировки (вернувшимся отметку снимают register_user и update_user_data)
+        prune.append({
+            USER_BLOCKED_DAY: {"$lt": cutoff},
+            "$expr": {"$lte": [{"$ifNull": [f"${USER_QUOTA_DAY}", 0]}, f"${USER_BLOCKED_DAY}"]}
+        })
+    if USERS_INACTIVE_DAYS:
+        cutoff = day_number((today - timedelta(days=USERS_INACTIVE_DAYS)).isoformat())
+        prune.append({USER_SIGN: {"$exists": False}, USER_QUOTA_DAY: {"$lt": cutoff}})
+    pruned = (await users_collection.delete_many({"$or": prune})).deleted_count if prune else 0
+
+    result = {"reset": reset.modified_count, "pruned": pruned}
+    logger.info(f"Обслуживание пользователей: счетчиков сброшено {result['reset']}, удалено {result['pruned']}.")
+    return result
+
+
+def _legacy_day_number(value):
+    # Прежняя схема хранила дни строкой YYYY-MM-DD, в отдельных документах - датой BSON
+    if isinstance(value, datetime):
+        return value.year * 10000 + value.month * 100 + value.day
+    if isinstance(value, str) and len(value) >= 10:
+        return day_number(value)
+    return None
+
+
+def compact_users(documents) -> list:
+    """
+    Поля документов прежней схемы (user_id, sign, birth_date, ...) в компактной схеме, без _id.
+    Знаки тех, у кого сохранена только дата рождения, определяются для всей пачки одним
+    вызовом get_zodiac_sign_indices.
+    """
+    compacts = []
+    for document in documents:
+        compact = {
+            USER_SIGN: SIGN_INDEX.get(document.get("sign")),
+            USER_BIRTH_DATE: _legacy_day_number(document.get("birth_date")),
+            USER_QUOTA_DAY: _legacy_day_number(document.get("last_horoscope_date")),
+            USER_QUOTA_USED: document.get("daily_horoscopes_given"),
+        }
+        if document.get("blocked"):
+            compact[USER_BLOCKED_DAY] = _legacy_day_number(document.get("blocked_at")) or day_number(today_key())
+        compacts.append(compact)
+
+    unsigned = [compact for compact in compacts if compact[USER_SIGN] is None and compact[USER_BIRTH_DATE]]
+    if unsigned:
+        births = [compact[USER_BIRTH_DATE] for compact in unsigned]
+        indices = get_zodiac_sign_indices([birth // 100 % 100 for birth in births], [birth % 100 for birth in births])
+        for compact, index in zip(unsigned, indices):
+            compact[USER_SIGN] = int(index) # Элементы массива NumPy BSON не кодирует
+    return [{field: value for field, value in compact.items() if value is not None} for compact in compacts]
+
+def compact_user(document: dict) -> dict:
+    return compact_users([document])[0]
+
+
+# Индексы прежней схемы пользователей (первый - частичный уникальный user_id на время миграции)
+LEGACY_USER_INDEXES = ("user_id_legacy", "sign_1_user_id_1", "last_horoscope_date_1", "blocked_at_1")
+
+async def users_migration_pending() -> bool:
+    # Пока миграция не закончена, в коллекции есть индекс user_id_1 или заменяющий его user_id_legacy
+    return bool({"user_id_1", LEGACY_USER_INDEXES[0]} & set(await users_collection.index_information()))
+
+async def drop_user_index(name: str):
+    """drop_index, которому не мешает, что индекс уже удалил параллельный процесс."""
+    try:
+        await users_collection.drop_index(name)
+    except OperationFailure:
+        if name in await users_collection.index_information():
+            raise
+
+async def replace_legacy_user_index():
+    """
+    Заменяет уникальный индекс user_id прежней схемы частичным - только по документам с полем user_id.
+    Безопасна при параллельных холодных стартах: одинаковый create_index - не ошибка, drop_user_index
+    не падает, если индекс уже удален.
+    """
+    if "user_id_1" not in await users_collection.index_information():
+        return
+    await users_collection.create_index(
+        "user_id", unique=True, name=LEGACY_USER_INDEXES[0], partialFilterExpression={"user_id": {"$exists": True}}
+    )
+    await drop_user_index("user_id_1")
+
+async def migrate_users(batch_size: int = 1000, time_budget: float = None) -> int:
+    """
+    Разовая задача: переписывает документы прежней схемы (с полем user_id) в компактную пачками.
+
+    Каждая пачка - один bulk_write с upsert документов с _id = user_id и одно удаление старых.
+    Поля, которые пользователь успел получить в новой схеме до миграции, не перезаписываются
+    ($ifNull), поэтому задачу можно запускать на работающем боте и повторять после сбоя.
+    Запускается командой migrate-users и из cron (scheduled_tasks), пока документы прежней схемы
+    не кончатся; cron ограничивает ее time_budget секундами, следующий запуск продолжит с того же места.
+    Параллельные запуски исключает аренда users_migration в коллекции meta, она продлевается после каждой пачки.
+    Индексы прежней схемы удаляются, когда старых документов не осталось.
+    """
+    meta_collection = db[MONGO_META_COLLECTION_NAME]
+    owner = f"{INSTANCE_ID}:{uuid.uuid4().hex[:8]}"
+    if not await acquire_lease(meta_collection, "users_migration", owner, LEADER_LEASE_SECONDS):
+        logger.info("Миграция пользователей уже идет в другом процессе.")
+        return 0
+    deadline = time.monotonic() + time_budget if time_budget else None
+    try:
+        await replace_legacy_user_index()
+
+        cursor = users_collection.find({"user_id": {"$exists": True}}).batch_size(batch_size)
+        migrated = 0
+        batch = []
+
+        async def write_batch():
+            requests = []
+            for document, fields in zip(batch, compact_users(batch)):
+                if fields:
+                    update = [{"$set": {field: {"$ifNull": [f"${field}", value]} for field, value in fields.items()}}]
+                else:
+                    update = {"$setOnInsert": {USER_QUOTA_USED: 0}} # как у register_user
+                requests.append(UpdateOne({"_id": document["user_id"]}, update, upsert=True))
+            await users_collection.bulk_write(requests, ordered=False)
+            result = await users_collection.delete_many({"_id": {"$in": [document["_id"] for document in batch]}})
+            return result.deleted_count
+
+        async for document in cursor:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                migrated += await write_batch()
+                batch = []
+                logger.info(f"Переписано в компактную схему: {migrated} пользователей.")
+                if deadline is not None and time.monotonic() >= deadline:
+                    logger.info("Миграция пользователей прервана по времени, ее продолжит следующий запуск.")
+                    return migrated
+                if not await acquire_lease(meta_collection, "users_migration", owner, LEADER_LEASE_SECONDS):
+                    logger.warning("Аренда миграции пользователей перешла другому процессу, останавливаемся.")
+                    return migrated
+        if batch:
+            migrated += await write_batch()
+
+        if await users_collection.count_documents({"user_id": {"$exists": True}}, limit=1):
+            # Их записали процессы прежней версии, пока шла миграция
+            logger.warning("Остались документы прежней схемы: запустите migrate-users еще раз после остановки старых процессов.")
+        else:
+            indexes = await users_collection.index_information()
+            for name in LEGACY_USER_INDEXES:
+                if name in indexes:
+                    await drop_user_index(name)
+        logger.info(f"Миграция пользователей завершена: переписано {migrated}.")
+        return migrated
+    finally:
+        await release_lease(meta_collection, "users_migration", owner)
+
+
+# Разовые служебные задачи: python astro.py <команда>
+CLI_COMMANDS = {
+    "rollup-events": rollup_recent_events,
+    "maintain-users": maintain_users,
+    "migrate-users": migrate_users,
+}
+
+async def run_command(name: str):
+    await init_mongodb()
+    try:
+        await CLI_COMMANDS[name]()
+    finally:
+        await user_writes.stop()
+        await analytics.stop()
+        close_mongodb()
+
+
+# --- Обработка входящих обновлений ---
+# Полосы (UpdateLanes), процессы-воркеры (WorkerPool) и long-polling - в runtime.updates,
+# здесь - выбор реплики и точка входа воркера.
+
+def update_replica(update: dict) -> int:
+    """Реплика, которой принадлежит чат обновления (REPLICA_ID, если реплик не задано)."""
+    if not REPLICA_URLS:
+        return REPLICA_ID
+    return chat_shard(update_chat_id(update), len(REPLICA_URLS), REPLICA_SEED)
+
+
+def worker_process(index: int, updates, reports):
+    """Точка входа процесса-воркера WorkerPool."""
+    setup_logging()
+    asyncio.run(_worker_main(index, updates, reports))
+
+async def _worker_main(index: int, updates, reports):
+    await init_mongodb()
+    user_writes.start()
+    analytics.start()
+    lanes = UpdateLanes(WEBHOOK_LANES, WEBHOOK_LANE_SIZE, WEBHOOK_ENQUEUE_TIMEOUT)
+    lanes.start(get_bot(), get_dispatcher())
+    reporter = asyncio.create_task(report_metrics(index, reports, METRICS_REPORT_INTERVAL))
+    loop = asyncio.get_running_loop()
+    logger.info(f"Воркер {index} готов к обработке обновлений.")
+    try:
+        while True:
+            try:
+                # С таймаутом: поток executor не должен зависнуть в get, если основной процесс умер
+                update = await loop.run_in_executor(None, updates.get, True, 1)
+            except Empty:
+                continue
+            if update is None:
+                break
+            while not await lanes.put(update):
+                logger.warning(f"Воркер {index}: полоса переполнена, ждем освобождения.")
+    finally:
+        await lanes.stop()
+        await user_writes.stop()
+        await analytics.stop()
+        reporter.cancel()
+        reports.put_nowait((index, metrics.snapshot()))
+        await get_bot().session.close()
+        close_mongodb()
+        logger.info(f"Воркер {index} остановлен.")
+
+
+def leader_lease(role: str) -> LeaderLease:
+    """Лидерство роли role среди всех процессов и инстансов (аренда в коллекции meta)."""
+    return LeaderLease(db[MONGO_META_COLLECTION_NAME], role, LEADER_LEASE_SECONDS)
+
+
+async def broadcast_scheduler(interval: float = 60):
+    """Ежедневная рассылка для долгоживущих процессов: с BROADCAST_HOUR (UTC), пока не завершена."""
+    while True:
+        try:
+            if datetime.now(timezone.utc).hour >= BROADCAST_HOUR:
+                plan = await broadcasts_collection.find_one({"_id": today_key()}, projection={"finished": 1})
+                if not (plan and plan.get("finished")):
+                    await scheduled_tasks()
+        except Exception as e:
+            logger.error(f"Ошибка рассылки по расписанию: {e}", exc_info=True)
+        await asyncio.sleep(interval)
 
 
 # --- Функции запуска и завершения ---
 
+_scheduler_task = None
+_payments_task = None
+
 # Функция для установки вебхука и инициализации БД
 async def on_startup(passed_bot: Bot) -> None:
+    global _scheduler_task, _payments_task
     logger.info("Инициализация...")
     await init_mongodb() # Инициализируем MongoDB
+    user_writes.start()
+    analytics.start()
+    if PROFILER_ENABLED:
+        profiler.start()
+    if BROADCAST_HOUR is not None and _scheduler_task is None:
+        _scheduler_task = asyncio.create_task(leader_lease("broadcast").run(broadcast_scheduler))
+    if not PAYMENT_CHECK_INLINE and _payments_task is None:
+        # Проверки оплат из всех процессов и инстансов опрашивает один лидер
+        _payments_task = asyncio.create_task(leader_lease("payments").run(payment_verifier.run))
     logger.info("Установка вебхука...")
-    if WEBHOOK_URL:
+    if WEBHOOK_URL and REPLICA_ID:
+        # drop_pending_updates при перезапуске каждой реплики терял бы обновления - вебхук ставит реплика 0
+        logger.info(f"Реплика {REPLICA_ID}: вебхук устанавливает реплика 0.")
+    elif WEBHOOK_URL:
         # Устанавливаем вебхук. drop_pending_updates=True очищает старые обновления,
         # чтобы бот не обрабатывал их после перезапуска.
-        await passed_bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
+        await passed_bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True, secret_token=WEBHOOK_SECRET)
         logger.info(f"Вебхук установлен на: {WEBHOOK_URL}")
     else:
         logger.warning("WEBHOOK_URL не установлен. Вебхук не будет настроен. Убедитесь, что переменная окружения WEBHOOK_HOST или RENDER_EXTERNAL_HOSTNAME задана.")
@@ -397,19 +2226,39 @@ async def on_startup(passed_bot: Bot) -> None:
 
 # Закрытие соединения с БД при завершении
 async def on_shutdown(passed_bot: Bot) -> None:
-    if mongo_client:
-        mongo_client.close()
-        logger.info("MongoDB соединение закрыто.")
+    global _scheduler_task, _payments_task
+    for task in (_scheduler_task, _payments_task):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    _scheduler_task = _payments_task = None
+    profiler.stop()
+    await user_writes.stop() # Дописываем накопленные изменения пользователей
+    await analytics.stop()
+    close_mongodb()
     logger.info("Завершение работы...")
 
 
 # Основная точка входа для локального запуска (если WEBHOOK_URL не установлен)
 async def main():
+    bot = get_bot()
     await on_startup(bot)
     try:
         if not WEBHOOK_URL: # Если WEBHOOK_URL не задан, это локальный запуск
             logger.info("Запуск бота в режиме long-polling (для локальной разработки).")
-            await dp.start_polling(bot)
+            # Две копии с polling обрабатывали бы обновления дважды - опрашивает только лидер
+            leader = leader_lease("polling")
+            if WORKERS > 1:
+                pool = WorkerPool(worker_process, WORKERS, WORKER_QUEUE_SIZE)
+                pool.start()
+                # Подтверждения оплат - воркеру чата, как и его обновления
+                payment_verifier.deliver = pool.put
+                try:
+                    await leader.run(lambda: poll_updates(bot, get_dispatcher(), pool))
+                finally:
+                    await pool.stop()
+            else:
+                await leader.run(lambda: get_dispatcher().start_polling(bot))
         else:
             logger.info("Бот настроен для вебхуков. Ожидание входящих запросов от Uvicorn/ASGI сервера.")
             # Для вебхуков, Uvicorn сам вызывает ASGI-приложение, которое мы настроили в api/index.py.
@@ -420,11 +2269,17 @@ async def main():
 
 # Этот блок будет выполняться только при прямом запуске astro.py
 if __name__ == "__main__":
+    setup_logging()
     # Если вы хотите тестировать локально через long-polling, убедитесь, что WEBHOOK_HOST не установлен в .env
     # или его значение пустое, чтобы WEBHOOK_URL стал None.
     # Если WEBHOOK_HOST установлен, то бот попытается использовать вебхуки даже локально,
     # что может привести к ошибкам, если нет публично доступного URL.
     try:
-        asyncio.run(main())
+        if len(sys.argv) > 1:
+            if sys.argv[1] not in CLI_COMMANDS:
+                sys.exit(f"Неизвестная команда {sys.argv[1]}. Доступны: {', '.join(CLI_COMMANDS)}")
+            asyncio.run(run_command(sys.argv[1]))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Бот остановлен вручную.")
@@ -0,0 +1,78 @@
+"""
+Бенчмарк FSM-хранилищ: задержка одного перехода состояния для MemoryStorage и MongoStorage.
+
+Один переход - то, что делает бот на каждом шаге диалога: чтение состояния (фильтр хендлера),
+update_data и set_state.
+
+    python benchmarks/bench_fsm_storage.py                 # MongoDB заменяется mongomock-motor
+    python benchmarks/bench_fsm_storage.py --mongo-uri mongodb://localhost:27017
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+import astro
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+
+async def run_transitions(storage, users: int, steps: int) -> list:
+    states = [astro.UserState.choosing_sign, astro.UserState.choosing_date, astro.UserState.choosing_type]
+    timings = []
+    for step in range(steps):
+        for user_id in range(users):
+            key = StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+            started = time.perf_counter()
+            await storage.get_state(key)
+            await storage.update_data(key, {"chosen_sign": astro.ZODIAC_SIGNS[user_id % 12], "step": step})
+            await storage.set_state(key, states[step % len(states)])
+            timings.append(time.perf_counter() - started)
+    return timings
+
+
+def report(name: str, timings: list):
+    timings = sorted(timings)
+    p50 = timings[len(timings) // 2] * 1e6
+    p95 = timings[int(len(timings) * 0.95)] * 1e6
+    print(f"{name:<28} переходов: {len(timings):>6}  среднее: {statistics.mean(timings) * 1e6:8.1f} мкс  "
+          f"p50: {p50:8.1f} мкс  p95: {p95:8.1f} мкс")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--mongo-uri", help="реальный MongoDB вместо mongomock-motor")
+    args = parser.parse_args()
+
+    if args.mongo_uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(args.mongo_uri)
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        client = AsyncMongoMockClient()
+    collection = client["astro_benchmark"]["fsm_states"]
+    await collection.delete_many({})
+    await collection.create_index("updated_at", expireAfterSeconds=3600)
+
+    report("MemoryStorage", await run_transitions(MemoryStorage(), args.users, args.steps))
+
+    storage = astro.MongoStorage(lambda: collection)
+    report("MongoStorage (с кэшем)", await run_transitions(storage, args.users, args.steps))
+
+    # cache_ttl=0: каждое чтение идет в MongoDB - так ведет себя холодный инстанс или деплой без кэша
+    cold_storage = astro.MongoStorage(lambda: collection, cache_ttl=0)
+    report("MongoStorage (без кэша)", await run_transitions(cold_storage, args.users, args.steps))
+
+    await collection.drop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
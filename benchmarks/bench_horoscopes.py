@@ -0,0 +1,61 @@
+"""
+Бенчмарк генерации гороскопов: неделя текстов для всех знаков, периодов и типов.
+
+Проверяет, что генерация детерминирована (повторный проход и одиночный render_horoscope
+дают те же тексты), считает число различных текстов и время пакетного прогрева.
+Код выхода 1, если неделя генерируется дольше --max-ms.
+
+    python benchmarks/bench_horoscopes.py
+    python benchmarks/bench_horoscopes.py --days 30 --max-ms 200
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+import astro
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--start", default=astro.today_key(), help="первый день, YYYY-MM-DD")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=20, help="повторов для замера")
+    parser.add_argument("--max-ms", type=float, default=50, help="допустимое время одного прохода")
+    args = parser.parse_args()
+
+    rendered = astro.render_horoscopes(args.start, args.days)
+    assert astro.render_horoscopes(args.start, args.days) == rendered
+    for day, texts in rendered.items():
+        for (sign, date_type, horoscope_type), text in texts.items():
+            assert astro.render_horoscope(sign, date_type, horoscope_type, day) == text
+    total = sum(len(texts) for texts in rendered.values())
+    unique = len({text.split("\n\n", 1)[1] for texts in rendered.values() for text in texts.values()})
+    print(f"{args.days} дн.: {total} текстов, различных прогнозов {unique}")
+
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        astro.render_horoscopes(args.start, args.days)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    best, median = timings[0] * 1e3, timings[len(timings) // 2] * 1e3
+    print(f"пакетно:  лучший {best:6.2f} мс, медиана {median:6.2f} мс ({median * 1e3 / total:.1f} мкс на текст)")
+
+    started = time.perf_counter()
+    for day, texts in rendered.items():
+        for key in texts:
+            astro.render_horoscope(*key, day)
+    print(f"по одному: {(time.perf_counter() - started) * 1e3:6.2f} мс")
+
+    if median > args.max_ms:
+        print(f"Медиана {median:.2f} мс больше допустимых {args.max_ms} мс")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
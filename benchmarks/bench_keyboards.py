@@ -0,0 +1,70 @@
+"""
+Микробенчмарк клавиатур: сборка и сериализация reply_markup на одно обновление.
+
+Сравнивает старый путь (builder + pydantic-модели на каждый вызов, сериализация в запросе)
+с готовыми клавиатурами из KeyboardRegistry. Пик выделенной за вызов памяти считается через tracemalloc.
+
+    python benchmarks/bench_keyboards.py
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+import astro
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.methods import SendMessage
+
+
+def legacy_update():
+    # Так было раньше: клавиатура собирается заново и сериализуется стандартной сессией
+    method = SendMessage(chat_id=1, text="Выбери свой знак зодиака:", reply_markup=astro._build_main_keyboard())
+    return AiohttpSession.build_form_data(astro.get_bot().session, astro.get_bot(), method)
+
+
+def prebuilt_update():
+    method = SendMessage(chat_id=1, text="Выбери свой знак зодиака:", reply_markup=astro.get_main_keyboard())
+    return astro.get_bot().session.build_form_data(astro.get_bot(), method)
+
+
+def payment_update():
+    method = SendMessage(chat_id=1, text="Оплатите гороскоп", reply_markup=astro.get_payment_keyboard("1_1700000000000"))
+    return astro.get_bot().session.build_form_data(astro.get_bot(), method)
+
+
+def measure(name: str, func, iterations: int):
+    func()  # прогрев
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    elapsed = (time.perf_counter() - started) / iterations
+
+    # Пик памяти за вызов: сколько временных объектов создается на одно обновление
+    tracemalloc.start()
+    peaks = []
+    for _ in range(100):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        func()
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    print(f"{name:<36} {elapsed * 1e6:8.1f} мкс/обновление  пик памяти {sum(peaks) / len(peaks):9.0f} байт")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    measure("builder на каждый вызов (было)", legacy_update, args.iterations)
+    measure("готовая клавиатура из реестра", prebuilt_update, args.iterations)
+    measure("клавиатура оплаты по шаблону", payment_update, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
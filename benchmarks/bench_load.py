@@ -0,0 +1,314 @@
+"""
+Нагрузочный тест обработки обновлений: синтетические пользователи проходят весь диалог бота
+через dp.feed_update, Bot API заменяется локальным aiohttp-сервером, MongoDB - mongomock-motor.
+
+Сценарий одного пользователя: три раза /start -> знак -> период -> тип (третий раз упирается
+в лимит и получает клавиатуру оплаты), затем "Проверить оплату" с группой заказов из этой клавиатуры.
+Пользователи идут параллельно (--concurrency), внутри пользователя обновления строго по порядку.
+
+Отчет: обновлений в секунду, p50/p95/p99 по хендлерам и по обновлению целиком,
+операций MongoDB и запросов к Bot API на одно обновление.
+
+    python benchmarks/bench_load.py --users 500 --concurrency 50
+    python benchmarks/bench_load.py --save-baseline                 # сохранить результат как базовый
+    python benchmarks/bench_load.py                                  # сравнить с сохраненным базовым
+    python benchmarks/bench_load.py --counts-only                    # сравнить только число запросов
+    python benchmarks/bench_load.py --mongo-uri mongodb://localhost:27017 --api-latency 30
+
+Базовый результат лежит в репозитории (benchmarks/baselines/bench_load.json, параметры по умолчанию,
+mongomock). Если какая-то метрика хуже базовой больше чем на --tolerance, скрипт завершается с кодом 1.
+Число операций MongoDB и запросов к Bot API на обновление от машины не зависит и сравнивается всегда;
+время и пропускная способность сравниваются, только если не задан --counts-only (на другой машине
+сначала пересохраните базовый результат). Сравнение с результатом других параметров запуска
+(пользователей, параллельности, задержки API, MongoDB) не имеет смысла и завершается с кодом 2.
+
+Зависимости для запуска: pip install -r requirements-dev.txt
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+# Виртуальные пользователи нажимают кнопки без пауз - защита от флуда отбросила бы большую часть сценария
+os.environ.setdefault("THROTTLE_RATE", "0")
+
+import astro
+from aiogram import BaseMiddleware, types
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baselines", "bench_load.json")
+PAYMENT_CALLBACK = re.compile(r"check_payment:[\w-]+")
+# Параметры запуска, при которых результаты сравнимы между собой
+RUN_PARAMETERS = ("users", "concurrency", "api_latency_ms", "mongo")
+
+
+class FakeBotAPI:
+    """Локальный Bot API: отвечает на любой метод, запоминает кнопку оплаты, отправленную в чат."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests = 0
+        self.payment_callbacks = {}  # chat_id -> callback_data кнопки "Проверить оплату"
+        self._message_id = 0
+        self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        method = request.match_info["method"].lower()
+        fields = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = int(fields.get("chat_id", 0))
+        match = PAYMENT_CALLBACK.search(fields.get("reply_markup", ""))
+        if match:
+            self.payment_callbacks[chat_id] = match.group(0)
+
+        if method in ("sendmessage", "editmessagetext"):
+            self._message_id += 1
+            result = {
+                "message_id": int(fields.get("message_id", self._message_id)), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": fields.get("text", "")
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class HandlerTimings(BaseMiddleware):
+    """Точные длительности хендлеров (гистограмма astro.metrics слишком груба для перцентилей)."""
+
+    def __init__(self):
+        self.timings = {}  # имя хендлера -> [секунды]
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.timings.setdefault(data["handler"].callback.__name__, []).append(time.perf_counter() - started)
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"}
+    }}
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": str(user_id), "data": data,
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+        "message": {"message_id": 1, "date": int(time.time()), "text": "...", "chat": {"id": user_id, "type": "private"}}
+    }}
+
+
+class LoadTest:
+    def __init__(self, bot, dispatcher, api: FakeBotAPI):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.api = api
+        self.update_timings = []
+        self._update_id = 0
+
+    async def feed(self, raw: dict):
+        self._update_id += 1
+        raw["update_id"] = self._update_id
+        update = types.Update.model_validate(raw, context={"bot": self.bot})
+        started = time.perf_counter()
+        await self.dispatcher.feed_update(self.bot, update)
+        self.update_timings.append(time.perf_counter() - started)
+
+    async def user_session(self, user_id: int):
+        sign = astro.ZODIAC_SIGNS[user_id % len(astro.ZODIAC_SIGNS)]
+        for round_number in range(astro.DAILY_FREE_HOROSCOPES + 1):
+            await self.feed(message_update(0, user_id, "/start"))
+            await self.feed(message_update(0, user_id, sign))
+            await self.feed(callback_update(0, user_id, f"date_{astro.DATE_TYPES[round_number % len(astro.DATE_TYPES)]}"))
+            await self.feed(callback_update(0, user_id, f"type_{astro.HOROSCOPE_TYPES[user_id % len(astro.HOROSCOPE_TYPES)]}"))
+        payment_callback = self.api.payment_callbacks.get(user_id)
+        if payment_callback:
+            await self.feed(callback_update(0, user_id, payment_callback))
+
+    async def run(self, users: int, concurrency: int, first_user_id: int) -> float:
+        queue = asyncio.Queue()
+        for user_id in range(first_user_id, first_user_id + users):
+            queue.put_nowait(user_id)
+
+        async def worker():
+            while not queue.empty():
+                await self.user_session(queue.get_nowait())
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - started
+
+
+def percentiles(timings: list) -> dict:
+    timings = sorted(timings)
+    return {
+        f"p{p}": round(timings[min(len(timings) - 1, int(len(timings) * p / 100))] * 1000, 3)
+        for p in (50, 95, 99)
+    }
+
+
+def count_metric(name: str) -> int:
+    return sum(h.count for (metric, _), h in astro.metrics.histograms.items() if metric == name)
+
+
+def compare(result: dict, baseline: dict, tolerance: float, counts_only: bool = False) -> list:
+    """Метрики, которые хуже базовых больше чем на tolerance."""
+    regressions = []
+
+    def check(name, value, base, higher_is_better=False):
+        if not base:
+            return
+        change = (base - value) / base if higher_is_better else (value - base) / base
+        if change > tolerance:
+            regressions.append(f"{name}: {base} -> {value} ({change:+.0%})")
+
+    check("db_ops_per_update", result["db_ops_per_update"], baseline.get("db_ops_per_update"))
+    check("api_calls_per_update", result["api_calls_per_update"], baseline.get("api_calls_per_update"))
+    if counts_only:
+        return regressions
+    check("updates_per_sec", result["updates_per_sec"], baseline.get("updates_per_sec"), higher_is_better=True)
+    check("update p95", result["update_ms"]["p95"], baseline.get("update_ms", {}).get("p95"))
+    for handler, stats in result["handlers_ms"].items():
+        check(f"{handler} p95", stats["p95"], baseline.get("handlers_ms", {}).get(handler, {}).get("p95"))
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--api-latency", type=float, default=0, help="задержка ответа Bot API, мс")
+    parser.add_argument("--mongo-uri", help="реальный MongoDB вместо mongomock-motor")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="файл базового результата")
+    parser.add_argument("--save-baseline", action="store_true", help="записать результат в --baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="допустимое ухудшение, доля")
+    parser.add_argument("--counts-only", action="store_true",
+                        help="сравнивать с базовым только число операций MongoDB и запросов к Bot API")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    # Предупреждения на каждое обновление (например, об отсутствии ADSGRAM_API_KEY) искажают замер
+    logging.getLogger(astro.__name__).setLevel(logging.ERROR)
+    astro.MONGO_DB_NAME = "astro_benchmark"
+    if args.mongo_uri:
+        astro.MONGO_URI = args.mongo_uri
+    else:
+        import motor.motor_asyncio
+        from mongomock_motor import AsyncMongoMockClient
+        client = AsyncMongoMockClient()
+        # mongomock не умеет time-series коллекции - события пишутся в обычную
+        await client[astro.MONGO_DB_NAME].create_collection(astro.MONGO_EVENTS_COLLECTION_NAME)
+        motor.motor_asyncio.AsyncIOMotorClient = lambda *args, **kwargs: client
+    await astro.init_mongodb()
+    for name in (astro.MONGO_COLLECTION_NAME, astro.MONGO_PAYMENTS_COLLECTION_NAME, astro.MONGO_PAYMENT_CHECKS_COLLECTION_NAME,
+                 astro.MONGO_FSM_COLLECTION_NAME, astro.MONGO_EVENTS_COLLECTION_NAME):
+        await astro.db[name].delete_many({})
+
+    api = FakeBotAPI(args.api_latency / 1000)
+    bot = astro.get_bot()
+    bot.session.api = TelegramAPIServer.from_base(await api.start())
+    dispatcher = astro.get_dispatcher()
+    handler_timings = HandlerTimings()
+    dispatcher.message.middleware(handler_timings)
+    dispatcher.callback_query.middleware(handler_timings)
+    astro.user_writes.start()
+    astro.analytics.start()
+
+    test = LoadTest(bot, dispatcher, api)
+    # Прогрев: горячий кэш гороскопов дня, соединения с Bot API и MongoDB
+    await test.run(users=min(10, args.users), concurrency=1, first_user_id=10_000_000)
+    test.update_timings.clear()
+    handler_timings.timings.clear()
+    astro.metrics.reset()
+    api.requests = 0
+
+    elapsed = await test.run(args.users, args.concurrency, first_user_id=1)
+    await astro.user_writes.flush()
+    await astro.analytics.flush()
+    updates = len(test.update_timings)
+
+    result = {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "api_latency_ms": args.api_latency,
+        "mongo": "mongodb" if args.mongo_uri else "mongomock",
+        "updates": updates,
+        "updates_per_sec": round(updates / elapsed, 1),
+        "update_ms": percentiles(test.update_timings),
+        "handlers_ms": {name: percentiles(timings) for name, timings in sorted(handler_timings.timings.items())},
+        "db_ops_per_update": round(count_metric("astro_mongo_operation_seconds") / updates, 3),
+        "api_calls_per_update": round(api.requests / updates, 3),
+    }
+
+    await astro.user_writes.stop()
+    await astro.analytics.stop()
+    await bot.session.close()
+    await api.stop()
+    if args.mongo_uri:
+        await astro.mongo_client.drop_database(astro.MONGO_DB_NAME)
+    astro.close_mongodb()
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(f"Обновлений: {updates} за {elapsed:.2f} с, {result['updates_per_sec']} в секунду "
+              f"(пользователей {args.users}, параллельно {args.concurrency})")
+        print(f"Операций MongoDB на обновление: {result['db_ops_per_update']}, "
+              f"запросов к Bot API: {result['api_calls_per_update']}")
+        print(f"{'':<24}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+        for name, stats in [("обновление целиком", result["update_ms"]), *result["handlers_ms"].items()]:
+            print(f"{name:<24}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{stats['p99']:>10.3f}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Базовый результат сохранен в {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        mismatched = [name for name in RUN_PARAMETERS if baseline.get(name) != result[name]]
+        if mismatched:
+            print(f"Базовый результат {args.baseline} получен с другими параметрами: "
+                  + ", ".join(f"{name}={baseline.get(name)}" for name in mismatched))
+            sys.exit(2)
+        regressions = compare(result, baseline, args.tolerance, args.counts_only)
+        if regressions:
+            print(f"Ухудшения относительно {args.baseline}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        checked = "число запросов" if args.counts_only else "все метрики"
+        print(f"Ухудшений относительно {args.baseline} нет ({checked}, допуск {args.tolerance:.0%}).")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+"""
+Бенчмарк холодного старта: python -X importtime для import astro и время сборки бота.
+
+Каждый замер - отдельный процесс, как холодный старт функции на Vercel/Render.
+Печатает медиану по запускам и самые тяжелые модули по собственному времени импорта.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10 --top 15
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Этапы холодного старта: импорт модуля (так стартует api/cron.py), затем сборка бота и диспетчера
+PHASES = """
+import time
+started = time.perf_counter()
+import astro
+imported = time.perf_counter()
+astro.get_bot()
+astro.get_dispatcher()
+built = time.perf_counter()
+print(f"PHASES {imported - started} {built - imported}")
+"""
+
+
+def run_once(env: dict):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PHASES],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    phases = next(line for line in result.stdout.splitlines() if line.startswith("PHASES"))
+    import_s, build_s = map(float, phases.split()[1:])
+    return import_s, build_s, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", "123456:benchmark")
+    env.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+    runs = [run_once(env) for _ in range(args.runs)]
+    import_times = [run[0] for run in runs]
+    build_times = [run[1] for run in runs]
+    print(f"import astro:                    {statistics.median(import_times) * 1e3:8.1f} мс (медиана из {args.runs})")
+    print(f"get_bot() + get_dispatcher():    {statistics.median(build_times) * 1e3:8.1f} мс")
+
+    modules = runs[-1][2]
+    print("\nСамые тяжелые модули (собственное время, последний запуск):")
+    for name, (self_us, cumulative_us) in sorted(modules.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f"  {name:<50} {self_us / 1e3:8.1f} мс  (с зависимостями {cumulative_us / 1e3:8.1f} мс)")
+    for name in ("aiogram", "motor.motor_asyncio", "numpy", "dotenv"):
+        state = f"{modules[name][1] / 1e3:.1f} мс" if name in modules else "не импортируется"
+        print(f"  {name:<50} {state}")
+
+
+if __name__ == "__main__":
+    main()
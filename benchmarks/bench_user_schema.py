@@ -0,0 +1,95 @@
+"""
+Бенчмарк схемы документа пользователя: сколько байт BSON приходит от MongoDB на запрос
+и сколько стоит декодирование ответа - в прежней схеме и в компактной.
+
+Документы прежней схемы генерируются случайно, компактные получаются из них через
+compact_user (как при migrate-users). Размеры - тела документов ответа без заголовков OP_MSG.
+
+    python benchmarks/bench_user_schema.py
+    python benchmarks/bench_user_schema.py --users 100000 --repeat 5
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+import bson
+from bson import ObjectId
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+import astro
+
+
+def legacy_user(rng: random.Random, today: date) -> dict:
+    # Типичный документ прежней схемы после выбора знака по дате рождения и нескольких гороскопов
+    birth = date(1960, 1, 1) + timedelta(days=rng.randrange(365 * 45))
+    return {
+        "_id": ObjectId(),
+        "user_id": rng.randrange(10**8, 8 * 10**9),
+        "daily_horoscopes_given": rng.randrange(3),
+        "last_horoscope_date": (today - timedelta(days=rng.randrange(30))).isoformat(),
+        "sign": astro.get_zodiac_sign(birth.day, birth.month),
+        "birth_date": birth.isoformat(),
+    }
+
+
+def requests_for(legacy: dict) -> dict:
+    """Ответы MongoDB на запросы бота: {запрос: (прежняя схема, компактная схема)}."""
+    compact = {"_id": legacy["user_id"], **astro.compact_user(legacy)}
+    return {
+        # consume_free_horoscope: раньше find_one_and_update возвращал документ целиком
+        "проверка лимита": (legacy, {"_id": compact["_id"], **{
+            field: compact[field] for field in (astro.USER_QUOTA_DAY, astro.USER_QUOTA_USED) if field in compact
+        }}),
+        # get_user_data: find_one без проекции и с проекцией полей схемы
+        "чтение пользователя": (legacy, compact),
+        # рассылка: один документ курсора
+        "курсор рассылки": ({"user_id": legacy["user_id"]}, {"_id": compact["_id"]}),
+    }
+
+
+def decode_seconds(encoded: list, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for data in encoded:
+            bson.decode(data)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=3, help="повторов декодирования, берется лучший")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    today = date.fromisoformat(astro.today_key())
+    legacy_users = [legacy_user(rng, today) for _ in range(args.users)]
+    samples = [requests_for(legacy) for legacy in legacy_users]
+
+    print(f"{args.users} пользователей")
+    print(f"{'запрос':<22}{'байт было':>10}{'стало':>8}{'декодирование было, мкс':>26}{'стало':>8}")
+    for name in samples[0]:
+        before = [bson.encode(sample[name][0]) for sample in samples]
+        after = [bson.encode(sample[name][1]) for sample in samples]
+        bytes_before = sum(map(len, before)) / len(before)
+        bytes_after = sum(map(len, after)) / len(after)
+        decode_before = decode_seconds(before, args.repeat) / len(before) * 1e6
+        decode_after = decode_seconds(after, args.repeat) / len(after) * 1e6
+        print(f"{name:<22}{bytes_before:>10.1f}{bytes_after:>8.1f}{decode_before:>26.2f}{decode_after:>8.2f}")
+
+    stored_before = sum(len(bson.encode(legacy)) for legacy in legacy_users)
+    stored_after = sum(len(bson.encode({"_id": legacy["user_id"], **astro.compact_user(legacy)})) for legacy in legacy_users)
+    print(f"Хранение: {stored_before / args.users:.1f} -> {stored_after / args.users:.1f} байт на документ "
+          f"(без индекса user_id, который в компактной схеме совпадает с _id)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Бенчмарк определения знака зодиака: одна дата и миллион дат.
+
+Сравнивает прежнюю цепочку сравнений с таблицей по дню года и пакетным API
+(NumPy, если установлен, иначе array).
+
+    python benchmarks/bench_zodiac.py
+    python benchmarks/bench_zodiac.py --dates 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+import astro
+
+
+def legacy_zodiac_sign(day, month):
+    # Прежняя реализация из process_birth_date
+    if (month == 3 and day >= 21) or (month == 4 and day <= 19): return "♈ Овен"
+    if (month == 4 and day >= 20) or (month == 5 and day <= 20): return "♉ Телец"
+    if (month == 5 and day >= 21) or (month == 6 and day <= 20): return "♊ Близнецы"
+    if (month == 6 and day >= 21) or (month == 7 and day <= 22): return "♋ Рак"
+    if (month == 7 and day >= 23) or (month == 8 and day <= 22): return "♌ Лев"
+    if (month == 8 and day >= 23) or (month == 9 and day <= 22): return "♍ Дева"
+    if (month == 9 and day >= 23) or (month == 10 and day <= 22): return "♎ Весы"
+    if (month == 10 and day >= 23) or (month == 11 and day <= 21): return "♏ Скорпион"
+    if (month == 11 and day >= 22) or (month == 12 and day <= 21): return "♐ Стрелец"
+    if (month == 12 and day >= 22) or (month == 1 and day <= 19): return "♑ Козерог"
+    if (month == 1 and day >= 20) or (month == 2 and day <= 18): return "♒ Водолей"
+    if (month == 2 and day >= 19) or (month == 3 and day <= 20): return "♓ Рыбы"
+    return "Неизвестный знак"
+
+
+def check_table():
+    # Таблица должна совпадать с прежней логикой для каждого дня високосного года
+    day = date(2000, 1, 1)
+    while day.year == 2000:
+        assert astro.get_zodiac_sign(day.day, day.month) == legacy_zodiac_sign(day.day, day.month), day
+        day += timedelta(days=1)
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dates", type=int, default=1_000_000)
+    parser.add_argument("--single", type=int, default=200_000, help="повторов для одной даты")
+    args = parser.parse_args()
+
+    check_table()
+
+    worst_day, worst_month = 1, 2 # Водолей проверялся последним из 11 условий
+    elapsed, _ = timed(lambda: [legacy_zodiac_sign(worst_day, worst_month) for _ in range(args.single)])
+    print(f"одна дата, цепочка сравнений:   {elapsed / args.single * 1e9:8.0f} нс")
+    elapsed, _ = timed(lambda: [astro.get_zodiac_sign(worst_day, worst_month) for _ in range(args.single)])
+    print(f"одна дата, таблица по дню года: {elapsed / args.single * 1e9:8.0f} нс")
+
+    rng = random.Random(42)
+    birth_dates = [date(2000, 1, 1) + timedelta(days=rng.randrange(366)) for _ in range(args.dates)]
+    months = [birth_date.month for birth_date in birth_dates]
+    days = [birth_date.day for birth_date in birth_dates]
+
+    elapsed, expected = timed(lambda: [legacy_zodiac_sign(day, month) for month, day in zip(months, days)])
+    print(f"{args.dates} дат, цепочка сравнений:   {elapsed * 1e3:8.1f} мс")
+
+    numpy = astro.get_numpy()
+    if numpy is not None:
+        month_array, day_array = numpy.array(months), numpy.array(days)
+        elapsed, indices = timed(astro.get_zodiac_sign_indices, month_array, day_array)
+        print(f"{args.dates} дат, пакетно (NumPy):      {elapsed * 1e3:8.1f} мс")
+        assert [astro.ZODIAC_SIGNS[index] for index in indices] == expected
+
+    astro._numpy = False # как будто NumPy не установлен
+    elapsed, indices = timed(astro.get_zodiac_sign_indices, months, days)
+    astro._numpy = None
+    print(f"{args.dates} дат, пакетно (array):      {elapsed * 1e3:8.1f} мс")
+    assert [astro.ZODIAC_SIGNS[index] for index in indices] == expected
+
+
+if __name__ == "__main__":
+    main()
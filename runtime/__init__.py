@@ -0,0 +1,2 @@
+# Инфраструктура бота, не зависящая от его логики (метрики, хранилища, исходящие запросы и т. п.).
+# Настройки из окружения читает astro.py и передает сюда параметрами.
@@ -0,0 +1,112 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from pymongo.errors import DuplicateKeyError
+
+from runtime.metrics import metrics, timed_db
+
+
+class MongoStorage(BaseStorage):
+    """
+    FSM-хранилище aiogram в MongoDB.
+
+    Состояние и данные пользователя лежат в одном документе и всегда записываются вместе
+    одной операцией, брошенные сессии удаляются TTL-индексом по полю updated_at.
+
+    У документа есть версия v, запись проходит только при версии, с которой документ был прочитан.
+    Если документ за это время изменил другой инстанс, он перечитывается и изменение (состояние
+    или данные) применяется к свежему документу. Чтения обслуживаются локальным LRU-кэшем,
+    запись в кэше живет cache_ttl секунд и обновляется только после успешной записи в MongoDB.
+    cache_ttl=0 отключает кэш - так нужно, когда обновления одного чата приходят на разные инстансы.
+
+    get_collection - функция без аргументов, возвращающая коллекцию: клиент MongoDB может быть
+    создан позже хранилища (диспетчер собирается до init_mongodb).
+    """
+
+    def __init__(self, get_collection, cache_size: int = 10000, cache_ttl: float = 30):
+        self.get_collection = get_collection
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.cache: OrderedDict = OrderedDict()  # ключ -> (expires_at, (version, state, data))
+
+    @property
+    def collection(self):
+        return self.get_collection()
+
+    async def _load(self, key: StorageKey, fresh: bool = False):
+        document_id = self.key_builder.build(key)
+        entry = self.cache.get(document_id)
+        if entry is not None and not fresh:
+            if entry[0] >= time.monotonic():
+                self.cache.move_to_end(document_id)
+                return document_id, entry[1]
+            del self.cache[document_id]
+        document = await timed_db("fsm_load", self.collection.find_one(
+            {"_id": document_id}, projection={"v": 1, "state": 1, "data": 1}
+        ))
+        # Нет документа - версия 0
+        record = (document.get("v", 0), document.get("state"), document.get("data") or {}) if document else (0, None, {})
+        self._remember(document_id, record)
+        return document_id, record
+
+    def _remember(self, document_id: str, record: tuple):
+        if not self.cache_ttl or not self.cache_size:
+            return
+        self.cache[document_id] = (time.monotonic() + self.cache_ttl, record)
+        self.cache.move_to_end(document_id)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def _save(self, document_id: str, version: int, state, data: dict) -> bool:
+        """Записывает документ, если его версия все еще version. False - документ изменил кто-то другой."""
+        # Документы без версии (записанные до ее появления) считаются версией 0
+        current = {"_id": document_id, "v": version if version else {"$in": [None, 0]}}
+        if state is None and not data:
+            # Пустую сессию не храним. Ничего не удалено - конфликт, если документ все же есть
+            result = await timed_db("fsm_delete", self.collection.delete_one(current))
+            if not result.deleted_count and (version or await timed_db("fsm_load", self.collection.find_one(
+                    {"_id": document_id}, projection={"_id": 1}))):
+                return False
+            self._remember(document_id, (0, None, {}))
+            return True
+        try:
+            await timed_db("fsm_save", self.collection.update_one(
+                current,
+                {"$set": {"v": version + 1, "state": state, "data": data, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True
+            ))
+        except DuplicateKeyError:
+            return False # Документ есть, но с другой версией: upsert попытался создать второй
+        self._remember(document_id, (version + 1, state, data))
+        return True
+
+    async def _update(self, key: StorageKey, change):
+        """Применяет change((state, data)) -> (state, data) к документу, перечитывая его при конфликте версий."""
+        document_id, (version, state, data) = await self._load(key)
+        while not await self._save(document_id, version, *change(state, data)):
+            metrics.inc("astro_fsm_conflicts_total")
+            document_id, (version, state, data) = await self._load(key, fresh=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self._update(key, lambda _, data: (state, data))
+
+    async def get_state(self, key: StorageKey):
+        _, (_, state, _) = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        data = data.copy()
+        await self._update(key, lambda state, _: (state, data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        _, (_, _, data) = await self._load(key)
+        return data.copy()
+
+    async def close(self) -> None:
+        # Клиентом MongoDB владеет astro, он закрывается в on_shutdown
+        self.cache.clear()
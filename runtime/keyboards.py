@@ -0,0 +1,47 @@
+import json
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+
+class KeyboardRegistry:
+    """
+    Статические клавиатуры: строятся один раз при первом запросе и больше не меняются
+    (объекты aiogram неизменяемы). Для каждой заранее готов JSON, который StaticKeyboardMiddleware
+    подставляет в запрос вместо повторной сериализации.
+    """
+
+    def __init__(self):
+        self.markups = {}  # имя -> markup
+        self.payloads = {}  # id(markup) -> (markup, json)
+
+    def get(self, name: str, build):
+        markup = self.markups.get(name)
+        if markup is None:
+            markup = self.markups[name] = self.register(build())
+        return markup
+
+    def register(self, markup):
+        # Сам объект храним рядом с JSON, чтобы id не переиспользовался другим объектом
+        self.payloads[id(markup)] = (markup, json.dumps(markup.model_dump(exclude_none=True)))
+        return markup
+
+    def payload(self, markup):
+        entry = self.payloads.get(id(markup))
+        return entry[1] if entry is not None and entry[0] is markup else None
+
+
+class StaticKeyboardMiddleware(BaseRequestMiddleware):
+    """
+    Подставляет в запрос готовый JSON статической клавиатуры из KeyboardRegistry.
+    Сессия отправляет строковые значения как есть, поэтому клавиатура не сериализуется заново.
+    """
+
+    def __init__(self, registry: KeyboardRegistry):
+        self.registry = registry
+
+    async def __call__(self, make_request, bot, method):
+        payload = self.registry.payload(getattr(method, "reply_markup", None))
+        if payload is not None:
+            # Копия без валидации: в поле клавиатуры вместо объекта лежит ее JSON
+            method = method.model_copy(update={"reply_markup": payload})
+        return await make_request(bot, method)
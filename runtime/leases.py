@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор процесса для аренд (lease) в MongoDB
+INSTANCE_ID = f"{os.getenv('HOSTNAME', 'local')}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def lease_is_free(now: datetime, owner: str) -> dict:
+    """Условие на документ аренды: она истекла, еще не выдавалась или уже принадлежит owner."""
+    return {"$or": [{"lease_until": {"$not": {"$gt": now}}}, {"lease_owner": owner}]}
+
+async def acquire_lease(collection, lease_id: str, owner: str, seconds: float) -> bool:
+    """Берет или продлевает аренду документа lease_id. False, если она занята другим владельцем."""
+    now = datetime.now(timezone.utc)
+    try:
+        await collection.update_one(
+            {"_id": lease_id, **lease_is_free(now, owner)},
+            {"$set": {"lease_owner": owner, "lease_until": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False # Документ есть, но аренда чужая и еще действует
+    return True
+
+async def release_lease(collection, lease_id: str, owner: str):
+    await collection.update_one({"_id": lease_id, "lease_owner": owner}, {"$set": {"lease_until": None}})
+
+
+class LeaderLease:
+    """
+    Лидерство через аренду в collection (коллекция meta): лидер роли - процесс, который продлевает
+    аренду leader:<role>. run(job) ждет лидерства, выполняет job и отменяет ее, если аренда потеряна.
+    """
+
+    def __init__(self, collection, role: str, seconds: float):
+        self.collection = collection
+        self.lease_id = f"leader:{role}"
+        self.seconds = seconds
+
+    async def _renew(self) -> bool:
+        return await acquire_lease(self.collection, self.lease_id, INSTANCE_ID, self.seconds)
+
+    async def run(self, job):
+        """job - функция без аргументов, возвращающая корутину. Возвращает результат job."""
+        while True:
+            try:
+                elected = await self._renew()
+            except Exception as e:
+                logger.warning(f"Не удалось получить {self.lease_id}: {e}")
+                elected = False
+            if not elected:
+                await asyncio.sleep(self.seconds / 3)
+                continue
+
+            logger.info(f"Процесс {INSTANCE_ID} стал лидером {self.lease_id}.")
+            task = asyncio.create_task(job())
+            try:
+                if await self._hold(task):
+                    return task.result()
+            finally:
+                if not task.done():
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                await release_lease(self.collection, self.lease_id, INSTANCE_ID)
+            logger.warning(f"Аренда {self.lease_id} потеряна, задача лидера остановлена.")
+
+    async def _hold(self, task: asyncio.Task) -> bool:
+        """Продлевает аренду, пока идет task. True - task завершилась, False - аренда потеряна."""
+        held_until = time.monotonic() + self.seconds
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=self.seconds / 3)
+            if done:
+                return True
+            try:
+                if not await self._renew():
+                    return False
+                held_until = time.monotonic() + self.seconds
+            except Exception as e:
+                # Сбой MongoDB: аренда еще наша до held_until, пробуем снова на следующем круге
+                logger.warning(f"Не удалось продлить {self.lease_id}: {e}")
+                if time.monotonic() >= held_until - self.seconds / 3:
+                    return False
@@ -0,0 +1,223 @@
+import logging
+import time
+from bisect import bisect_left
+
+from aiogram import BaseMiddleware, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Все измерения - это perf_counter и инкремент счетчика в памяти процесса (единицы микросекунд),
+# поэтому метрики включены всегда. Текст в формате Prometheus собирается только при запросе /metrics.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRIC_HELP = {
+    "astro_update_seconds": ("histogram", "Время обработки обновления целиком, включая FSM и middleware."),
+    "astro_handler_seconds": ("histogram", "Время работы хендлера."),
+    "astro_handler_errors_total": ("counter", "Исключения в хендлерах."),
+    "astro_mongo_operation_seconds": ("histogram", "Время операций MongoDB."),
+    "astro_mongo_errors_total": ("counter", "Ошибки операций MongoDB."),
+    "astro_telegram_request_seconds": ("histogram", "Время запросов к Bot API."),
+    "astro_telegram_errors_total": ("counter", "Ошибки запросов к Bot API."),
+    "astro_telegram_flood_waits_total": ("counter", "Ответы RetryAfter от Bot API."),
+    "astro_telegram_edits_coalesced_total": ("counter", "Правки сообщений, замененные более новой правкой до отправки."),
+    "astro_outbound_chats": ("gauge", "Чатов с запросами в очереди исходящих."),
+    "astro_update_queue_depth": ("gauge", "Обновлений в очередях полос вебхука."),
+    "astro_user_writes_pending": ("gauge", "Пользователей с незаписанными изменениями."),
+    "astro_payments_pending": ("gauge", "Групп заказов, ожидающих проверки оплаты."),
+    "astro_user_cache_size": ("gauge", "Пользователей в локальном кэше."),
+    "astro_throttled_total": ("counter", "Обновления, отброшенные защитой от флуда."),
+    "astro_throttle_buckets": ("gauge", "Корзин защиты от флуда в памяти."),
+    "astro_events_pending": ("gauge", "Событий аналитики в буфере, еще не записанных в MongoDB."),
+    "astro_events_dropped_total": ("counter", "События аналитики, вытесненные из переполненного буфера."),
+}
+
+
+class Histogram:
+    """Гистограмма длительностей с фиксированными корзинами LATENCY_BUCKETS (как histogram в Prometheus)."""
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # последняя корзина - +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по корзинам (верхняя граница корзины, в которую он попал)."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """
+    Метрики процесса: гистограммы и счетчики по имени и меткам, gauge-функции,
+    которые вызываются в момент сбора. Метки - кортеж пар (имя, значение).
+    Снимки метрик процессов-воркеров (WorkerPool) складываются с метриками этого процесса при сборе.
+    """
+
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> число
+        self.gauges = {}  # name -> функция без аргументов
+        self.workers = {}  # номер воркера -> последний снимок его метрик
+
+    def observe(self, name: str, labels: tuple, value: float):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, labels: tuple = (), value: int = 1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, func):
+        self.gauges[name] = func
+
+    def reset(self):
+        self.histograms.clear()
+        self.counters.clear()
+        self.workers.clear()
+
+    def snapshot(self) -> dict:
+        """Значения метрик процесса для передачи через multiprocessing: gauge вычисляются сразу."""
+        gauges = {}
+        for name, func in self.gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                logger.error(f"Ошибка при чтении метрики {name}: {e}")
+        return {
+            "histograms": {key: (list(h.counts), h.total, h.count) for key, h in self.histograms.items()},
+            "counters": dict(self.counters),
+            "gauges": gauges,
+        }
+
+    def collect(self) -> dict:
+        """Снимок этого процесса, сложенный со снимками воркеров: счетчики, корзины и gauge суммируются."""
+        merged = self.snapshot()
+        for worker in self.workers.values():
+            for key, (counts, total, count) in worker["histograms"].items():
+                current = merged["histograms"].get(key)
+                if current is None:
+                    merged["histograms"][key] = (list(counts), total, count)
+                else:
+                    merged["histograms"][key] = (
+                        [a + b for a, b in zip(current[0], counts)], current[1] + total, current[2] + count,
+                    )
+            for section in ("counters", "gauges"):
+                for key, value in worker[section].items():
+                    merged[section][key] = merged[section].get(key, 0) + value
+        return merged
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus (text/plain; version=0.0.4)."""
+        merged = self.collect()
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                kind, help_text = METRIC_HELP.get(name, ("untyped", name))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), (counts, total, count) in sorted(merged["histograms"].items()):
+            describe(name)
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        for (name, labels), value in sorted(merged["counters"].items()):
+            describe(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name, value in sorted(merged["gauges"].items()):
+            describe(name)
+            lines.append(f"{name} {value}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = (
+        f'{key}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for key, value in labels
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+metrics = MetricsRegistry()
+
+async def timed_db(operation: str, awaitable):
+    """Ждет операцию MongoDB и записывает ее длительность в astro_mongo_operation_seconds."""
+    labels = (("operation", operation),)
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    except Exception:
+        metrics.inc("astro_mongo_errors_total", labels)
+        raise
+    finally:
+        metrics.observe("astro_mongo_operation_seconds", labels, time.perf_counter() - started)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer-middleware на update: полное время обработки обновления по типу события."""
+
+    async def __call__(self, handler, event: types.Update, data: dict):
+        try:
+            labels = (("event", event.event_type),)
+        except Exception:
+            labels = (("event", "unknown"),)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.observe("astro_update_seconds", labels, time.perf_counter() - started)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: время работы каждого хендлера и число исключений в нем."""
+
+    async def __call__(self, handler, event, data: dict):
+        labels = (("handler", data["handler"].callback.__name__),)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("astro_handler_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("astro_handler_seconds", labels, time.perf_counter() - started)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: длительность и ошибки каждого запроса к Bot API по методу."""
+
+    async def __call__(self, make_request, bot, method):
+        labels = (("method", method.__api_method__),)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("astro_telegram_errors_total", labels + (("error", type(e).__name__),))
+            raise
+        finally:
+            metrics.observe("astro_telegram_request_seconds", labels, time.perf_counter() - started)
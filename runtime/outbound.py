@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
+from aiogram.methods import EditMessageCaption, EditMessageReplyMarkup, EditMessageText
+
+from runtime.metrics import metrics
+from runtime.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundDispatcher(BaseRequestMiddleware):
+    """
+    Слой исходящих запросов к Bot API (middleware сессии бота).
+
+    - Запросы без чата (answerCallbackQuery, служебные методы) идут сразу, вне очередей и лимита.
+    - Запросы в один чат выполняются строго по порядку, разные чаты - параллельно.
+    - Правки одного сообщения, еще ждущие своей очереди, склеиваются: уходит только последняя,
+      все ожидающие получают ее результат. Отмена одного из них не отменяет правку для остальных.
+    - Повторы запросов есть только здесь. После RetryAfter запросы в чаты ставятся на паузу
+      на retry_after секунд, после сетевой ошибки запрос ждет 1, 2, 4... секунды; всего не больше
+      max_retries повторов. При rate > 0 запросы в чаты еще и ограничены rate в секунду.
+    """
+
+    COALESCED_METHODS = (EditMessageText, EditMessageReplyMarkup, EditMessageCaption)
+
+    def __init__(self, rate: float, max_retries: int):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.paused_until = 0.0
+        self.max_retries = max_retries
+        self.chats = {}  # chat_id -> [asyncio.Lock, число запросов в очереди]
+        self.pending_edits = {}  # (метод, chat_id, message_id) -> [method, future результата, число вызвавших]
+        metrics.gauge("astro_outbound_chats", lambda: len(self.chats))
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await self._send(make_request, bot, method, limited=False)
+
+        edit_key = pending = None
+        if isinstance(method, self.COALESCED_METHODS) and method.message_id is not None:
+            edit_key = (type(method), chat_id, method.message_id)
+            pending = self.pending_edits.get(edit_key)
+            if pending is None:
+                pending = self.pending_edits[edit_key] = [method, asyncio.get_running_loop().create_future(), 0]
+            else:
+                # Предыдущая правка еще не отправлена - отправится эта, вместо нее
+                metrics.inc("astro_telegram_edits_coalesced_total")
+                pending[0] = method
+            pending[2] += 1
+
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = [asyncio.Lock(), 0]
+        chat[1] += 1
+        try:
+            async with chat[0]:
+                if pending is None:
+                    return await self._send(make_request, bot, method, limited=True)
+                result = pending[1]
+                if not result.done():
+                    # Склеенные вызвавшие стоят в очереди чата каждый сам за себя: правку отправляет первый
+                    # дошедший, остальные берут готовый результат. Если отправителя отменили (в очереди
+                    # или во время запроса), правку отправит следующий из них, а не отменятся все разом.
+                    if self.pending_edits.get(edit_key) is pending:
+                        # Дальше правки этого сообщения копятся в новой записи, эта уже не меняется
+                        del self.pending_edits[edit_key]
+                    try:
+                        result.set_result(await self._send(make_request, bot, pending[0], limited=True))
+                    except Exception as e:
+                        result.set_exception(e)
+                return result.result()
+        finally:
+            chat[1] -= 1
+            if not chat[1]:
+                del self.chats[chat_id]
+            if pending is not None:
+                pending[2] -= 1
+                if not pending[2] and self.pending_edits.get(edit_key) is pending:
+                    # Все вызвавшие отменены до отправки - правка никому не нужна
+                    del self.pending_edits[edit_key]
+
+    async def _send(self, make_request, bot, method, limited: bool):
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                delay = self.paused_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self.bucket is not None:
+                    await self.bucket.acquire()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                metrics.inc("astro_telegram_flood_waits_total")
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Flood control на {method.__api_method__}: ждем {e.retry_after} с.")
+                # Flood control в Telegram считается на бота целиком, поэтому тормозим все чаты
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                if not limited:
+                    await asyncio.sleep(e.retry_after)
+            except TelegramNetworkError as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Сетевая ошибка на {method.__api_method__} (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
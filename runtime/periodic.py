@@ -0,0 +1,49 @@
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicFlusher(ABC):
+    """
+    Основа буферов, которые сбрасываются в фоне: run вызывает flush раз в flush_interval секунд,
+    flush_soon запускает сброс сразу (например, по порогу размера буфера), не больше одного одновременно.
+    stop останавливает фоновую задачу, дожидается начатых сбросов и сбрасывает остаток.
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._task = None
+        self._flush_tasks = set()
+
+    @abstractmethod
+    async def flush(self):
+        """Один сброс. Ошибки записи наследник обрабатывает сам, run только логирует непойманные."""
+
+    def flush_soon(self):
+        if self._flush_tasks:
+            return
+        task = asyncio.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фонового сброса {type(self).__name__}: {e}", exc_info=True)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+        await self.flush()
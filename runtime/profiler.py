@@ -0,0 +1,70 @@
+import logging
+import os
+import signal
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """
+    Семплирующий профайлер для продакшена.
+
+    Таймер ITIMER_PROF раз в interval секунд процессорного времени присылает SIGPROF, обработчик
+    запоминает стек, который выполнялся в этот момент. Ожидание ввода-вывода в select не тратит
+    процессорное время и не семплируется, поэтому отчет показывает, на что уходит CPU event loop.
+    Работает на Unix в основном потоке. Отчет - в формате folded stacks (flamegraph.pl, speedscope):
+    "f1;f2;f3 <число семплов>".
+    """
+
+    def __init__(self, interval: float, max_depth: int = 64, max_stacks: int = 10000):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+        self.stacks = Counter()
+        self.samples = 0
+        self.running = False
+        self._frame_names = {}  # code -> "функция (файл:строка)"
+        self._previous_handler = None
+
+    def start(self):
+        if self.running:
+            return
+        if not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+            logger.warning("Профайлер доступен только в основном потоке на Unix, он не будет запущен.")
+            return
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+        logger.info(f"Профайлер запущен, интервал {self.interval} с.")
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        self.running = False
+
+    def reset(self):
+        self.stacks.clear()
+        self.samples = 0
+
+    def _frame_name(self, code) -> str:
+        name = self._frame_names.get(code)
+        if name is None:
+            name = self._frame_names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return name
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            stack.append(self._frame_name(frame.f_code))
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        if key in self.stacks or len(self.stacks) < self.max_stacks:
+            self.stacks[key] += 1
+        self.samples += 1
+
+    def report(self, limit: int = None) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common(limit))
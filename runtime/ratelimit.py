@@ -0,0 +1,61 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, в запасе не более capacity."""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def pause(self, seconds: float):
+        # Telegram попросил подождать (RetryAfter) - никто не берет токены до истечения паузы
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SendRateLimiter:
+    """Глобальный лимит бота плюс лимит на каждый чат (хранится только для недавних чатов)."""
+
+    def __init__(self, rate: float, chat_rate: float, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.max_chats = max_chats
+        self.chat_buckets: OrderedDict = OrderedDict()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+            if len(self.chat_buckets) > self.max_chats:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def acquire(self, chat_id: int):
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    def pause(self, chat_id: int, seconds: float):
+        # Flood control в Telegram считается на бота целиком, поэтому тормозим всех
+        self._chat_bucket(chat_id).pause(seconds)
+        self.global_bucket.pause(seconds)
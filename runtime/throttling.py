@@ -0,0 +1,112 @@
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware, types
+from aiogram.dispatcher.flags import get_flag
+
+from runtime.metrics import metrics
+
+# Лишние обновления одного пользователя отбрасываются до хендлера: до чтения пользователя
+# из MongoDB, записей и запросов к Bot API. Проверка - арифметика над одним объектом в памяти.
+# Общий лимит пользователя проверяет outer-middleware UpdateThrottlingMiddleware еще до загрузки
+# состояния FSM, отдельные лимиты хендлеров - inner-middleware ThrottlingMiddleware.
+
+def parse_throttle_limits(value: str) -> dict:
+    """'cmd_start=0.2/3,check_payment=0.5/2' -> {'cmd_start': (0.2, 3.0), 'check_payment': (0.5, 2.0)}"""
+    limits = {}
+    for item in value.split(","):
+        name, _, limit = item.strip().partition("=")
+        if limit:
+            rate, _, burst = limit.partition("/")
+            limits[name.strip()] = (float(rate), float(burst or 1))
+    return limits
+
+
+class ThrottleBucket:
+    """Token bucket одного пользователя для одного лимита (rate и burst хранит ThrottlingMiddleware)."""
+    __slots__ = ("tokens", "updated", "notified")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.notified = False
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Inner-middleware: лимиты обновлений пользователя для отдельных хендлеров.
+
+    Лимит хендлера задается флагом throttle=(rate, burst) при регистрации или переменной
+    THROTTLE_LIMITS по имени хендлера. Общий лимит пользователя rate/burst (THROTTLE_RATE/THROTTLE_BURST)
+    на все обновления проверяет UpdateThrottlingMiddleware, корзины у них общие и хранятся в LRU
+    на max_users записей. На первое отброшенное нажатие кнопки пользователь получает подсказку,
+    остальные отбрасываются молча, пока в корзине не появится токен.
+    """
+
+    def __init__(self, rate: float, burst: float, max_users: int, limits: dict = None):
+        self.default = (rate, burst)
+        self.max_users = max_users
+        self.limits = limits or {}
+        self.buckets: OrderedDict = OrderedDict()  # (user_id, лимит) -> ThrottleBucket
+
+    def allow(self, user_id: int, name: str, rate: float, burst: float) -> ThrottleBucket:
+        """Списывает токен. Возвращает None, если обновление проходит, иначе корзину пользователя."""
+        key = (user_id, name)
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = ThrottleBucket(burst - 1, now)
+            if len(self.buckets) > self.max_users:
+                self.buckets.popitem(last=False)
+            return None
+        self.buckets.move_to_end(key)
+        bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+        bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.notified = False
+            return None
+        return bucket
+
+    async def reject(self, bucket: ThrottleBucket, event, name: str):
+        metrics.inc("astro_throttled_total", (("handler", name),))
+        if not bucket.notified:
+            bucket.notified = True
+            if isinstance(event, types.CallbackQuery):
+                # Иначе у пользователя будут крутиться часики на кнопке
+                await event.answer("Слишком часто. Подождите немного.")
+
+    async def __call__(self, handler, event, data: dict):
+        user = data.get("event_from_user")
+        handler_name = data["handler"].callback.__name__
+        limit = self.limits.get(handler_name) or get_flag(data, "throttle")
+        if user is None or limit is None:
+            return await handler(event, data)
+        rate, burst = limit
+        bucket = self.allow(user.id, handler_name, rate, burst) if rate > 0 else None
+        if bucket is None:
+            return await handler(event, data)
+        await self.reject(bucket, event, handler_name)
+        return None
+
+
+class UpdateThrottlingMiddleware(BaseMiddleware):
+    """
+    Outer-middleware на update: общий лимит пользователя на все обновления.
+
+    Регистрируется до FSM-middleware диспетчера, поэтому отброшенное обновление не стоит ни чтения
+    состояния FSM, ни поиска хендлера. Лимит и корзины - у ThrottlingMiddleware (корзина "default").
+    """
+
+    def __init__(self, throttling: ThrottlingMiddleware):
+        self.throttling = throttling
+
+    async def __call__(self, handler, event: types.Update, data: dict):
+        user = data.get("event_from_user")
+        rate, burst = self.throttling.default
+        bucket = self.throttling.allow(user.id, "default", rate, burst) if user is not None and rate > 0 else None
+        if bucket is None:
+            return await handler(event, data)
+        # Хендлер еще не выбран: в метриках такие обновления идут под именем update
+        await self.throttling.reject(bucket, event.callback_query, "update")
+        return None
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import multiprocessing
+from queue import Empty, Full
+
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.methods import GetUpdates, TelegramMethod
+
+from runtime.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Все обновления одного чата попадают в один процесс (реплика -> воркер -> полоса), поэтому
+# локальные кэши пользователей и FSM остаются верными. Общее состояние (FSM, квоты, оплаты,
+# рассылка) хранится в MongoDB.
+
+REPLICA_SEED = 1
+WORKER_SEED = 2
+
+
+def update_chat_id(update: dict) -> int:
+    """Чат, к которому относится сырое обновление Telegram (для вебхука и шардирования)."""
+    for field, value in update.items():
+        if field == "update_id" or not isinstance(value, dict):
+            continue
+        if "chat" in value:
+            return value["chat"]["id"]
+        if isinstance(value.get("message"), dict) and "chat" in value["message"]:
+            return value["message"]["chat"]["id"]
+        if "from" in value:
+            return value["from"]["id"]
+        if "user" in value:
+            return value["user"]["id"]
+    return update.get("update_id", 0)
+
+
+class UpdateLanes:
+    """
+    Ограниченный пул обработки обновлений.
+
+    Обновление попадает в полосу по chat_id: внутри чата порядок сохраняется,
+    разные чаты обрабатываются параллельно. Очередь каждой полосы ограничена,
+    при переполнении put() ждет не дольше enqueue_timeout и возвращает False.
+    """
+
+    def __init__(self, lanes: int, lane_size: int, enqueue_timeout: float):
+        self.lanes = [asyncio.Queue(maxsize=lane_size) for _ in range(lanes)]
+        self.enqueue_timeout = enqueue_timeout
+        self._workers = []
+
+    def depth(self) -> int:
+        return sum(lane.qsize() for lane in self.lanes)
+
+    async def put(self, update: dict) -> bool:
+        lane = self.lanes[update_chat_id(update) % len(self.lanes)]
+        try:
+            await asyncio.wait_for(lane.put(update), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _process(self, lane: asyncio.Queue, bot, dispatcher, **kwargs):
+        while True:
+            update = await lane.get()
+            try:
+                result = await dispatcher.feed_raw_update(bot=bot, update=update, **kwargs)
+                if isinstance(result, TelegramMethod):
+                    await dispatcher.silent_call_request(bot=bot, result=result)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке обновления {update.get('update_id')}: {e}", exc_info=True)
+            finally:
+                lane.task_done()
+
+    def start(self, bot, dispatcher, **kwargs):
+        metrics.gauge("astro_update_queue_depth", self.depth)
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._process(lane, bot, dispatcher, **kwargs)) for lane in self.lanes]
+
+    async def stop(self):
+        # Дожидаемся уже принятых обновлений: Telegram их повторно не пришлет
+        await asyncio.gather(*(lane.join() for lane in self.lanes))
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+def chat_shard(chat_id: int, shards: int, seed: int) -> int:
+    """
+    Номер шарда чата. Хеш (splitmix64) с разным seed для реплик и воркеров: при простом
+    chat_id % N на обоих уровнях, например, 2 реплики и 2 воркера, каждой реплике достались бы
+    только четные или только нечетные чаты, и все они попали бы в один воркер.
+    """
+    x = (chat_id + seed * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return (x ^ (x >> 31)) % shards
+
+
+class WorkerPool:
+    """
+    Обработка обновлений в нескольких процессах. Обновление уходит в процесс по хешу чата
+    через multiprocessing-очередь, внутри процесса - в его UpdateLanes.
+    Интерфейс put/start/stop/depth тот же, что у UpdateLanes.
+
+    target(index, updates, reports) - точка входа процесса-воркера, функция уровня модуля
+    (процессы запускаются через spawn). Воркер берет обновления из очереди updates до None
+    и присылает снимки своих метрик через reports (report_metrics), они попадают в metrics.workers.
+    """
+
+    def __init__(self, target, workers: int, queue_size: int):
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.reports = context.Queue()
+        self.processes = [
+            context.Process(target=target, args=(index, updates, self.reports), name=f"astro-worker-{index}")
+            for index, updates in enumerate(self.queues)
+        ]
+        self._collector = None
+
+    def depth(self) -> int:
+        return sum(updates.qsize() for updates in self.queues)
+
+    async def put(self, update: dict) -> bool:
+        updates = self.queues[chat_shard(update_chat_id(update), len(self.queues), WORKER_SEED)]
+        try:
+            updates.put_nowait(update)
+        except Full:
+            return False
+        return True
+
+    def start(self, bot=None, dispatcher=None, **kwargs):
+        # Бот и диспетчер у каждого воркера свои
+        metrics.gauge("astro_update_queue_depth", self.depth)
+        for process in self.processes:
+            if not process.is_alive() and process.exitcode is None:
+                process.start()
+        if self._collector is None:
+            self._collector = asyncio.create_task(self._collect_metrics())
+        logger.info(f"Запущено воркеров: {len(self.processes)}.")
+
+    async def _collect_metrics(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                report = await loop.run_in_executor(None, self.reports.get, True, 1)
+            except Empty:
+                continue
+            if report is None:
+                break
+            index, snapshot = report
+            metrics.workers[index] = snapshot
+
+    async def stop(self):
+        # None - сигнал воркеру дообработать очередь и завершиться
+        loop = asyncio.get_running_loop()
+        for updates in self.queues:
+            await loop.run_in_executor(None, updates.put, None)
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join)
+        if self._collector is not None:
+            # Последние снимки воркеров уже в очереди, None после них завершает сборщик
+            await loop.run_in_executor(None, self.reports.put, None)
+            await self._collector
+            self._collector = None
+
+
+async def report_metrics(index: int, reports, interval: float):
+    """Фоновая задача воркера WorkerPool: раз в interval секунд отправляет снимок метрик процесса."""
+    while True:
+        await asyncio.sleep(interval)
+        reports.put_nowait((index, metrics.snapshot()))
+
+
+async def poll_updates(bot, dispatcher, pool: WorkerPool, polling_timeout: int = 30):
+    """Long-polling, который не обрабатывает обновления сам, а раздает их воркерам пула."""
+    offset = None
+    allowed_updates = dispatcher.resolve_used_update_types()
+    while True:
+        try:
+            updates = await bot(
+                GetUpdates(offset=offset, timeout=polling_timeout, allowed_updates=allowed_updates),
+                request_timeout=int(bot.session.timeout + polling_timeout)
+            )
+        except TelegramNetworkError as e:
+            logger.warning(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            raw = update.model_dump(mode="json", exclude_unset=True, by_alias=True)
+            while not await pool.put(raw):
+                await asyncio.sleep(0.1) # Воркер не успевает - не забираем новые обновления
+            offset = update.update_id + 1
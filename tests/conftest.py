@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+import astro
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """
+    mongomock-motor вместо MongoDB: коллекции модуля astro указывают на пустую базу,
+    кэш и буфер записей пользователей - новые для каждого теста.
+    """
+    from mongomock_motor import AsyncMongoMockClient
+
+    db = AsyncMongoMockClient()[astro.MONGO_DB_NAME]
+    monkeypatch.setattr(astro, "db", db)
+    monkeypatch.setattr(astro, "users_collection", db[astro.MONGO_COLLECTION_NAME])
+    monkeypatch.setattr(astro, "broadcasts_collection", db[astro.MONGO_BROADCASTS_COLLECTION_NAME])
+    monkeypatch.setattr(astro, "horoscopes_collection", db[astro.MONGO_HOROSCOPES_COLLECTION_NAME])
+    monkeypatch.setattr(astro, "payments_collection", db[astro.MONGO_PAYMENTS_COLLECTION_NAME])
+    monkeypatch.setattr(astro, "user_cache", astro.UserCache(astro.USER_CACHE_SIZE, astro.USER_CACHE_TTL))
+    monkeypatch.setattr(astro, "user_writes", astro.UserWriteBuffer(
+        astro.USER_WRITE_FLUSH_INTERVAL, astro.USER_WRITE_FLUSH_THRESHOLD
+    ))
+    monkeypatch.setattr(astro, "_indexes_ready", False)
+
+    async def ensure_events_collection():
+        pass # mongomock не умеет time-series коллекции
+
+    monkeypatch.setattr(astro, "ensure_events_collection", ensure_events_collection)
+    return db
@@ -0,0 +1,70 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+
+import astro
+
+
+class CountingCollection:
+    """Коллекция FSM, которая считает чтения find_one."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.reads = 0
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def find_one(self, *args, **kwargs):
+        self.reads += 1
+        return self.collection.find_one(*args, **kwargs)
+
+
+def _run_handler(mongo, monkeypatch, raw_state, handler):
+    analytics = astro.EventBuffer(100, 60, 1000)
+    monkeypatch.setattr(astro, "analytics", analytics)
+    collection = CountingCollection(mongo[astro.MONGO_FSM_COLLECTION_NAME])
+    storage = astro.MongoStorage(lambda: collection, cache_ttl=0) # Как на Vercel
+    key = StorageKey(bot_id=1, chat_id=3, user_id=3)
+
+    async def scenario():
+        await storage.set_state(key, raw_state)
+        collection.reads = 0
+        data = {"state": FSMContext(storage, key), "raw_state": raw_state, "handler": SimpleNamespace(callback=handler)}
+        await astro.FSMTransitionMiddleware()(handler, None, data)
+        return collection.reads
+
+    reads = asyncio.run(scenario())
+    return reads, [event["meta"] for event in analytics.events]
+
+
+def test_transition_is_recorded_without_reading_state_back(mongo, monkeypatch):
+    async def choose_date(event, data):
+        await data["state"].set_state(astro.UserState.choosing_date)
+
+    reads, events = _run_handler(mongo, monkeypatch, astro.UserState.choosing_sign.state, choose_date)
+    assert events == [{
+        "event": "fsm_transition", "handler": "choose_date",
+        "before": astro.UserState.choosing_sign.state, "after": astro.UserState.choosing_date.state,
+    }]
+    assert reads == 1 # Только чтение в set_state перед записью
+
+
+def test_clear_is_a_transition_and_unchanged_state_is_not(mongo, monkeypatch):
+    async def finish(event, data):
+        await data["state"].clear()
+
+    async def stay(event, data):
+        await data["state"].set_state(astro.UserState.choosing_sign)
+
+    async def read_only(event, data):
+        pass
+
+    sign = astro.UserState.choosing_sign.state
+    assert _run_handler(mongo, monkeypatch, sign, finish)[1] == [
+        {"event": "fsm_transition", "handler": "finish", "before": sign, "after": None}
+    ]
+    assert _run_handler(mongo, monkeypatch, sign, stay)[1] == []
+    assert _run_handler(mongo, monkeypatch, sign, read_only) == (0, [])
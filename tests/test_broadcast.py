@@ -0,0 +1,77 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import astro
+from astro import acquire_lease, release_lease
+
+
+def test_lease_is_exclusive_until_expiry(mongo):
+    meta = mongo[astro.MONGO_META_COLLECTION_NAME]
+
+    async def scenario():
+        first = await acquire_lease(meta, "job", "a", 60)
+        taken = await acquire_lease(meta, "job", "b", 60)
+        renewed = await acquire_lease(meta, "job", "a", 60)
+        await meta.update_one({"_id": "job"}, {"$set": {"lease_until": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+        takeover = await acquire_lease(meta, "job", "b", 60)
+        lost = await acquire_lease(meta, "job", "a", 60)
+        return first, taken, renewed, takeover, lost, await meta.find_one({"_id": "job"})
+
+    first, taken, renewed, takeover, lost, document = asyncio.run(scenario())
+    assert (first, taken, renewed, takeover, lost) == (True, False, True, True, False)
+    assert document["lease_owner"] == "b"
+
+
+def test_released_lease_is_free_for_others(mongo):
+    meta = mongo[astro.MONGO_META_COLLECTION_NAME]
+
+    async def scenario():
+        await acquire_lease(meta, "job", "a", 60)
+        await release_lease(meta, "job", "b") # Чужая аренда не снимается
+        held = await acquire_lease(meta, "job", "b", 60)
+        await release_lease(meta, "job", "a")
+        return held, await acquire_lease(meta, "job", "b", 60)
+
+    assert asyncio.run(scenario()) == (False, True)
+
+
+def _shards(mongo, day: str, count: int):
+    return mongo[astro.MONGO_BROADCASTS_COLLECTION_NAME].insert_many([
+        {"_id": f"{day}:{shard:03d}", "day": day, "shard": shard, "finished": False, "lease_until": None}
+        for shard in range(count)
+    ])
+
+
+def test_claim_broadcast_shard_takes_over_expired_shard(mongo):
+    broadcasts = mongo[astro.MONGO_BROADCASTS_COLLECTION_NAME]
+    day = astro.today_key()
+
+    async def scenario():
+        await _shards(mongo, day, 2)
+        first = await astro.claim_broadcast_shard(day, "a")
+        second = await astro.claim_broadcast_shard(day, "b")
+        exhausted = await astro.claim_broadcast_shard(day, "c")
+        # Запуск a упал, его аренда истекла
+        await broadcasts.update_one(
+            {"_id": first["_id"]}, {"$set": {"lease_until": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+        )
+        takeover = await astro.claim_broadcast_shard(day, "c")
+        return first, second, exhausted, takeover
+
+    first, second, exhausted, takeover = asyncio.run(scenario())
+    assert (first["shard"], second["shard"]) == (0, 1)
+    assert exhausted is None
+    assert takeover["_id"] == first["_id"]
+    assert takeover["lease_owner"] == "c"
+
+
+def test_claim_broadcast_shard_skips_finished_shards(mongo):
+    broadcasts = mongo[astro.MONGO_BROADCASTS_COLLECTION_NAME]
+    day = astro.today_key()
+
+    async def scenario():
+        await _shards(mongo, day, 2)
+        await broadcasts.update_one({"shard": 0}, {"$set": {"finished": True}})
+        return await astro.claim_broadcast_shard(day, "a")
+
+    assert asyncio.run(scenario())["shard"] == 1
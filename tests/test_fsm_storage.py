@@ -0,0 +1,78 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+import astro
+from runtime.metrics import metrics
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=2)
+
+
+def _fsm(mongo):
+    return mongo[astro.MONGO_FSM_COLLECTION_NAME]
+
+
+def test_conflicting_write_rereads_and_keeps_both_changes(mongo):
+    # Два инстанса с кэшем: первый меняет данные по устаревшей версии документа
+    first = astro.MongoStorage(lambda: _fsm(mongo))
+    second = astro.MongoStorage(lambda: _fsm(mongo))
+
+    async def scenario():
+        await first.set_state(KEY, "UserState:choosing_sign")
+        await second.get_state(KEY)
+        await first.set_state(KEY, "UserState:choosing_date")
+        conflicts = metrics.counters.get(("astro_fsm_conflicts_total", ()), 0)
+        await second.set_data(KEY, {"sign": 3})
+        return (
+            metrics.counters.get(("astro_fsm_conflicts_total", ()), 0) - conflicts,
+            await _fsm(mongo).find_one({}),
+            await second.get_state(KEY),
+        )
+
+    conflicts, document, cached_state = asyncio.run(scenario())
+    assert conflicts == 1
+    assert (document["v"], document["state"], document["data"]) == (3, "UserState:choosing_date", {"sign": 3})
+    assert cached_state == "UserState:choosing_date" # Кэш обновлен перечитанным документом
+
+
+def test_cache_serves_reads_until_ttl_and_no_cache_reads_fresh(mongo):
+    cached = astro.MongoStorage(lambda: _fsm(mongo))
+    uncached = astro.MongoStorage(lambda: _fsm(mongo), cache_ttl=0)
+    writer = astro.MongoStorage(lambda: _fsm(mongo))
+
+    async def scenario():
+        await writer.set_state(KEY, "UserState:choosing_sign")
+        await cached.get_state(KEY)
+        await uncached.get_state(KEY)
+        await writer.set_state(KEY, "UserState:choosing_date")
+        return await cached.get_state(KEY), await uncached.get_state(KEY)
+
+    assert asyncio.run(scenario()) == ("UserState:choosing_sign", "UserState:choosing_date")
+
+
+def test_clearing_session_deletes_document(mongo):
+    storage = astro.MongoStorage(lambda: _fsm(mongo))
+
+    async def scenario():
+        await storage.set_state(KEY, "UserState:choosing_sign")
+        await storage.set_data(KEY, {"sign": 1})
+        await storage.set_data(KEY, {})
+        await storage.set_state(KEY, None)
+        return await _fsm(mongo).count_documents({}), await storage.get_state(KEY), await storage.get_data(KEY)
+
+    assert asyncio.run(scenario()) == (0, None, {})
+
+
+def test_documents_without_version_are_version_zero(mongo):
+    storage = astro.MongoStorage(lambda: _fsm(mongo), cache_ttl=0)
+
+    async def scenario():
+        # Документ записан до появления версий
+        await _fsm(mongo).insert_one(
+            {"_id": storage.key_builder.build(KEY), "state": "UserState:choosing_sign", "data": {}}
+        )
+        await storage.set_data(KEY, {"sign": 5})
+        return await _fsm(mongo).find_one({})
+
+    document = asyncio.run(scenario())
+    assert (document["v"], document["state"], document["data"]) == (1, "UserState:choosing_sign", {"sign": 5})
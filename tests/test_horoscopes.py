@@ -0,0 +1,47 @@
+import asyncio
+from datetime import date, timedelta
+
+import astro
+
+DAY = "2024-05-15" # Среда
+
+
+def _body(text: str) -> str:
+    return text.split("\n\n", 1)[1]
+
+
+def test_bulk_rendering_matches_single_texts():
+    rendered = astro.render_horoscopes(DAY, 2)
+    assert len(rendered[DAY]) == len(astro.ZODIAC_SIGNS) * len(astro.DATE_TYPES) * len(astro.HOROSCOPE_TYPES)
+    for day, texts in rendered.items():
+        for (sign, date_type, horoscope_type), text in texts.items():
+            assert text == astro.render_horoscope(sign, date_type, horoscope_type, day)
+
+
+def test_texts_depend_on_forecast_date_not_request_day():
+    sign = astro.ZODIAC_SIGNS[3]
+    tomorrow = (date.fromisoformat(DAY) + timedelta(days=1)).isoformat()
+    assert _body(astro.render_horoscope(sign, "tomorrow", "love", DAY)) == \
+        _body(astro.render_horoscope(sign, "today", "love", tomorrow))
+    monday = date.fromisoformat(DAY) - timedelta(days=2)
+    weeks = {_body(astro.render_horoscope(sign, "week", "love", (monday + timedelta(days=offset)).isoformat()))
+             for offset in range(7)}
+    assert len(weeks) == 1
+
+
+def test_seed_is_stable_across_processes():
+    # Все инстансы должны отдавать одни и те же тексты: зерно - blake2b, а не hash() с солью процесса
+    seed = astro.horoscope_seed(astro.ZODIAC_SIGNS[7], DAY, "health")
+    assert seed.hex() == "3cf631dde480b7bf244787eedcf82f0b"
+
+
+def test_prewarmed_days_are_served_from_mongo(mongo):
+    async def scenario():
+        added = await astro.horoscope_store.prewarm(DAY, 2)
+        again = await astro.horoscope_store.prewarm(DAY, 2)
+        store = astro.HoroscopeStore()
+        return added, again, await store._load_day(DAY)
+
+    added, again, texts = asyncio.run(scenario())
+    assert (added, again) == (2, 0)
+    assert texts == astro.render_all_horoscopes(DAY)
@@ -0,0 +1,157 @@
+import asyncio
+
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.methods import EditMessageText, SendMessage
+
+from astro import OutboundDispatcher
+
+
+class FakeApi:
+    """make_request для OutboundDispatcher: запросы ждут gate, отправленные копятся в sent."""
+
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.sent = []
+
+    async def __call__(self, bot, method):
+        await self.gate.wait()
+        self.sent.append(method.text)
+        return method.text
+
+
+async def _queue_behind_message(dispatcher: OutboundDispatcher, api: FakeApi):
+    # Первый запрос занимает очередь чата, правки за ним ждут своей очереди
+    blocker = asyncio.ensure_future(dispatcher(api, None, SendMessage(chat_id=1, text="message")))
+    await asyncio.sleep(0)
+    return blocker
+
+
+def _edit(text: str) -> EditMessageText:
+    return EditMessageText(chat_id=1, message_id=5, text=text)
+
+
+def test_pending_edits_are_coalesced():
+    async def scenario():
+        dispatcher, api = OutboundDispatcher(0, 0), FakeApi()
+        blocker = await _queue_behind_message(dispatcher, api)
+        edits = [asyncio.ensure_future(dispatcher(api, None, _edit(f"e{index}"))) for index in range(3)]
+        await asyncio.sleep(0)
+        api.gate.set()
+        return await blocker, await asyncio.gather(*edits), api.sent, dispatcher
+
+    blocker, edits, sent, dispatcher = asyncio.run(scenario())
+    assert blocker == "message"
+    assert edits == ["e2", "e2", "e2"]
+    assert sent == ["message", "e2"]
+    assert dispatcher.pending_edits == {} and dispatcher.chats == {}
+
+
+def test_cancelled_sender_hands_edit_to_coalesced_caller():
+    async def scenario():
+        dispatcher, api = OutboundDispatcher(0, 0), FakeApi()
+        blocker = await _queue_behind_message(dispatcher, api)
+        first = asyncio.ensure_future(dispatcher(api, None, _edit("e1")))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(dispatcher(api, None, _edit("e2")))
+        await asyncio.sleep(0)
+        # Отменяется вызвавший, который стоит в очереди чата: склеенную правку отправит второй
+        first.cancel()
+        await asyncio.sleep(0)
+        third = asyncio.ensure_future(dispatcher(api, None, _edit("e3")))
+        await asyncio.sleep(0)
+        api.gate.set()
+        return first, await blocker, await second, await third, api.sent, dispatcher
+
+    first, blocker, second, third, sent, dispatcher = asyncio.run(scenario())
+    assert first.cancelled()
+    assert (second, third) == ("e3", "e3")
+    assert sent == ["message", "e3"]
+    assert dispatcher.pending_edits == {} and dispatcher.chats == {}
+
+
+def test_edit_cancelled_during_request_is_resent_for_coalesced_caller():
+    async def scenario():
+        dispatcher, gate = OutboundDispatcher(0, 0), asyncio.Event()
+        edit_started, sent = asyncio.Event(), []
+
+        async def make_request(bot, method):
+            await gate.wait()
+            if isinstance(method, EditMessageText) and not edit_started.is_set():
+                edit_started.set()
+                await asyncio.Event().wait() # Первая отправка правки висит, пока вызвавшего не отменят
+            sent.append(method.text)
+            return method.text
+
+        blocker = asyncio.ensure_future(dispatcher(make_request, None, SendMessage(chat_id=1, text="message")))
+        await asyncio.sleep(0)
+        first = asyncio.ensure_future(dispatcher(make_request, None, _edit("e1")))
+        second = asyncio.ensure_future(dispatcher(make_request, None, _edit("e2")))
+        await asyncio.sleep(0)
+        gate.set()
+        await edit_started.wait()
+        first.cancel()
+        return await blocker, await second, sent, dispatcher
+
+    blocker, second, sent, dispatcher = asyncio.run(scenario())
+    assert second == "e2"
+    assert sent == ["message", "e2"]
+    assert dispatcher.pending_edits == {} and dispatcher.chats == {}
+
+
+def test_edit_cancelled_by_every_caller_is_dropped():
+    async def scenario():
+        dispatcher, api = OutboundDispatcher(0, 0), FakeApi()
+        blocker = await _queue_behind_message(dispatcher, api)
+        edits = [asyncio.ensure_future(dispatcher(api, None, _edit(f"e{index}"))) for index in range(2)]
+        await asyncio.sleep(0)
+        for edit in edits:
+            edit.cancel()
+        await asyncio.sleep(0)
+        pending_after_cancel = dict(dispatcher.pending_edits)
+        api.gate.set()
+        return pending_after_cancel, await blocker, api.sent, dispatcher
+
+    pending_after_cancel, blocker, sent, dispatcher = asyncio.run(scenario())
+    assert pending_after_cancel == {}
+    assert sent == ["message"]
+    assert dispatcher.chats == {}
+
+
+def test_failed_edit_fails_coalesced_callers():
+    async def scenario():
+        dispatcher = OutboundDispatcher(0, 0)
+        gate = asyncio.Event()
+
+        async def make_request(bot, method):
+            await gate.wait()
+            if isinstance(method, EditMessageText):
+                raise TelegramNetworkError(method=method, message="down")
+            return True
+
+        blocker = asyncio.ensure_future(dispatcher(make_request, None, SendMessage(chat_id=1, text="message")))
+        await asyncio.sleep(0)
+        edits = [asyncio.ensure_future(dispatcher(make_request, None, _edit(f"e{index}"))) for index in range(2)]
+        await asyncio.sleep(0)
+        gate.set()
+        await blocker
+        return await asyncio.gather(*edits, return_exceptions=True), dispatcher
+
+    results, dispatcher = asyncio.run(scenario())
+    assert all(isinstance(result, TelegramNetworkError) for result in results)
+    assert dispatcher.pending_edits == {} and dispatcher.chats == {}
+
+
+def test_network_errors_are_retried():
+    async def scenario():
+        dispatcher = OutboundDispatcher(0, 1)
+        attempts = []
+
+        async def make_request(bot, method):
+            attempts.append(method)
+            if len(attempts) == 1:
+                raise TelegramNetworkError(method=method, message="down")
+            return True
+
+        return await dispatcher(make_request, None, SendMessage(chat_id=1, text="message")), len(attempts)
+
+    assert asyncio.run(scenario()) == (True, 2)
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+import astro
+
+
+class FakeBot:
+    id = 1
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+@pytest.fixture
+def bot(mongo, monkeypatch):
+    """Бот без сети и свой диспетчер на mongomock; провайдеры подтверждают оплату с первой проверки."""
+    fake = FakeBot()
+    monkeypatch.setattr(astro, "get_bot", lambda: fake)
+    monkeypatch.setattr(astro, "_dp", None)
+    monkeypatch.setattr(astro, "payment_providers", {
+        "adsgram": astro.MockPaymentProvider(0), "ton": astro.MockPaymentProvider(0)
+    })
+    return fake
+
+
+def _state(bot, user_id: int, chat_id: int):
+    return astro.get_dispatcher().fsm.get_context(bot=bot, chat_id=chat_id, user_id=user_id).get_state()
+
+
+def test_submit_rejects_group_already_on_check(mongo):
+    verifier = astro.PaymentVerifier(60, 60, False)
+
+    async def scenario():
+        return await verifier.submit("g", 1, 1), await verifier.submit("g", 1, 1), await verifier.submit("h", 1, 1)
+
+    assert asyncio.run(scenario()) == (True, False, True)
+
+
+def test_check_is_claimed_once(mongo):
+    verifier = astro.PaymentVerifier(60, 60, False)
+
+    async def scenario():
+        await verifier.submit("g", 1, 1)
+        return await asyncio.gather(*(verifier._claim("g") for _ in range(3)))
+
+    assert sorted(asyncio.run(scenario())) == [False, False, True]
+
+
+def test_leader_hands_confirmation_to_chat_owner(mongo, bot):
+    leader = astro.PaymentVerifier(60, 60, False)
+    delivered = []
+
+    async def deliver(update):
+        delivered.append(update)
+        return True
+
+    leader.deliver = deliver
+
+    async def scenario():
+        await mongo[astro.MONGO_COLLECTION_NAME].insert_one({"_id": 7, astro.USER_QUOTA_USED: 2})
+        group = await astro.create_payment_orders(7)
+        await leader.submit(group, 7, 70)
+        await leader.poll()
+        # Лидер не трогает ни FSM, ни буфер записей: счетчик сброшен прямо в базе
+        leader_side = (
+            list(bot.sent), await _state(bot, 7, 70), dict(astro.user_writes.pending),
+            await mongo[astro.MONGO_COLLECTION_NAME].find_one({"_id": 7}),
+        )
+        # Процесс чата получает служебное обновление тем же путем, что и обновления Telegram
+        for update in delivered:
+            await astro.get_dispatcher().feed_raw_update(bot=bot, update=update)
+        return leader_side, bot.sent, await _state(bot, 7, 70)
+
+    (sent_by_leader, leader_state, pending, user), sent, state = asyncio.run(scenario())
+    assert len(delivered) == 1 and astro.update_chat_id(delivered[0]) == 70
+    assert (sent_by_leader, leader_state, pending) == ([], None, {})
+    assert user[astro.USER_QUOTA_USED] == 0
+    assert [chat_id for chat_id, _ in sent] == [70]
+    assert state == astro.UserState.choosing_sign.state
+
+
+def test_confirmation_of_unpaid_order_is_ignored(mongo, bot):
+    async def scenario():
+        group = await astro.create_payment_orders(8)
+        update = astro.payment_confirmed_update(f"adsgram_{group}", 8, 80)
+        await astro.get_dispatcher().feed_raw_update(bot=bot, update=update)
+        return bot.sent, await _state(bot, 8, 80)
+
+    assert asyncio.run(scenario()) == ([], None)
@@ -0,0 +1,49 @@
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import astro
+from runtime.leases import LeaderLease
+from runtime.updates import REPLICA_SEED, WORKER_SEED, chat_shard
+
+
+def test_chat_shard_spreads_replica_chats_over_workers():
+    # При chat_id % N чаты одной реплики из двух достались бы одному воркеру из двух
+    pairs = Counter(
+        (chat_shard(chat_id, 2, REPLICA_SEED), chat_shard(chat_id, 2, WORKER_SEED))
+        for chat_id in range(10000)
+    )
+    assert len(pairs) == 4
+    assert min(pairs.values()) > 2000
+
+
+def test_leader_lease_runs_job_once_leader(mongo):
+    meta = mongo[astro.MONGO_META_COLLECTION_NAME]
+
+    async def scenario():
+        async def job():
+            return (await meta.find_one({"_id": "leader:test"}))["lease_owner"]
+
+        owner = await LeaderLease(meta, "test", 60).run(job)
+        return owner, await meta.find_one({"_id": "leader:test"})
+
+    owner, document = asyncio.run(scenario())
+    assert owner == astro.INSTANCE_ID
+    assert document["lease_until"] is None # Аренда отпущена после завершения задачи
+
+
+def test_leader_lease_waits_for_expired_lease(mongo):
+    meta = mongo[astro.MONGO_META_COLLECTION_NAME]
+
+    async def scenario():
+        until = datetime.now(timezone.utc) + timedelta(seconds=0.2)
+        await meta.insert_one({"_id": "leader:test", "lease_owner": "other", "lease_until": until})
+
+        async def job():
+            return datetime.now(timezone.utc)
+
+        return until, await LeaderLease(meta, "test", 0.3).run(job)
+
+    until, started = asyncio.run(scenario())
+    # mongomock хранит время с точностью до миллисекунд
+    assert started >= until - timedelta(milliseconds=1)
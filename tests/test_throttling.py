@@ -0,0 +1,77 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import AnswerCallbackQuery
+
+import astro
+from runtime.throttling import ThrottlingMiddleware
+
+
+class FakeBot:
+    id = 1
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, method, request_timeout=None):
+        self.calls.append(method)
+        return True
+
+
+class CountingStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    async def get_state(self, key):
+        self.reads += 1
+        return await super().get_state(key)
+
+
+def _callback(update_id: int, user_id: int) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": "user"}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user, "chat_instance": "chat", "data": "noop",
+        "message": {"message_id": 1, "date": 0, "chat": {"id": user_id, "type": "private"}},
+    }}
+
+
+def test_flood_is_dropped_before_fsm_state_is_loaded(monkeypatch):
+    monkeypatch.setattr(astro, "THROTTLE_RATE", 0.001)
+    monkeypatch.setattr(astro, "THROTTLE_BURST", 2)
+    monkeypatch.setattr(astro, "_dp", None)
+    dispatcher, bot, storage = astro.get_dispatcher(), FakeBot(), CountingStorage()
+    dispatcher.fsm.storage = storage
+
+    async def scenario():
+        for update_id in range(5):
+            await dispatcher.feed_raw_update(bot=bot, update=_callback(update_id, 9))
+        await dispatcher.feed_raw_update(bot=bot, update=_callback(5, 10)) # Другого пользователя лимит не касается
+
+    asyncio.run(scenario())
+    assert storage.reads == 3 # Два обновления в пределах burst и одно от другого пользователя
+    # Подсказка - только на первое отброшенное нажатие
+    assert [type(call) for call in bot.calls] == [AnswerCallbackQuery]
+
+
+def test_handler_limit_applies_on_top_of_user_limit():
+    throttling = ThrottlingMiddleware(100, 100, 1000, {"cmd_start": (0.001, 1)})
+    handled = []
+
+    async def cmd_start(event, data):
+        handled.append(event)
+
+    async def other(event, data):
+        handled.append(event)
+
+    async def scenario():
+        user = SimpleNamespace(id=1)
+        for index in range(3):
+            for callback in (cmd_start, other):
+                data = {"event_from_user": user, "handler": SimpleNamespace(callback=callback, flags={})}
+                await throttling(callback, (callback.__name__, index), data)
+
+    asyncio.run(scenario())
+    # У other нет своего лимита: общий лимит пользователя проверяет UpdateThrottlingMiddleware
+    assert handled == [("cmd_start", 0), ("other", 0), ("other", 1), ("other", 2)]
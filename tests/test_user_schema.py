@@ -0,0 +1,134 @@
+import asyncio
+
+import astro
+from astro import acquire_lease
+
+
+def test_compact_user():
+    legacy = {
+        "user_id": 5,
+        "sign": astro.ZODIAC_SIGNS[4],
+        "birth_date": "1990-08-01",
+        "last_horoscope_date": "2024-05-01",
+        "daily_horoscopes_given": 2,
+        "blocked": True,
+        "blocked_at": "2024-06-02",
+    }
+    assert astro.compact_user(legacy) == {
+        astro.USER_SIGN: 4,
+        astro.USER_BIRTH_DATE: 19900801,
+        astro.USER_QUOTA_DAY: 20240501,
+        astro.USER_QUOTA_USED: 2,
+        astro.USER_BLOCKED_DAY: 20240602,
+    }
+
+
+def test_compact_user_derives_sign_from_birth_date():
+    compact = astro.compact_user({"user_id": 6, "birth_date": "1990-08-01"})
+    assert compact[astro.USER_SIGN] == astro.SIGN_INDEX[astro.get_zodiac_sign(1, 8)]
+
+
+def test_compact_user_skips_missing_fields():
+    assert astro.compact_user({"user_id": 7}) == {}
+
+
+def test_migrate_users_swaps_unique_index_and_is_idempotent(mongo):
+    users = mongo[astro.MONGO_COLLECTION_NAME]
+
+    async def scenario():
+        await users.create_index("user_id", unique=True)
+        await users.create_index([("sign", 1), ("user_id", 1)])
+        await users.insert_many([
+            {"user_id": 1, "sign": astro.ZODIAC_SIGNS[0], "daily_horoscopes_given": 1,
+             "last_horoscope_date": "2024-05-01"},
+            {"user_id": 2},
+        ])
+        # Пользователь, который успел получить компактный документ до миграции
+        await users.insert_one({"_id": 3, astro.USER_QUOTA_USED: 2})
+        await users.insert_one({"user_id": 3, "daily_horoscopes_given": 0, "sign": astro.ZODIAC_SIGNS[1]})
+        first = await astro.migrate_users(batch_size=2)
+        second = await astro.migrate_users()
+        documents = {document["_id"]: document async for document in users.find()}
+        return first, second, documents, await users.index_information()
+
+    first, second, documents, indexes = asyncio.run(scenario())
+    assert (first, second) == (3, 0)
+    assert documents == {
+        1: {"_id": 1, astro.USER_SIGN: 0, astro.USER_QUOTA_USED: 1, astro.USER_QUOTA_DAY: 20240501},
+        2: {"_id": 2, astro.USER_QUOTA_USED: 0},
+        3: {"_id": 3, astro.USER_SIGN: 1, astro.USER_QUOTA_USED: 2},
+    }
+    assert not set(indexes) & {"user_id_1", *astro.LEGACY_USER_INDEXES}
+
+
+def test_migrate_users_waits_for_lease_holder(mongo):
+    users = mongo[astro.MONGO_COLLECTION_NAME]
+
+    async def scenario():
+        await users.insert_one({"user_id": 9})
+        await acquire_lease(mongo[astro.MONGO_META_COLLECTION_NAME], "users_migration", "other", 60)
+        return await astro.migrate_users(), await users.count_documents({"user_id": 9})
+
+    assert asyncio.run(scenario()) == (0, 1)
+
+
+def test_migrate_users_stops_at_time_budget(mongo):
+    users = mongo[astro.MONGO_COLLECTION_NAME]
+
+    async def scenario():
+        await users.create_index("user_id", unique=True)
+        await users.insert_many([{"user_id": user_id} for user_id in range(1, 5)])
+        first = await astro.migrate_users(batch_size=2, time_budget=1e-9)
+        legacy = await users.count_documents({"user_id": {"$exists": True}})
+        second = await astro.migrate_users(batch_size=2, time_budget=1e-9)
+        last = await astro.migrate_users(batch_size=2, time_budget=1e-9)
+        return first, legacy, second, last, await astro.users_migration_pending()
+
+    assert asyncio.run(scenario()) == (2, 2, 2, 0, False)
+
+
+def test_ensure_indexes_replaces_unique_index_without_migrating(mongo):
+    users = mongo[astro.MONGO_COLLECTION_NAME]
+
+    async def scenario():
+        await users.create_index("user_id", unique=True)
+        await users.insert_one({"user_id": 8, "sign": astro.ZODIAC_SIGNS[2]})
+        await astro.ensure_indexes()
+        # Компактные документы без user_id больше не конфликтуют по уникальному индексу
+        await astro.register_user(10)
+        await astro.register_user(11)
+        await astro.user_writes.flush()
+        return await users.count_documents({"user_id": 8}), await users.index_information()
+
+    legacy, indexes = asyncio.run(scenario())
+    assert legacy == 1
+    assert "user_id_1" not in indexes and astro.LEGACY_USER_INDEXES[0] in indexes
+
+
+def test_drop_user_index_tolerates_concurrent_drop(mongo):
+    users = mongo[astro.MONGO_COLLECTION_NAME]
+
+    async def scenario():
+        await users.create_index("user_id", unique=True)
+        await asyncio.gather(astro.replace_legacy_user_index(), astro.replace_legacy_user_index())
+        await astro.drop_user_index("user_id_1")
+        return await users.index_information()
+
+    indexes = asyncio.run(scenario())
+    assert "user_id_1" not in indexes and astro.LEGACY_USER_INDEXES[0] in indexes
+
+
+def test_compact_users_derives_batch_signs_with_and_without_numpy(monkeypatch):
+    legacy = [
+        {"user_id": 12, "birth_date": "1990-08-01"},
+        {"user_id": 13, "sign": astro.ZODIAC_SIGNS[1], "birth_date": "1990-08-01"},
+        {"user_id": 14, "birth_date": "1985-01-15"},
+    ]
+    expected = [
+        astro.SIGN_INDEX[astro.get_zodiac_sign(1, 8)], 1, astro.SIGN_INDEX[astro.get_zodiac_sign(15, 1)],
+    ]
+    signs = [compact[astro.USER_SIGN] for compact in astro.compact_users(legacy)]
+    monkeypatch.setattr(astro, "_numpy", False)
+    fallback = [compact[astro.USER_SIGN] for compact in astro.compact_users(legacy)]
+    assert signs == fallback == expected
+    assert all(type(sign) is int for sign in signs + fallback)
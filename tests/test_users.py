@@ -0,0 +1,79 @@
+import asyncio
+
+import astro
+
+
+def test_concurrent_consume_never_exceeds_daily_limit(mongo):
+    async def scenario():
+        await astro.register_user(1)
+        await astro.user_writes.flush()
+        results = await asyncio.gather(*(astro.consume_free_horoscope(1) for _ in range(10)))
+        return results, await mongo[astro.MONGO_COLLECTION_NAME].find_one({"_id": 1})
+
+    results, document = asyncio.run(scenario())
+    assert sum(results) == astro.DAILY_FREE_HOROSCOPES
+    assert document[astro.USER_QUOTA_USED] == astro.DAILY_FREE_HOROSCOPES
+    assert document[astro.USER_QUOTA_DAY] == astro.day_number(astro.today_key())
+
+
+class InterleavedCollection:
+    """
+    Коллекция, которая отдает управление циклу до и после каждого запроса, как настоящий драйвер.
+    mongomock-motor выполняет запрос, не переключаясь, и гонки между запросами не воспроизводит.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+        if not asyncio.iscoroutinefunction(method):
+            return method
+
+        async def call(*args, **kwargs):
+            await asyncio.sleep(0)
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                await asyncio.sleep(0)
+
+        return call
+
+
+def test_concurrent_consume_for_new_user_inserts_once(mongo, monkeypatch):
+    monkeypatch.setattr(astro, "users_collection", InterleavedCollection(mongo[astro.MONGO_COLLECTION_NAME]))
+
+    async def scenario():
+        results = await asyncio.gather(*(astro.consume_free_horoscope(2) for _ in range(10)))
+        return results, await mongo[astro.MONGO_COLLECTION_NAME].find_one({"_id": 2})
+
+    results, document = asyncio.run(scenario())
+    assert sum(results) == astro.DAILY_FREE_HOROSCOPES
+    assert document[astro.USER_QUOTA_USED] == astro.DAILY_FREE_HOROSCOPES
+
+
+def test_consume_resets_quota_on_new_day(mongo):
+    async def scenario():
+        await mongo[astro.MONGO_COLLECTION_NAME].insert_one(
+            {"_id": 3, astro.USER_QUOTA_DAY: 20200101, astro.USER_QUOTA_USED: astro.DAILY_FREE_HOROSCOPES}
+        )
+        allowed = await astro.consume_free_horoscope(3)
+        return allowed, await mongo[astro.MONGO_COLLECTION_NAME].find_one({"_id": 3})
+
+    allowed, document = asyncio.run(scenario())
+    assert allowed
+    assert document[astro.USER_QUOTA_USED] == 1
+    assert document[astro.USER_QUOTA_DAY] == astro.day_number(astro.today_key())
+
+
+def test_consume_flushes_pending_quota_reset_first(mongo):
+    async def scenario():
+        today = astro.day_number(astro.today_key())
+        await mongo[astro.MONGO_COLLECTION_NAME].insert_one(
+            {"_id": 4, astro.USER_QUOTA_DAY: today, astro.USER_QUOTA_USED: astro.DAILY_FREE_HOROSCOPES}
+        )
+        # Сброс счетчика после оплаты еще в буфере
+        await astro.update_user_data(4, {astro.USER_QUOTA_USED: 0})
+        return await astro.consume_free_horoscope(4)
+
+    assert asyncio.run(scenario())